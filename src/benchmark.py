@@ -0,0 +1,585 @@
+#
+# Copyright 2023 OpenIndex.de.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import argparse
+import base64
+import gc
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import threading
+import time
+import timeit
+import tracemalloc
+from configparser import ConfigParser
+from datetime import datetime, timedelta
+from email import quoprimime
+from typing import Callable
+
+from imapclient.response_parser import parse_fetch_response
+from imapclient.response_types import Envelope, Address
+
+from lib import create_logger, \
+    decode_rfc2047, \
+    get_envelope_message_id, \
+    get_envelope_in_reply_to, \
+    get_envelope_date, \
+    get_envelope_subject, \
+    get_envelope_from_first, \
+    get_envelope_sender_first, \
+    get_envelope_to, \
+    get_envelope_to_first, \
+    get_envelope_cc, \
+    get_address_name, \
+    get_address_mail
+from lib.callback import CallbackThread
+from lib.event import MessageEvent
+from lib.idle import ImapIdleHandler
+from lib.spawner import parse_command, get_process_reaper
+from lib.config import create_callback_handler, \
+    create_imap_connector, \
+    create_imap_idle_handler, \
+    get_imap_folder, \
+    read_config
+
+logger = create_logger()
+
+BENCHMARK_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmark')
+"""
+Directory with fixtures and baselines of the microbenchmarks.
+"""
+
+CHARSETS: dict[str, str] = {
+    'utf-8': 'Grüße Öl naïve façade € 漢字 ありがとう Привет 🚀',
+    'iso-8859-1': 'Grüße Öl naïve façade Björn',
+    'iso-8859-15': 'Prix spécial € réduction Élodie',
+    'windows-1252': '“Quotes” – dashes … Zoë €',
+    'koi8-r': 'Отчёт о продажах Иван Петров',
+    'iso-2022-jp': '会議の議事録 ありがとう 山田太郎',
+    'gb2312': '您的订单已发货 客服中心',
+    'big5': '會員通知 帳戶安全更新',
+    'euc-kr': '회의 일정 변경 안내 김민준',
+    'iso-8859-7': 'Ενημέρωση λογαριασμού Γιώργος',
+}
+"""
+Charsets of synthetic fixtures with characters, that are used for random text.
+"""
+
+
+def create_mailbox_config(count: int, hosts: int = 10) -> ConfigParser:
+    """
+    Creates a configuration with synthetic mailbox sections.
+
+    :param count: number of mailboxes
+    :param hosts: number of distinct hosts
+    :return: configuration
+    """
+
+    config = ConfigParser()
+    for i in range(count):
+        section = 'mailbox%s' % i
+        config.add_section(section)
+        config.set(section, 'host', 'imap%s.example.com' % (i % hosts))
+        config.set(section, 'port', '993')
+        config.set(section, 'username', 'user%s@example.com' % i)
+        config.set(section, 'password', 'secret%s' % i)
+        config.set(section, 'encryption', 'ssl')
+        config.set(section, 'on_new_message', './callback/printenv.sh')
+        config.set(section, 'env_mail_account', 'user%s@example.com' % i)
+    return config
+
+
+def get_memory() -> tuple[int, int]:
+    """
+    Get virtual and resident memory of the current process.
+
+    :return: virtual and resident memory in bytes
+    """
+
+    with open('/proc/self/statm', 'r') as f:
+        values = f.read().split()
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    return int(values[0]) * page_size, int(values[1]) * page_size
+
+
+def benchmark_memory(count: int, stack_size: int):
+    """
+    Measures the memory footprint of watched mailboxes.
+
+    :param count: number of mailboxes
+    :param stack_size: thread stack size in KiB or 0 for the default size
+    """
+
+    config = create_mailbox_config(count)
+
+    gc.collect()
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+
+    handlers = []
+    for section in config.sections():
+        connector = create_imap_connector(config=config, section=section)
+        callback = create_callback_handler(config=config, section=section)
+        handlers.append(create_imap_idle_handler(
+            config=config,
+            section=section,
+            connector=connector,
+            callback=callback,
+        ))
+
+    gc.collect()
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    logger.info('Python objects: %.0f bytes per mailbox (%s mailboxes).', (after - before) / count, count)
+
+    # each running mailbox holds a thread, that is blocked by network I/O most of the time
+    if stack_size > 0:
+        threading.stack_size(stack_size * 1024)
+
+    stop = threading.Event()
+    vms_before, rss_before = get_memory()
+    threads = [threading.Thread(target=stop.wait) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    vms_after, rss_after = get_memory()
+    stop.set()
+    for thread in threads:
+        thread.join()
+
+    logger.info(
+        'Threads: %.0f bytes resident and %.0f bytes virtual memory per mailbox (stack size %s).',
+        (rss_after - rss_before) / count,
+        (vms_after - vms_before) / count,
+        '%s KiB' % stack_size if stack_size > 0 else 'default'
+    )
+
+
+def benchmark_spawn(count: int, command: str):
+    """
+    Compares callbacks launched through a shell in separate threads with callbacks launched directly.
+
+    :param count: number of callbacks
+    :param command: callback command
+    """
+
+    environment = {**os.environ, 'MESSAGE_ID': '<benchmark@example.com>'}
+
+    # one thread per callback, each running a shell
+    max_threads = threading.active_count()
+    started = time.perf_counter()
+    threads = []
+    for _ in range(count):
+        thread = CallbackThread(name='benchmark', command=command, environment=environment)
+        thread.start()
+        threads.append(thread)
+        max_threads = max(max_threads, threading.active_count())
+    launched = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    finished = time.perf_counter()
+
+    logger.info(
+        'Shell: %.3f ms per launch, %.3f ms per callback, up to %s threads.',
+        (launched - started) * 1000 / count,
+        (finished - started) * 1000 / count,
+        max_threads
+    )
+
+    # direct launch, all processes are collected by a single reaper thread
+    reaper = get_process_reaper()
+    argv = parse_command(command)
+    done = threading.Semaphore(0)
+    max_threads = threading.active_count()
+    started = time.perf_counter()
+    for _ in range(count):
+        reaper.spawn(argv=argv, environment=environment, on_exit=lambda code: done.release())
+        max_threads = max(max_threads, threading.active_count())
+    launched = time.perf_counter()
+    for _ in range(count):
+        done.acquire()
+    finished = time.perf_counter()
+
+    logger.info(
+        'Direct: %.3f ms per launch, %.3f ms per callback, up to %s threads.',
+        (launched - started) * 1000 / count,
+        (finished - started) * 1000 / count,
+        max_threads
+    )
+
+
+def log_durations(label: str, durations: list[float]):
+    """
+    Log statistics about measured durations.
+
+    :param label: name of the measurement
+    :param durations: durations in seconds
+    """
+
+    logger.info(
+        '%s: %.1f ms median, %.1f ms average, %.1f ms min, %.1f ms max (%s runs).',
+        label,
+        statistics.median(durations) * 1000,
+        statistics.mean(durations) * 1000,
+        min(durations) * 1000,
+        max(durations) * 1000,
+        len(durations)
+    )
+
+
+def benchmark_fetch(config_path: str, section: str, count: int):
+    """
+    Compares the latency of fetching the latest message on a separate connection with fetching it on the IDLE
+    connection (DONE, FETCH, IDLE).
+
+    :param config_path: path to the configuration file
+    :param section: mailbox section
+    :param count: number of fetches
+    """
+
+    config = read_config(config_path=config_path, logger=logger)
+    if not config:
+        return
+
+    connector = create_imap_connector(config=config, section=section, use_uid=False)
+    folder = get_imap_folder(config=config, section=section)
+    items = ['ENVELOPE', 'UID']
+
+    # a separate connection for each message
+    durations: list[float] = []
+    for _ in range(count):
+        started = time.perf_counter()
+        client = connector.connect()
+        try:
+            message_number = int(client.select_folder(folder, readonly=True).get(b'EXISTS', 0))
+            client.fetch([max(1, message_number)], items)
+        finally:
+            connector.disconnect(client)
+        durations.append(time.perf_counter() - started)
+    log_durations('Separate connection', durations)
+
+    # the IDLE connection is used for fetching
+    durations = []
+    client = connector.connect()
+    try:
+        message_number = int(client.select_folder(folder, readonly=True).get(b'EXISTS', 0))
+        client.idle()
+        for _ in range(count):
+            started = time.perf_counter()
+            client.idle_done()
+            client.fetch([max(1, message_number)], items)
+            client.idle()
+            durations.append(time.perf_counter() - started)
+        client.idle_done()
+    finally:
+        connector.disconnect(client)
+    log_durations('IDLE connection', durations)
+
+
+def encode_words(text: str, charset: str, chars_per_word: int = 12) -> bytes:
+    """
+    Encode a text as RFC 2047 encoded words, alternating between "B" and "Q" encoding.
+
+    :param text: text to encode
+    :param charset: charset of the encoded words
+    :param chars_per_word: number of characters per encoded word
+    :return: encoded header value
+    """
+
+    words = []
+    for i in range(0, len(text), chars_per_word):
+        data = text[i:i + chars_per_word].encode(charset)
+        if len(words) % 2 == 0:
+            words.append('=?%s?b?%s?=' % (charset, base64.b64encode(data).decode('ascii')))
+        else:
+            words.append(quoprimime.header_encode(data, charset))
+    return ' '.join(words).encode('ascii')
+
+
+def create_synthetic_envelopes(count: int = 200, seed: int = 4711) -> list[Envelope]:
+    """
+    Creates reproducible envelopes with encoded subjects and names in many charsets, long subjects and many
+    recipients.
+
+    :param count: number of envelopes
+    :param seed: seed of the random generator
+    :return: envelopes
+    """
+
+    rnd = random.Random(seed)
+    charsets = sorted(CHARSETS)
+
+    def text(charset: str, length: int) -> str:
+        return ''.join(rnd.choice(CHARSETS[charset]) for _ in range(length)).strip() or 'x'
+
+    def address(i: int) -> Address:
+        charset = rnd.choice(charsets)
+        name = encode_words(text(charset, rnd.randint(5, 30)), charset) if rnd.random() < 0.8 else None
+        return Address(name, None, b'user%d' % i, b'example%d.com' % rnd.randint(0, 9))
+
+    envelopes = []
+    date = datetime(2023, 7, 1)
+    for i in range(count):
+        charset = charsets[i % len(charsets)]
+        subject = encode_words(text(charset, rnd.choice((10, 40, 200, 600))), charset)
+        envelopes.append(Envelope(
+            date=date + timedelta(minutes=i),
+            subject=subject,
+            from_=(address(i),) if rnd.random() < 0.9 else None,
+            sender=(address(i),),
+            reply_to=None,
+            to=tuple(address(i + j) for j in range(rnd.choice((1, 2, 10, 100)))),
+            cc=tuple(address(i + j) for j in range(rnd.randint(0, 20))) or None,
+            bcc=None,
+            in_reply_to=b'<%d@example.net>' % (i - 1) if i % 3 == 0 else None,
+            message_id=b'<%d@example.net>' % i,
+        ))
+    return envelopes
+
+
+def load_recorded_envelopes(path: str) -> list[Envelope]:
+    """
+    Load envelopes from raw FETCH responses.
+
+    :param path: path to a file with one untagged FETCH response per line
+    :return: envelopes
+    """
+
+    envelopes = []
+    with open(path, 'rb') as f:
+        for line in f:
+            line = line.rstrip(b'\r\n')
+            if not line or line.startswith(b'#'):
+                continue
+            # "* 1 FETCH (...)" is passed to the parser as "1 (...)", like IMAPClient does
+            data = line.removeprefix(b'* ').replace(b' FETCH ', b' ', 1)
+            for message in parse_fetch_response([data], normalise_times=True, uid_is_key=False).values():
+                envelopes.append(message[b'ENVELOPE'])
+    return envelopes
+
+
+def create_micro_benchmarks(envelopes: list[Envelope]) -> dict[str, tuple[Callable[[], None], int]]:
+    """
+    Creates microbenchmarks for the functions, that are called for each new message.
+
+    :param envelopes: envelope fixtures
+    :return: benchmark functions with the number of processed items per call
+    """
+
+    # noinspection PyUnresolvedReferences
+    get_new_message_number = ImapIdleHandler._ImapIdleHandler__get_new_message_number
+    responses = [
+        [(275, b'EXISTS'), (1, b'RECENT')],
+        [(1, b'RECENT'), (276, b'EXISTS')],
+        [(12, b'FETCH', (b'FLAGS', (b'\\Seen',)))],
+        [(3, b'EXPUNGE'), (274, b'EXISTS')],
+        [],
+    ] * 20
+
+    addresses = [
+        address for envelope in envelopes for address in (*get_envelope_to(envelope), *get_envelope_cc(envelope))
+    ]
+    values = [envelope.subject.decode('ascii', errors='replace') for envelope in envelopes if envelope.subject]
+    values.extend(address.name.decode('ascii', errors='replace') for address in addresses if address.name)
+
+    events = [MessageEvent.from_envelope('benchmark', 'INBOX', envelope, uid=i) for i, envelope in enumerate(envelopes)]
+    additional_env = {'MAIL_ACCOUNT': 'user@example.com'}
+
+    def run_decode_rfc2047():
+        for value in values:
+            decode_rfc2047(value)
+
+    def run_envelope_helpers():
+        for envelope in envelopes:
+            get_envelope_message_id(envelope)
+            get_envelope_in_reply_to(envelope)
+            get_envelope_date(envelope)
+            get_envelope_subject(envelope)
+            get_envelope_from_first(envelope)
+            get_envelope_sender_first(envelope)
+            get_envelope_to_first(envelope)
+
+    def run_address_helpers():
+        for address in addresses:
+            get_address_name(address)
+            get_address_mail(address)
+
+    def run_new_message_number():
+        for response in responses:
+            get_new_message_number(response)
+
+    def run_callback_environment():
+        # same steps as for a new message: create the event once and merge it with the configured variables
+        for i, envelope in enumerate(envelopes):
+            event = MessageEvent.from_envelope('benchmark', 'INBOX', envelope, uid=i)
+            _ = {**additional_env, **event.get_environment()}
+
+    def run_callback_thread():
+        for event in events:
+            CallbackThread(name='benchmark', command='true', environment=event.get_environment())
+
+    return {
+        'decode_rfc2047': (run_decode_rfc2047, len(values)),
+        'envelope_helpers': (run_envelope_helpers, len(envelopes)),
+        'address_helpers': (run_address_helpers, len(addresses)),
+        'new_message_number': (run_new_message_number, len(responses)),
+        'callback_environment': (run_callback_environment, len(envelopes)),
+        'callback_thread': (run_callback_thread, len(events)),
+    }
+
+
+def run_calibration():
+    """
+    Fixed pure Python workload. Results are stored relative to its duration, so that baselines can be compared on
+    faster or slower machines.
+    """
+
+    values = {}
+    for i in range(2000):
+        values['key%s' % i] = str(i).encode('ascii').decode('ascii').strip()
+    ''.join(values.values()).lower()
+
+
+def create_timer(function: Callable[[], None]) -> tuple[timeit.Timer, int]:
+    """
+    Create a timer, that measures the CPU time of a function.
+
+    :param function: function to measure
+    :return: timer and number of calls, that take at least 0.2 seconds
+    """
+
+    # CPU time is not affected by other processes, that run on the same machine
+    timer = timeit.Timer(function, timer=time.process_time)
+    number, _ = timer.autorange()
+    return timer, number
+
+
+def benchmark_micro(baseline_path: str, update_baseline: bool, tolerance: float, repeat: int) -> bool:
+    """
+    Run microbenchmarks for the functions, that are called for each new message, and compare the results with a
+    stored baseline.
+
+    :param baseline_path: path to the baseline file
+    :param update_baseline: store the results as new baseline
+    :param tolerance: allowed slowdown compared to the baseline (e.g. 0.3 for 30%)
+    :param repeat: number of measurements per benchmark
+    :return: False, if a benchmark is slower than allowed
+    """
+
+    envelopes = create_synthetic_envelopes()
+    envelopes.extend(load_recorded_envelopes(os.path.join(BENCHMARK_DIR, 'envelopes.txt')))
+    benchmarks = create_micro_benchmarks(envelopes)
+
+    baseline: dict = {}
+    if not update_baseline:
+        try:
+            with open(baseline_path, 'r') as f:
+                baseline = json.load(f)
+        except FileNotFoundError:
+            logger.warning('No baseline found at "%s".', baseline_path)
+
+    timers = {name: create_timer(function) for name, (function, _) in benchmarks.items()}
+    calibration_timer = create_timer(run_calibration)
+
+    # benchmarks are measured in rounds and compared to the calibration of the same round,
+    # as the speed of the machine might vary while running
+    ratios: dict[str, list[float]] = {name: [] for name in benchmarks}
+    durations: dict[str, float] = {}
+    calibration = 0.0
+    for _ in range(repeat):
+        timer, number = calibration_timer
+        round_calibration = timer.timeit(number) / number
+        calibration = min(calibration, round_calibration) if calibration else round_calibration
+        for name, (timer, number) in timers.items():
+            duration = timer.timeit(number) / number
+            durations[name] = min(durations.get(name, duration), duration)
+            ratios[name].append(duration / round_calibration)
+    logger.info('Calibration: %.1f µs.', calibration * 1000000)
+
+    results: dict[str, float] = {}
+    passed = True
+    for name, (_, items) in benchmarks.items():
+        duration = durations[name]
+        results[name] = statistics.median(ratios[name])
+
+        expected = baseline.get('results', {}).get(name)
+        if not expected:
+            logger.info('%s: %.2f µs per item.', name, duration * 1000000 / items)
+            continue
+
+        ratio = results[name] / expected
+        if ratio > 1 + tolerance:
+            passed = False
+            logger.error('%s: %.2f µs per item, %.0f%% slower than baseline!', name, duration * 1000000 / items,
+                         (ratio - 1) * 100)
+        else:
+            logger.info('%s: %.2f µs per item, %.2fx baseline.', name, duration * 1000000 / items, ratio)
+
+    if update_baseline:
+        with open(baseline_path, 'w') as f:
+            json.dump({
+                'python': platform.python_version(),
+                'calibration': calibration,
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+            f.write('\n')
+        logger.info('Stored baseline at "%s".', baseline_path)
+
+    return passed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks for IMAP Watcher.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    memory_parser = commands.add_parser('memory', help='memory footprint per watched mailbox')
+    memory_parser.add_argument('--count', type=int, default=10000, help='number of mailboxes')
+    memory_parser.add_argument('--stack-size', type=int, default=0, help='thread stack size in KiB')
+
+    spawn_parser = commands.add_parser('spawn', help='cost of launching callback commands')
+    spawn_parser.add_argument('--count', type=int, default=500, help='number of callbacks')
+    spawn_parser.add_argument('--callback', default='true', help='callback command')
+
+    fetch_parser = commands.add_parser('fetch', help='latency of fetching new messages')
+    fetch_parser.add_argument('config', help='path to the configuration file')
+    fetch_parser.add_argument('section', help='mailbox section to connect to')
+    fetch_parser.add_argument('--count', type=int, default=20, help='number of fetches')
+
+    micro_parser = commands.add_parser('micro', help='microbenchmarks of functions called for each new message')
+    micro_parser.add_argument('--baseline', default=os.path.join(BENCHMARK_DIR, 'baseline.json'),
+                              help='path to the baseline file')
+    micro_parser.add_argument('--update-baseline', action='store_true', help='store the results as new baseline')
+    micro_parser.add_argument('--tolerance', type=float, default=0.3, help='allowed slowdown (0.3 = 30%%)')
+    micro_parser.add_argument('--repeat', type=int, default=7, help='number of measurements per benchmark')
+
+    args = parser.parse_args()
+    if args.command == 'memory':
+        benchmark_memory(count=args.count, stack_size=args.stack_size)
+    elif args.command == 'spawn':
+        benchmark_spawn(count=args.count, command=args.callback)
+    elif args.command == 'fetch':
+        benchmark_fetch(config_path=args.config, section=args.section, count=args.count)
+    elif args.command == 'micro':
+        if not benchmark_micro(
+                baseline_path=args.baseline,
+                update_baseline=args.update_baseline,
+                tolerance=args.tolerance,
+                repeat=args.repeat,
+        ):
+            sys.exit(1)
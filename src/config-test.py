@@ -14,7 +14,13 @@
 # limitations under the License.
 #
 
+import argparse
+import json
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from configparser import ConfigParser
 from datetime import datetime
+from time import perf_counter
 
 from imapclient import IMAPClient
 from imapclient.response_types import Address, Envelope
@@ -24,91 +30,197 @@ from lib import get_envelope_subject, \
     get_envelope_from_first, \
     get_envelope_date, \
     create_logger
-from lib.config import get_config, get_imap_folder, create_imap_connector
+from lib.config import read_config, \
+    setup_logging, \
+    get_imap_folder, \
+    create_imap_connector, \
+    create_account_config, \
+    create_external_inventory, \
+    create_inventory
 from lib.connector import ImapConnector
+from lib.inventory import Inventory
+
+PHASES: tuple[str, ...] = ('dns', 'tcp', 'tls', 'greeting', 'login', 'compress', 'select', 'fetch')
+
+
+def test_section(config: ConfigParser, section: str) -> dict:
+    """
+    Test connection to a configured mailbox and fetch its latest message.
+
+    :param config: configuration
+    :param section: section name
+    :return: test result
+    """
+
+    logger = create_logger(section)
+    result: dict = {
+        'section': section,
+        'success': False,
+        'error': None,
+        'timings': {},
+        'capabilities': [],
+        'latest_message': None,
+        'traffic': None,
+    }
+    timings: dict[str, float] = result['timings']
+
+    try:
+        # sequence numbers are used, in order to fetch the latest message without searching
+        connector: ImapConnector = create_imap_connector(config=config, section=section, use_uid=False)
+    except Exception as ex:
+        logger.exception('Invalid configuration. %s', str(ex))
+        result['error'] = 'Invalid configuration. %s' % str(ex)
+        return result
+
+    logger.info('Testing connection...')
+    client: IMAPClient | None = None
+    try:
+        folder = get_imap_folder(config=config, section=section)
+
+        try:
+            client = connector.connect(timings=timings)
+        except Exception as ex:
+            logger.exception('Connection failed. %s', str(ex))
+            result['error'] = 'Connection failed. %s' % str(ex)
+            return result
+
+        try:
+            started_at = perf_counter()
+            select_info = client.select_folder(folder, readonly=True)
+            timings['select'] = perf_counter() - started_at
+        except Exception as ex:
+            logger.exception('Folder selection failed. %s', str(ex))
+            result['error'] = 'Folder selection failed. %s' % str(ex)
+            return result
+
+        logger.info('Connection successful.')
+
+        try:
+            capabilities = []
+            for cap in client.capabilities():
+                capabilities.append(cap.decode('utf-8'))
+
+            result['capabilities'] = sorted(capabilities)
+            logger.info('Capabilities: %s', ', '.join(result['capabilities']))
+        except Exception as ex:
+            logger.exception('Can\'t load server capabilities. %s', str(ex))
+            result['error'] = 'Can\'t load server capabilities. %s' % str(ex)
+            return result
+
+        # the number of existing messages is the sequence number of the latest message
+        logger.info('Fetch latest message from "%s".', folder)
+        last_message_number = int(select_info.get(b'EXISTS', 0))
+        if last_message_number < 1:
+            logger.info('No messages found in "%s".', folder)
+            result['success'] = True
+            return result
+
+        started_at = perf_counter()
+        fetch_result = client.fetch([last_message_number], ['ENVELOPE'])
+        timings['fetch'] = perf_counter() - started_at
+        if last_message_number not in fetch_result:
+            logger.error('No envelope data found for message nr %s in "%s".', last_message_number, folder)
+            result['error'] = 'No envelope data found for message nr %s.' % last_message_number
+            return result
+
+        message_info = ['Latest message in "%s":' % folder]
+
+        last_message_envelope: Envelope = fetch_result[last_message_number][b'ENVELOPE']
+
+        msg_date: datetime | None = get_envelope_date(last_message_envelope)
+        message_info.append('-> Date    : %s' % msg_date)
+
+        subject: str | None = get_envelope_subject(last_message_envelope)
+        message_info.append('-> Subject : %s' % subject)
+
+        from_address: Address | None = get_envelope_from_first(last_message_envelope)
+        message_info.append('-> From    : %s' % str(from_address))
+
+        sender_address: Address | None = get_envelope_sender_first(last_message_envelope)
+        message_info.append('-> Sender  : %s' % str(sender_address))
+
+        logger.info('\n'.join(message_info))
+
+        result['latest_message'] = {
+            'number': last_message_number,
+            'date': str(msg_date) if msg_date else None,
+            'subject': subject,
+            'from': str(from_address) if from_address else None,
+            'sender': str(sender_address) if sender_address else None,
+        }
+        result['success'] = True
+        return result
+
+    except Exception as ex:
+        logger.exception('Test failed. %s', str(ex))
+        result['error'] = 'Test failed. %s' % str(ex)
+        return result
+
+    finally:
+        if client:
+            result['traffic'] = client.get_traffic()
+            logger.info(
+                'Traffic: %s bytes sent, %s bytes received (%s / %s bytes of protocol data).',
+                result['traffic']['bytes_sent'],
+                result['traffic']['bytes_received'],
+                result['traffic']['data_sent'],
+                result['traffic']['data_received'],
+            )
+
+        connector.disconnect(client)
+
+        logger.info('Timings: %s', ', '.join(
+            '%s %.0f ms' % (phase, timings[phase] * 1000) for phase in PHASES if phase in timings
+        ))
+
 
 if __name__ == '__main__':
     root_logger = create_logger()
 
-    config = get_config(logger=root_logger)
+    parser = argparse.ArgumentParser(description='Test configured IMAP connections.')
+    parser.add_argument('config', help='path to the configuration file')
+    parser.add_argument('--parallel', type=int, default=10, help='number of concurrently tested sections')
+    parser.add_argument('--json', metavar='FILE', default=None, help='write results as JSON into a file')
+    args = parser.parse_args()
+
+    config = read_config(config_path=args.config, logger=root_logger)
     if not config:
-        exit(1)
+        sys.exit(1)
+
+    try:
+        setup_logging(config=config)
+    except Exception as ex:
+        root_logger.error('Invalid logging configuration. %s', str(ex))
+        sys.exit(1)
+
+    try:
+        inventory: Inventory = create_inventory(config=config, external=create_external_inventory(config=config))
+        sections = list(inventory.get_fingerprints().keys())
+    except Exception as ex:
+        root_logger.error('Can\'t load accounts. %s', str(ex))
+        sys.exit(1)
 
-    sections = config.sections()
     if not sections:
         root_logger.warning('No IMAP servers configured. Nothing to do.')
-        exit(0)
+        sys.exit(0)
+
+    def test_account(name: str) -> dict:
+        options = inventory.load(name)
+        return test_section(create_account_config(config, name, options if options else {}), name)
 
     root_logger.info('Testing %s configured IMAP connections...', len(sections))
-    for section in sections:
-        logger = create_logger(section)
+    started = perf_counter()
+    with ThreadPoolExecutor(max_workers=max(1, args.parallel)) as executor:
+        results = list(executor.map(test_account, sections))
 
-        try:
-            connector: ImapConnector = create_imap_connector(config=config, section=section)
-        except Exception as ex:
-            logger.exception('Invalid configuration. %s', str(ex))
-            continue
+    failed = [result['section'] for result in results if not result['success']]
+    root_logger.info(
+        'Tested %s IMAP connections in %.1f seconds, %s failed%s',
+        len(results), perf_counter() - started, len(failed), (': %s' % ', '.join(failed)) if failed else '.'
+    )
 
-        logger.info('Testing connection...')
-        client: IMAPClient | None = None
-        try:
-            folder = get_imap_folder(config=config, section=section)
-
-            try:
-                client = connector.connect(
-                    select_folder=folder,
-                    select_folder_readonly=True,
-                )
-            except Exception as ex:
-                logger.exception('Connection failed. %s', str(ex))
-                continue
-
-            logger.info('Connection successful.')
-
-            try:
-                capabilities = []
-                for cap in client.capabilities():
-                    capabilities.append(cap.decode('utf-8'))
-
-                logger.info('Capabilities: %s', ', '.join(sorted(capabilities)))
-            except Exception as ex:
-                logger.exception('Can\'t load server capabilities. %s', str(ex))
-                continue
-
-            logger.info('Fetch latest message from "%s".', folder)
-            message_numbers = client.search()
-            if len(message_numbers) < 1:
-                logger.info('No messages found in "%s".', folder)
-                continue
-
-            last_message_number = message_numbers[len(message_numbers) - 1]
-            result = client.fetch([last_message_number], ['ENVELOPE'])
-            if last_message_number not in result:
-                logger.error('No envelope data found for message nr %s in "%s".', last_message_number, folder)
-                continue
-
-            message_info = ['Latest message in "%s":' % folder]
-
-            last_message_envelope: Envelope = result[last_message_number][b'ENVELOPE']
-
-            msg_date: datetime | None = get_envelope_date(last_message_envelope)
-            message_info.append('-> Date    : %s' % msg_date)
-
-            subject: str | None = get_envelope_subject(last_message_envelope)
-            message_info.append('-> Subject : %s' % subject)
-
-            from_address: Address | None = get_envelope_from_first(last_message_envelope)
-            message_info.append('-> From    : %s' % str(from_address))
-
-            sender_address: Address | None = get_envelope_sender_first(last_message_envelope)
-            message_info.append('-> Sender  : %s' % str(sender_address))
-
-            logger.info('\n'.join(message_info))
-
-        finally:
-            # noinspection PyBroadException
-            try:
-                if client:
-                    client.logout()
-            except Exception:
-                pass
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+
+    sys.exit(1 if failed else 0)
@@ -14,14 +14,20 @@
 # limitations under the License.
 #
 
+import atexit
 import logging
 import sys
 from datetime import datetime
 from email.header import decode_header
+from email.parser import BytesHeaderParser
 from enum import Enum
+from logging.handlers import QueueListener
+from queue import Queue
 
 from imapclient.response_types import Address, Envelope
 
+from .log import NonBlockingQueueHandler, RepeatFilter, TextFormatter, JsonFormatter
+
 
 class Encryption(Enum):
     NONE = 'none'
@@ -36,31 +42,67 @@ class EncryptionCertificateCheck(Enum):
 
 
 __LOGGERS: dict[str, logging.Logger] = {}
+__LOG_LEVEL: list[int] = [logging.INFO]
+__LOG_QUEUE: Queue = Queue(maxsize=10000)
+__LOG_HANDLER: NonBlockingQueueHandler = NonBlockingQueueHandler(__LOG_QUEUE)
+__LOG_REPEAT_FILTER: list[RepeatFilter | None] = [None]
+__LOG_OUTPUT: logging.StreamHandler = logging.StreamHandler(stream=sys.stdout)
+__LOG_OUTPUT.setFormatter(TextFormatter())
+__LOG_LISTENER: QueueListener = QueueListener(__LOG_QUEUE, __LOG_OUTPUT)
+__LOG_LISTENER.start()
+atexit.register(__LOG_LISTENER.stop)
+
+
+def create_logger(name: str = 'app', level: int | None = None) -> logging.Logger:
+    """
+    Get a logger, that writes into the shared log queue.
+    Log records are written to stdout by a background thread.
 
+    :param name: logger name
+    :param level: log level or None, to use the level configured via configure_logging()
+    :return: logger
+    """
 
-def create_logger(name: str = 'app', level: int = logging.INFO) -> logging.Logger:
     if name in __LOGGERS:
         return __LOGGERS[name]
 
     logger: logging.Logger = logging.getLogger(name)
-    logger.setLevel(level)
-
-    # noinspection SpellCheckingInspection
-    logger_format = '[%(levelname)s] %(asctime)s | %(message)s' if name == 'app' \
-        else '[%(levelname)s:%(name)s] %(asctime)s | %(message)s'
-    formatter: logging.Formatter = logging.Formatter(
-        fmt=logger_format,
-        datefmt='%Y-%m-%d %H:%M:%S'
-    )
-
-    handler: logging.StreamHandler = logging.StreamHandler(stream=sys.stdout)
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
+    logger.setLevel(level if level is not None else __LOG_LEVEL[0])
+    logger.addHandler(__LOG_HANDLER)
 
     __LOGGERS[name] = logger
     return logger
 
 
+def configure_logging(
+        level: int = logging.INFO,
+        json_format: bool = False,
+        rate_limit: int = 0,
+        rate_limit_window: float = 60,
+):
+    """
+    Configure all loggers.
+
+    :param level: log level
+    :param json_format: write JSON lines instead of plain text
+    :param rate_limit: maximal number of similar messages per logger within the rate limit window (0 = unlimited)
+    :param rate_limit_window: number of seconds of the rate limit window
+    """
+
+    __LOG_LEVEL[0] = level
+    for logger in __LOGGERS.values():
+        logger.setLevel(level)
+
+    __LOG_OUTPUT.setFormatter(JsonFormatter() if json_format else TextFormatter())
+
+    if __LOG_REPEAT_FILTER[0]:
+        __LOG_HANDLER.removeFilter(__LOG_REPEAT_FILTER[0])
+        __LOG_REPEAT_FILTER[0] = None
+    if rate_limit > 0:
+        __LOG_REPEAT_FILTER[0] = RepeatFilter(max_messages=rate_limit, window=rate_limit_window)
+        __LOG_HANDLER.addFilter(__LOG_REPEAT_FILTER[0])
+
+
 def get_address_mail(address: Address, charset='utf-8') -> str | None:
     """
     Extracts mail address from an address.
@@ -289,6 +331,20 @@ def get_envelope_bcc_first(envelope: Envelope) -> Address | None:
     return values[0] if values and len(values) > 0 else None
 
 
+def get_header_fields(data: bytes) -> dict[str, str]:
+    """
+    Parse message headers, as returned for "BODY.PEEK[HEADER.FIELDS (...)]".
+
+    :param data: raw header lines
+    :return: decoded header values with lower case names, the first occurrence of a header is used
+    """
+
+    headers: dict[str, str] = {}
+    for name, value in BytesHeaderParser().parsebytes(data).items():
+        headers.setdefault(name.lower(), decode_rfc2047(str(value)).strip())
+    return headers
+
+
 def decode_rfc2047(header_value: str) -> str:
     """
     Returns the value of the RFC 2047 decoded header, or the header_value as-is if it's not encoded.
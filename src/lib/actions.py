@@ -0,0 +1,541 @@
+#
+# Copyright 2023 OpenIndex.de.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import json
+import logging
+from collections import OrderedDict
+from threading import Thread, Condition
+from time import monotonic
+
+from imapclient import IMAPClient, SEEN, FLAGGED, DELETED
+
+from . import root_logger, create_logger
+from .connector import ImapConnector
+
+
+class MailboxAction:
+    """
+    An action for a message, that was returned by a callback command.
+    """
+
+    __slots__ = ('kind', 'value')
+
+    ADD_FLAGS: str = 'add_flags'
+    """
+    Add flags to the message, the value contains the flags.
+    """
+
+    REMOVE_FLAGS: str = 'remove_flags'
+    """
+    Remove flags from the message, the value contains the flags.
+    """
+
+    MOVE: str = 'move'
+    """
+    Move the message to another folder, the value contains the folder.
+    """
+
+    def __init__(self, kind: str, value: tuple[bytes, ...] | str):
+        self.kind = kind
+        self.value = value
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, MailboxAction) and self.kind == other.kind and self.value == other.value
+
+    def __hash__(self) -> int:
+        return hash((self.kind, self.value))
+
+
+SHORTCUTS: dict[str, MailboxAction] = {
+    'seen': MailboxAction(MailboxAction.ADD_FLAGS, (SEEN,)),
+    'unseen': MailboxAction(MailboxAction.REMOVE_FLAGS, (SEEN,)),
+    'flag': MailboxAction(MailboxAction.ADD_FLAGS, (FLAGGED,)),
+    'unflag': MailboxAction(MailboxAction.REMOVE_FLAGS, (FLAGGED,)),
+}
+"""
+Actions, that don't require further parameters.
+"""
+
+
+def parse_action(value: dict) -> MailboxAction:
+    """
+    Parse an action object, e.g. {"action": "seen"}, {"action": "add_flags", "flags": ["$Done"]} or
+    {"action": "move", "folder": "Archive"}.
+
+    :param value: decoded JSON object
+    :return: action
+    """
+
+    name = str(value.get('action', '')).strip().lower()
+    if name in SHORTCUTS:
+        return SHORTCUTS[name]
+
+    if name in (MailboxAction.ADD_FLAGS, MailboxAction.REMOVE_FLAGS):
+        flags = value.get('flags')
+        if isinstance(flags, str):
+            flags = [flags]
+        if not flags or not all(isinstance(flag, str) and flag.strip() for flag in flags):
+            raise Exception('Action "%s" requires a list of flags.' % name)
+        return MailboxAction(name, tuple(sorted({flag.strip().encode('utf-8') for flag in flags})))
+
+    if name == MailboxAction.MOVE:
+        folder = value.get('folder')
+        if not isinstance(folder, str) or not folder.strip():
+            raise Exception('Action "%s" requires a folder.' % name)
+        return MailboxAction(name, folder.strip())
+
+    raise Exception('Unknown action "%s".' % name)
+
+
+def parse_actions(output: bytes, logger: logging.Logger = root_logger) -> tuple[list[MailboxAction], bytes]:
+    """
+    Extract actions from the output of a callback command. Each action is written as JSON object on a separate line.
+
+    :param output: output of the callback command
+    :param logger: logger for invalid actions
+    :return: parsed actions and the remaining output, that does not contain actions
+    """
+
+    actions: list[MailboxAction] = []
+    remaining: list[bytes] = []
+    for line in output.splitlines(keepends=True):
+        stripped = line.strip()
+        if not stripped.startswith(b'{'):
+            remaining.append(line)
+            continue
+
+        try:
+            value = json.loads(stripped)
+        except ValueError:
+            remaining.append(line)
+            continue
+        if not isinstance(value, dict) or 'action' not in value:
+            remaining.append(line)
+            continue
+
+        try:
+            action = parse_action(value)
+        except Exception as ex:
+            logger.warning('Ignore invalid action %s. %s', stripped.decode('utf-8', errors='replace'), str(ex))
+            continue
+        if action not in actions:
+            actions.append(action)
+
+    return actions, b''.join(remaining)
+
+
+class ActionRequest:
+    """
+    Actions for a single message.
+    """
+
+    __slots__ = ('name', 'connector', 'folder', 'uid', 'actions')
+
+    def __init__(
+            self,
+            name: str,
+            connector: ImapConnector,
+            folder: str,
+            uid: int,
+            actions: list[MailboxAction],
+    ):
+        self.name = name
+        self.connector = connector
+        self.folder = folder
+        self.uid = uid
+        self.actions = actions
+
+    @property
+    def account(self) -> tuple:
+        """
+        Requests for the same account share a connection.
+        """
+
+        return self.connector.host, self.connector.port, self.connector.username
+
+
+class PooledClient:
+    """
+    An open connection of the executor.
+    """
+
+    __slots__ = ('client', 'connector', 'folder', 'used_at')
+
+    def __init__(self, client: IMAPClient, connector: ImapConnector, folder: str):
+        self.client = client
+        self.connector = connector
+        self.folder = folder
+        self.used_at = monotonic()
+
+
+class MailboxActionExecutor:
+    """
+    Executes actions, that were returned by callback commands.
+
+    Actions are collected for a short delay and executed in batches. Actions of all messages in the same folder are
+    combined into a single UID STORE or UID MOVE command for each set of flags or target folder. Connections are kept
+    open for further batches and are closed after they were not used for a while.
+
+    Accounts are processed by a limited number of workers, each account by a single worker at a time. This way a slow
+    or unreachable account (waiting for connection timeouts) does not block actions of other accounts. If connections
+    are limited by a budget, connections are closed after each batch, as they would otherwise hold a connection, that
+    is needed for fetching new messages.
+    """
+
+    def __init__(self, delay: float = 1.0, idle_timeout: float = 60.0, max_queued: int = 10000, workers: int = 4):
+        if workers < 1:
+            raise Exception('At least one action worker is required.')
+
+        self.__delay = max(0.0, delay)
+        self.__idle_timeout = max(1.0, idle_timeout)
+        self.__max_queued = max(1, max_queued)
+        self.__workers = workers
+        self.__accounts: OrderedDict[tuple, list[ActionRequest]] = OrderedDict()
+        self.__due: dict[tuple, float] = {}
+        self.__busy: set[tuple] = set()
+        self.__queued = 0
+        self.__clients: dict[tuple, PooledClient] = {}
+        self.__condition = Condition()
+        self.__threads: list[Thread] = []
+        self.__stopped = False
+
+    def submit(self, request: ActionRequest) -> bool:
+        """
+        Queue actions for a message. This never blocks.
+
+        :param request: actions for a message
+        :return: False, if the queue is full or the executor was stopped
+        """
+
+        with self.__condition:
+            if self.__stopped or self.__queued >= self.__max_queued:
+                return False
+
+            # further actions of the same burst are collected until the account is due
+            if request.account not in self.__accounts:
+                self.__due[request.account] = monotonic() + self.__delay
+            self.__accounts.setdefault(request.account, []).append(request)
+            self.__queued += 1
+            self.__condition.notify()
+
+            # worker threads are started on demand
+            if len(self.__threads) < self.__workers:
+                thread = Thread(target=self.__work, name='actions-%s' % len(self.__threads), daemon=True)
+                self.__threads.append(thread)
+                thread.start()
+
+        return True
+
+    def stop(self):
+        """
+        Execute queued actions and close all connections.
+        """
+
+        with self.__condition:
+            self.__stopped = True
+            self.__condition.notify_all()
+            threads = list(self.__threads)
+        for thread in threads:
+            thread.join()
+
+    def get_usage(self) -> dict[str, int]:
+        """
+        Get the number of queued requests and open connections.
+
+        :return: number of queued requests and connections
+        """
+
+        with self.__condition:
+            return {
+                'queued': self.__queued,
+                'connections': len(self.__clients) + len(self.__busy),
+            }
+
+    def __next(self) -> tuple | None:
+        """
+        Take the account, that waits the longest, is due and is not processed by another worker.
+        Must be called while holding the lock.
+
+        :return: account or None, if no account can be processed
+        """
+
+        now = monotonic()
+        return next((
+            account for account in self.__accounts
+            if account not in self.__busy and (self.__stopped or self.__due[account] <= now)
+        ), None)
+
+    def __get_wait_time(self) -> float | None:
+        """
+        Get the number of seconds until the next account is due or until the next pooled connection is unused for the
+        idle timeout.
+        Must be called while holding the lock.
+
+        :return: number of seconds or None to wait for new requests
+        """
+
+        deadlines = [due for account, due in self.__due.items() if account not in self.__busy]
+        deadlines.extend(pooled.used_at + self.__idle_timeout for pooled in self.__clients.values())
+        return max(0.0, min(deadlines) - monotonic()) if deadlines else None
+
+    def __work(self):
+        """
+        Process queued requests.
+        """
+
+        while True:
+            with self.__condition:
+                account = self.__next()
+                while account is None and not (self.__stopped and not self.__accounts):
+                    timed_out = not self.__condition.wait(self.__get_wait_time())
+                    account = self.__next()
+                    if timed_out and account is None:
+                        # unused connections are closed after the timeout
+                        break
+
+                if account is not None:
+                    requests = self.__accounts.pop(account)
+                    del self.__due[account]
+                    self.__queued -= len(requests)
+                    self.__busy.add(account)
+                    pooled = self.__clients.pop(account, None)
+                stopped = self.__stopped and not self.__accounts
+
+            if account is not None:
+                try:
+                    pooled = self.__execute(account, requests, pooled)
+                except Exception as ex:
+                    root_logger.exception('Unexpected action error. %s', str(ex))
+                finally:
+                    with self.__condition:
+                        self.__busy.discard(account)
+                        if pooled:
+                            self.__clients[account] = pooled
+                        # requests of this account might wait for a worker
+                        self.__condition.notify_all()
+
+            self.__close_clients(idle_only=not stopped)
+            if stopped:
+                return
+
+    def __execute(
+            self,
+            account: tuple,
+            requests: list[ActionRequest],
+            pooled: PooledClient | None,
+    ) -> PooledClient | None:
+        """
+        Execute actions for all requested messages of an account, grouped by folder.
+
+        :param account: account of the requests
+        :param requests: queued requests of the account
+        :param pooled: pooled connection of the account
+        :return: connection, that is kept open for further batches
+        """
+
+        folders: dict[str, list[ActionRequest]] = {}
+        for request in requests:
+            folders.setdefault(request.folder, []).append(request)
+
+        for folder, batch in folders.items():
+            logger = create_logger(batch[0].name)
+            try:
+                pooled = self.__execute_with_retry(folder, batch, pooled, logger)
+            except Exception as ex:
+                pooled = None
+                logger.exception(
+                    'Can\'t execute actions for message UIDs %s. %s',
+                    ', '.join(str(request.uid) for request in batch),
+                    str(ex)
+                )
+
+        # connections within a budget are not kept open, as they might be needed for fetching new messages
+        if pooled and pooled.connector.budgeted:
+            pooled.connector.disconnect(pooled.client)
+            return None
+        return pooled
+
+    def __execute_with_retry(
+            self,
+            folder: str,
+            batch: list[ActionRequest],
+            pooled: PooledClient | None,
+            logger: logging.Logger,
+    ) -> PooledClient:
+        """
+        Execute actions on a pooled connection. If a pooled connection was closed by the server in the meantime,
+        the actions are executed again on a new connection.
+
+        :param folder: folder of the requests
+        :param batch: requests for the same account and folder
+        :param pooled: pooled connection of the account
+        :param logger: logger of the mailbox
+        :return: connection, that was used
+        """
+
+        reused = pooled is not None
+        pooled = self.__get_client(pooled, batch[0].connector, folder)
+        try:
+            self.__execute_folder(pooled.client, batch, logger)
+            pooled.used_at = monotonic()
+            return pooled
+        except Exception as ex:
+            pooled.connector.disconnect(pooled.client)
+            if not reused:
+                raise
+            logger.debug('Pooled connection failed, trying a new connection. %s', str(ex))
+
+        pooled = self.__get_client(None, batch[0].connector, folder)
+        try:
+            self.__execute_folder(pooled.client, batch, logger)
+        except Exception:
+            pooled.connector.disconnect(pooled.client)
+            raise
+        pooled.used_at = monotonic()
+        return pooled
+
+    @staticmethod
+    def __get_client(pooled: PooledClient | None, connector: ImapConnector, folder: str) -> PooledClient:
+        """
+        Get a connection of an account with a selected folder. Folders are selected for writing.
+
+        :param pooled: pooled connection of the account or None to connect
+        :param connector: connector of the account
+        :param folder: folder to select
+        :return: pooled connection
+        """
+
+        if pooled is None:
+            client = connector.connect(select_folder=folder, select_folder_readonly=False)
+            client.use_uid = True
+            return PooledClient(client, connector, folder)
+
+        if pooled.folder != folder:
+            try:
+                pooled.folder = ''
+                pooled.client.select_folder(folder, readonly=False)
+            except Exception:
+                pooled.connector.disconnect(pooled.client)
+                raise
+            pooled.folder = folder
+        return pooled
+
+    @staticmethod
+    def __execute_folder(client: IMAPClient, batch: list[ActionRequest], logger: logging.Logger):
+        """
+        Execute actions for messages of the selected folder. Flags are changed before messages are moved.
+
+        :param client: IMAP client with the folder selected
+        :param batch: requests for the same folder
+        :param logger: logger of the mailbox
+        """
+
+        add_flags: dict[tuple[bytes, ...], set[int]] = {}
+        remove_flags: dict[tuple[bytes, ...], set[int]] = {}
+        moves: dict[str, set[int]] = {}
+        moved: set[int] = set()
+
+        for request in batch:
+            for action in request.actions:
+                if action.kind == MailboxAction.ADD_FLAGS:
+                    add_flags.setdefault(action.value, set()).add(request.uid)
+                elif action.kind == MailboxAction.REMOVE_FLAGS:
+                    remove_flags.setdefault(action.value, set()).add(request.uid)
+                elif action.kind == MailboxAction.MOVE and request.uid not in moved:
+                    # a message can only be moved once
+                    moves.setdefault(action.value, set()).add(request.uid)
+                    moved.add(request.uid)
+
+        for flags, uids in add_flags.items():
+            client.add_flags(sorted(uids), flags, silent=True)
+        for flags, uids in remove_flags.items():
+            client.remove_flags(sorted(uids), flags, silent=True)
+
+        for folder, uids in moves.items():
+            if client.has_capability('MOVE'):
+                client.move(sorted(uids), folder)
+                continue
+
+            client.copy(sorted(uids), folder)
+            client.add_flags(sorted(uids), (DELETED,), silent=True)
+            if client.has_capability('UIDPLUS'):
+                client.expunge(sorted(uids))
+            else:
+                logger.warning('Server supports neither MOVE nor UIDPLUS, moved messages are marked as deleted.')
+
+        logger.info(
+            'Executed %s flag changes and %s moves for %s messages.',
+            len(add_flags) + len(remove_flags),
+            len(moves),
+            len({request.uid for request in batch})
+        )
+
+    def __close_clients(self, idle_only: bool = True):
+        """
+        Close pooled connections, that are not used by a worker.
+
+        :param idle_only: only close connections, that were not used within the idle timeout
+        """
+
+        now = monotonic()
+        with self.__condition:
+            closed = [
+                account for account, pooled in self.__clients.items()
+                if not idle_only or now - pooled.used_at >= self.__idle_timeout
+            ]
+            closed = [self.__clients.pop(account) for account in closed]
+
+        for pooled in closed:
+            pooled.connector.disconnect(pooled.client)
+
+
+class MailboxActions:
+    """
+    Submits actions, that were returned by the callback commands of a mailbox.
+    """
+
+    __slots__ = ('__name', '__connector', '__folder', '__executor', '__logger')
+
+    def __init__(self, name: str, connector: ImapConnector, folder: str, executor: MailboxActionExecutor):
+        self.__name = name.strip()
+        self.__connector = connector
+        self.__folder = folder
+        self.__executor = executor
+        self.__logger = create_logger(self.__name)
+
+    def submit(self, uid: int, output: bytes) -> bytes:
+        """
+        Submit the actions from the output of a callback command.
+
+        :param uid: UID of the message
+        :param output: output of the callback command
+        :return: remaining output, that does not contain actions
+        """
+
+        actions, remaining = parse_actions(output, self.__logger)
+        if not actions:
+            return remaining
+
+        queued = self.__executor.submit(ActionRequest(
+            name=self.__name,
+            connector=self.__connector,
+            folder=self.__folder,
+            uid=uid,
+            actions=actions,
+        ))
+        if not queued:
+            self.__logger.error('Action queue is full. Dropped actions for message UID %s.', uid)
+        return remaining
@@ -0,0 +1,322 @@
+#
+# Copyright 2023 OpenIndex.de.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import json
+import logging
+import os
+from enum import Enum
+from threading import Thread, Event, Lock
+from time import monotonic
+from typing import Callable
+
+from imapclient import IMAPClient
+
+from . import root_logger
+from .connector import ImapConnector
+from .spool import MessageSpooler
+
+
+class BackfillMode(Enum):
+    """
+    Whether a backfill runs only once or again on each application start.
+    """
+
+    ONCE = 'once'
+    STARTUP = 'startup'
+
+
+class BackfillProgress:
+    """
+    Remembers the progress of backfills, so that an interrupted backfill resumes where it stopped.
+
+    A single instance is shared by all mailboxes of the process. The progress is optionally written into a JSON file,
+    otherwise it is only kept until the application stops.
+    """
+
+    def __init__(self, file: str | None = None):
+        self.__file = file.strip() if file else None
+        self.__states: dict[str, dict] = {}
+        self.__lock = Lock()
+
+        if self.__file:
+            self.__load()
+
+    def get(self, name: str) -> dict | None:
+        """
+        Get the progress of a mailbox.
+
+        :param name: name of the mailbox section
+        :return: search criteria, UIDVALIDITY, last processed UID and whether the backfill is finished
+        or None, if no backfill was started yet
+        """
+
+        with self.__lock:
+            state = self.__states.get(name)
+            return dict(state) if state else None
+
+    def set(self, name: str, state: dict, save: bool = True):
+        """
+        Change the progress of a mailbox.
+
+        :param name: name of the mailbox section
+        :param state: search criteria, UIDVALIDITY, last processed UID and whether the backfill is finished
+        :param save: whether the persistence file is written immediately
+        """
+
+        with self.__lock:
+            self.__states[name] = dict(state)
+        if save:
+            self.save()
+
+    def save(self):
+        """
+        Write the progress of all mailboxes into the persistence file, if configured.
+        """
+
+        if not self.__file:
+            return
+
+        with self.__lock:
+            data = json.dumps(self.__states)
+            tmp_file = '%s.%s.tmp' % (self.__file, os.getpid())
+            try:
+                with open(tmp_file, 'w', encoding='utf-8') as f:
+                    f.write(data)
+                os.replace(tmp_file, self.__file)
+            except Exception as ex:
+                root_logger.warning('Can\'t write backfill file "%s". %s', self.__file, str(ex))
+
+    def __load(self):
+        """
+        Read the progress of all mailboxes from the persistence file.
+        """
+
+        if not os.path.isfile(self.__file):
+            return
+
+        try:
+            with open(self.__file, 'r', encoding='utf-8') as f:
+                data: dict = json.load(f)
+        except Exception as ex:
+            root_logger.warning('Can\'t read backfill file "%s". %s', self.__file, str(ex))
+            return
+
+        self.__states = {name: state for name, state in data.items() if isinstance(state, dict)}
+
+
+class MessageBackfill:
+    """
+    Triggers callbacks for messages, that already existed in a mailbox (e.g. all unseen messages).
+
+    The backfill runs within a separate thread and connection, while the IDLE connection of the mailbox keeps running.
+    Matching UIDs are searched once, envelopes are fetched in chunks with pipelined commands and the callbacks are
+    triggered at a limited rate, in order to not flood the callback commands.
+    """
+
+    __slots__ = (
+        '__name',
+        '__connector',
+        '__folder',
+        '__criteria',
+        '__mode',
+        '__progress',
+        '__chunk_size',
+        '__pipeline',
+        '__rate',
+        '__spooler',
+        '__thread',
+        '__thread_stopped',
+    )
+
+    SECONDS_TO_WAIT_AFTER_ERROR: int = 60
+    """
+    Number of seconds to wait after the backfill failed, before it is resumed.
+    """
+
+    def __init__(
+            self,
+            name: str,
+            connector: ImapConnector,
+            criteria: str = 'UNSEEN',
+            folder: str = 'INBOX',
+            mode: BackfillMode = BackfillMode.ONCE,
+            progress: BackfillProgress | None = None,
+            chunk_size: int = 100,
+            pipeline: int = 4,
+            rate: float = 10,
+            spooler: MessageSpooler | None = None,
+    ):
+        self.__name = name.strip()
+        self.__connector = connector
+        self.__folder = folder.strip()
+        self.__criteria = criteria.strip()
+        self.__mode = BackfillMode(mode.strip().lower()) if isinstance(mode, str) else mode
+        self.__progress = progress or BackfillProgress()
+        self.__chunk_size = max(1, chunk_size)
+        self.__pipeline = max(1, pipeline)
+        self.__rate = max(0.0, rate)
+        self.__spooler = spooler
+        self.__thread: Thread | None = None
+        self.__thread_stopped = Event()
+
+    def start(
+            self,
+            items: list[str],
+            deliver: Callable[[dict, int, dict[str, str]], None],
+            logger: logging.Logger = root_logger,
+    ):
+        """
+        Start the backfill thread.
+
+        :param items: items to fetch for each message
+        :param deliver: function, that triggers the callback for fetched message data, its UID and spooled files
+        :param logger: logger of the mailbox
+        """
+
+        if self.__thread is not None:
+            return
+
+        # progress of a finished backfill is restarted on each application start, if configured
+        state = self.__progress.get(self.__name)
+        if self.__mode == BackfillMode.STARTUP and state and state.get('finished'):
+            self.__progress.set(self.__name, {**state, 'uid': 0, 'finished': False})
+
+        self.__thread = Thread(
+            target=self.__run,
+            args=(items, deliver, logger),
+            name='%s-backfill' % self.__name,
+            daemon=True,
+        )
+        self.__thread.start()
+
+    def stop(self):
+        """
+        Stop the backfill thread.
+        """
+
+        self.__thread_stopped.set()
+
+    def join(self, timeout: float | None = None):
+        """
+        Join the backfill thread.
+
+        :param timeout: maximal number of seconds to wait or None to wait infinitely
+        """
+
+        if self.__thread:
+            self.__thread.join(timeout=timeout)
+
+    def __run(self, items: list[str], deliver: Callable, logger: logging.Logger):
+        """
+        Run the backfill until it is finished or stopped, failed backfills are resumed.
+
+        :param items: items to fetch for each message
+        :param deliver: function, that triggers the callback for fetched message data
+        :param logger: logger of the mailbox
+        """
+
+        while not self.__thread_stopped.is_set():
+            try:
+                self.__backfill(items, deliver, logger)
+                return
+            except Exception as ex:
+                logger.exception('Backfill failed. %s', str(ex))
+                self.__thread_stopped.wait(self.SECONDS_TO_WAIT_AFTER_ERROR)
+
+    def __backfill(self, items: list[str], deliver: Callable, logger: logging.Logger):
+        """
+        Search matching messages and trigger callbacks for messages, that were not processed yet.
+
+        :param items: items to fetch for each message
+        :param deliver: function, that triggers the callback for fetched message data
+        :param logger: logger of the mailbox
+        """
+
+        client = None
+        try:
+            # the connection is held for the whole backfill, so it must not take the connection reserved for fetching
+            client = self.__connector.connect(long_lived=True)
+            client.use_uid = True
+            response = client.select_folder(self.__folder, readonly=True)
+            uid_validity = response.get(b'UIDVALIDITY')
+
+            # the progress is only resumed for the same search in the same folder
+            state = self.__progress.get(self.__name)
+            if not state or state.get('criteria') != self.__criteria or state.get('uidvalidity') != uid_validity:
+                state = {'criteria': self.__criteria, 'uidvalidity': uid_validity, 'uid': 0, 'finished': False}
+            if state.get('finished'):
+                logger.debug('Backfill is already finished.')
+                return
+
+            last_uid = int(state.get('uid') or 0)
+            uids = sorted(uid for uid in client.search(self.__criteria) if uid > last_uid)
+            logger.info('Backfill %s messages.', len(uids))
+
+            chunks = [uids[i:i + self.__chunk_size] for i in range(0, len(uids), self.__chunk_size)]
+            windows = [chunks[i:i + self.__pipeline] for i in range(0, len(chunks), self.__pipeline)]
+            next_delivery = monotonic()
+            try:
+                for window in windows:
+                    result = client.fetch_pipelined(window, items)
+                    for uid in (uid for chunk in window for uid in chunk):
+                        if self.__thread_stopped.is_set():
+                            logger.info('Backfill stopped at UID %s.', state['uid'])
+                            return
+
+                        # limit the rate of triggered callbacks
+                        if self.__rate > 0:
+                            delay = next_delivery - monotonic()
+                            if delay > 0 and self.__thread_stopped.wait(delay):
+                                continue
+                            next_delivery = max(next_delivery, monotonic()) + 1.0 / self.__rate
+
+                        message_result = result.get(uid)
+                        if message_result is not None:
+                            files = self.__spool(client, uid, message_result, logger)
+                            try:
+                                deliver(message_result, uid, files)
+                            except Exception as ex:
+                                logger.exception('Callback failed. %s', str(ex))
+                        state['uid'] = uid
+
+                    self.__progress.set(self.__name, state)
+
+                state['finished'] = True
+                logger.info('Backfill finished.')
+            finally:
+                self.__progress.set(self.__name, state)
+
+        finally:
+            self.__connector.disconnect(client)
+
+    def __spool(self, client: IMAPClient, uid: int, message_result: dict, logger: logging.Logger) -> dict[str, str]:
+        """
+        Write the content of a message into files, if spooling is enabled.
+
+        :param client: IMAP client with the folder selected
+        :param uid: UID of the message
+        :param message_result: fetched data of the message
+        :param logger: logger of the mailbox
+        :return: paths of spooled files
+        """
+
+        if not self.__spooler:
+            return {}
+        try:
+            return self.__spooler.spool(client, uid, logger, message_result)
+        except Exception as ex:
+            logger.exception('Spooling message UID %s failed. %s', uid, str(ex))
+            return {}
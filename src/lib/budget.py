@@ -0,0 +1,184 @@
+#
+# Copyright 2023 OpenIndex.de.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+from collections import deque
+from threading import Condition
+from time import monotonic
+
+
+class ConnectionLease:
+    """
+    Permission to hold an open connection for a certain host and user.
+    """
+
+    __slots__ = ('host', 'username', 'long_lived', 'granted', 'released')
+
+    def __init__(self, host: str, username: str, long_lived: bool = False):
+        self.host = host
+        self.username = username
+        self.long_lived = long_lived
+        self.granted = False
+        self.released = False
+
+
+class ConnectionBudget:
+    """
+    Limits the number of concurrently open IMAP connections for each host and for each user on a host.
+
+    Callers, that exceed the budget, are queued and served in order of their requests. A caller, that is blocked by
+    the limit of its user, doesn't block callers of other users on the same host.
+
+    Long-lived connections (IDLE connections and backfills) may use all but one connection of each limit. The remaining
+    connection is reserved for short-lived connections (e.g. fetching a new message), so that they are not blocked by
+    long-lived connections.
+    """
+
+    def __init__(
+            self,
+            max_connections_per_host: int = 0,
+            max_connections_per_user: int = 0,
+    ):
+        if max_connections_per_host == 1 or max_connections_per_user == 1:
+            raise Exception('At least 2 connections are required per host and per user, '
+                            'one of them is reserved for fetching messages.')
+
+        self.__max_per_host = max_connections_per_host
+        self.__max_per_user = max_connections_per_user
+        self.__host_usage: dict[str, int] = {}
+        self.__user_usage: dict[tuple[str, str], int] = {}
+        self.__host_long_lived_usage: dict[str, int] = {}
+        self.__user_long_lived_usage: dict[tuple[str, str], int] = {}
+        self.__waiting: deque[ConnectionLease] = deque()
+        self.__condition = Condition()
+
+    def acquire(
+            self,
+            host: str,
+            username: str | None,
+            timeout: float | None = None,
+            long_lived: bool = False,
+    ) -> ConnectionLease | None:
+        """
+        Wait until a connection for a host and user is available within the budget.
+
+        :param host: IMAP host
+        :param username: IMAP user
+        :param timeout: maximal number of seconds to wait or None to wait infinitely
+        :param long_lived: whether the connection is held for a long time (e.g. IDLE), these can't use the last
+        connection of a limit
+        :return: lease or None, if the timeout was reached
+        """
+
+        lease = ConnectionLease(host=host.lower(), username=username.lower() if username else '', long_lived=long_lived)
+        deadline = monotonic() + timeout if timeout is not None else None
+
+        with self.__condition:
+            self.__waiting.append(lease)
+            self.__grant()
+
+            while not lease.granted:
+                remaining = deadline - monotonic() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    self.__waiting.remove(lease)
+                    return None
+                self.__condition.wait(timeout=remaining)
+
+            return lease
+
+    def release(self, lease: ConnectionLease | None):
+        """
+        Give back a lease after the connection was closed.
+
+        :param lease: lease returned by acquire()
+        """
+
+        if lease is None:
+            return
+
+        with self.__condition:
+            if lease.released or not lease.granted:
+                return
+
+            lease.released = True
+            user = (lease.host, lease.username)
+            self.__decrement(self.__host_usage, lease.host)
+            self.__decrement(self.__user_usage, user)
+            if lease.long_lived:
+                self.__decrement(self.__host_long_lived_usage, lease.host)
+                self.__decrement(self.__user_long_lived_usage, user)
+
+            self.__grant()
+
+    def get_usage(self) -> dict:
+        """
+        Get currently open and waiting connections.
+
+        :return: open connections per host and per user as well as the number of waiting callers
+        """
+
+        with self.__condition:
+            return {
+                'hosts': {**self.__host_usage},
+                'users': {'%s@%s' % (username, host): count for (host, username), count in self.__user_usage.items()},
+                'waiting': len(self.__waiting),
+            }
+
+    def __grant(self):
+        """
+        Grant leases to waiting callers in order of their requests, as long as the budget allows it.
+        Must be called while holding the lock.
+        """
+
+        granted = False
+        for lease in list(self.__waiting):
+            user = (lease.host, lease.username)
+            host_usage = self.__host_usage.get(lease.host, 0)
+            user_usage = self.__user_usage.get(user, 0)
+
+            if 0 < self.__max_per_host <= host_usage:
+                continue
+            if 0 < self.__max_per_user <= user_usage:
+                continue
+            if lease.long_lived:
+                if 0 < self.__max_per_host - 1 <= self.__host_long_lived_usage.get(lease.host, 0):
+                    continue
+                if 0 < self.__max_per_user - 1 <= self.__user_long_lived_usage.get(user, 0):
+                    continue
+                self.__host_long_lived_usage[lease.host] = self.__host_long_lived_usage.get(lease.host, 0) + 1
+                self.__user_long_lived_usage[user] = self.__user_long_lived_usage.get(user, 0) + 1
+
+            self.__waiting.remove(lease)
+            self.__host_usage[lease.host] = host_usage + 1
+            self.__user_usage[user] = user_usage + 1
+            lease.granted = True
+            granted = True
+
+        if granted:
+            self.__condition.notify_all()
+
+    @staticmethod
+    def __decrement(usage: dict, key):
+        """
+        Decrement a usage counter and remove it, if it reaches zero.
+        Must be called while holding the lock.
+
+        :param usage: usage counters
+        :param key: key of the counter
+        """
+
+        usage[key] -= 1
+        if usage[key] < 1:
+            del usage[key]
@@ -15,22 +15,46 @@
 #
 
 import subprocess
-from datetime import datetime
+import sys
+import tempfile
 from os import getcwd
-from threading import Thread
+from threading import Thread, Event
+from typing import Callable
 
-from imapclient.response_types import Envelope, Address
+from . import create_logger
+from .actions import MailboxActions
+from .dedup import MessageDeduplicator
+from .event import MessageEvent
+from .journal import EventJournal
+from .priority import Priority, PriorityRules, CallbackDispatcher
+from .publisher import EventPublisher
+from .spawner import parse_command, get_process_reaper
+from .spool import remove_files
 
-from . import get_envelope_message_id, \
-    get_envelope_in_reply_to, \
-    get_envelope_date, \
-    get_envelope_subject, \
-    get_envelope_from_first, \
-    get_envelope_sender_first, \
-    get_envelope_to_first, \
-    get_address_name, \
-    get_address_mail, \
-    create_logger
+
+def forward_output(output: bytes):
+    """
+    Write captured output of a callback command to the standard output, as if it was not captured.
+
+    :param output: captured output
+    """
+
+    if output:
+        sys.stdout.buffer.write(output)
+        sys.stdout.buffer.flush()
+
+
+class CallbackCommand:
+    """
+    A configured callback command.
+    """
+
+    __slots__ = ('command', 'argv')
+
+    def __init__(self, command: str, use_shell: bool = True):
+        self.command = sys.intern(command)
+        # without a shell the command line is split only once
+        self.argv = parse_command(command) if not use_shell else None
 
 
 class CallbackHandler:
@@ -38,67 +62,317 @@ class CallbackHandler:
     Runs an IMAP IDLE callback operations in a separate thread.
     """
 
+    __slots__ = (
+        '__name',
+        '__on_new_message',
+        '__on_message_flags_changed',
+        '__on_message_expunged',
+        '__additional_env',
+        '__deduplicator',
+        '__priority_rules',
+        '__dispatcher',
+        '__actions',
+        '__publisher',
+        '__journal',
+        '__logger',
+    )
+
+    MAX_OUTPUT_SIZE: int = 65536
+    """
+    Maximum number of bytes, that are read from the output of a callback command, in order to find actions.
+    """
+
     def __init__(
             self,
             name: str,
             on_new_message: str | None = None,
             additional_env: dict | None = None,
+            deduplicator: MessageDeduplicator | None = None,
+            use_shell: bool = True,
+            priority_rules: PriorityRules | None = None,
+            dispatcher: CallbackDispatcher | None = None,
+            on_message_flags_changed: str | None = None,
+            on_message_expunged: str | None = None,
+            actions: MailboxActions | None = None,
+            publisher: EventPublisher | None = None,
+            journal: EventJournal | None = None,
     ):
         self.__name = name.strip()
-        self.__on_new_message = on_new_message
+        self.__on_new_message = CallbackCommand(on_new_message, use_shell) if on_new_message else None
+        self.__on_message_flags_changed = CallbackCommand(on_message_flags_changed, use_shell) \
+            if on_message_flags_changed else None
+        self.__on_message_expunged = CallbackCommand(on_message_expunged, use_shell) \
+            if on_message_expunged else None
         self.__additional_env = {**additional_env} if additional_env else {}
+        self.__deduplicator = deduplicator
+        self.__priority_rules = priority_rules
+        self.__dispatcher = dispatcher
+        self.__actions = actions
+        self.__publisher = publisher
+        self.__journal = journal
+        self.__logger = create_logger(self.__name)
 
-    def trigger_new_message_command(self, envelope: Envelope):
-        if not self.__on_new_message:
-            raise Exception('No command for new message configured.')
+    @property
+    def headers(self) -> tuple[str, ...]:
+        """
+        Message headers, that are required in addition to the envelope.
+        """
+
+        return PriorityRules.HEADERS if self.__priority_rules and self.__priority_rules.use_headers else ()
+
+    @property
+    def has_new_message_command(self) -> bool:
+        """
+        Whether new messages are processed by a command or by the event publisher.
+        """
+
+        return self.__on_new_message is not None or self.__publisher is not None
 
-        msg_id: str | None = get_envelope_message_id(envelope)
-        msg_reply_to_id: str | None = get_envelope_in_reply_to(envelope)
-        msg_date: datetime | None = get_envelope_date(envelope)
-        msg_subject: str | None = get_envelope_subject(envelope)
+    @property
+    def has_message_change_commands(self) -> bool:
+        """
+        Whether commands for flag changes or expunged messages are configured.
+        These require a map of sequence numbers to UIDs.
+        """
 
-        msg_from: Address | None = get_envelope_from_first(envelope)
-        msg_from_name = get_address_name(msg_from) if msg_from and msg_from.name else ''
-        msg_from_mail = get_address_mail(msg_from) if msg_from and msg_from.host and msg_from.mailbox else ''
+        return self.__on_message_flags_changed is not None or self.__on_message_expunged is not None
 
-        msg_sender: Address | None = get_envelope_sender_first(envelope)
-        msg_sender_name = get_address_name(msg_sender) if msg_sender and msg_sender.name else ''
-        msg_sender_mail = get_address_mail(msg_sender) if msg_sender and msg_sender.host and msg_sender.mailbox else ''
+    def trigger_message_flags_changed_command(self, uid: int | None, sequence_number: int, flags: tuple):
+        """
+        Run the command for changed message flags.
 
-        msg_to: Address | None = get_envelope_to_first(envelope)
-        msg_to_name = get_address_name(msg_to) if msg_to and msg_to.name else ''
-        msg_to_mail = get_address_mail(msg_to) if msg_to and msg_to.host and msg_to.mailbox else ''
+        :param uid: UID of the message or None, if not known
+        :param sequence_number: sequence number of the message
+        :param flags: current flags of the message
+        """
 
-        msg_author = msg_from if msg_from else msg_sender
-        msg_author_name = get_address_name(msg_author) if msg_author and msg_author.name else ''
-        msg_author_mail = get_address_mail(msg_author) if msg_author and msg_author.host and msg_author.mailbox else ''
+        if not self.__on_message_flags_changed:
+            return
 
-        environment = {
+        self.__launch(self.__on_message_flags_changed, Priority.NORMAL, {
             **self.__additional_env,
-            'MESSAGE_ID': str(msg_id) if msg_id else '',
-            'MESSAGE_REPLY_TO_ID': str(msg_reply_to_id) if msg_reply_to_id else '',
-            'MESSAGE_DATE': str(msg_date) if msg_date else '',
-            'MESSAGE_SUBJECT': msg_subject.strip() if msg_subject else '',
-            'MESSAGE_AUTHOR': str(msg_author) if msg_author else '',
-            'MESSAGE_AUTHOR_NAME': msg_author_name,
-            'MESSAGE_AUTHOR_MAIL': msg_author_mail,
-            'MESSAGE_FROM': str(msg_from) if msg_from else '',
-            'MESSAGE_FROM_NAME': msg_from_name,
-            'MESSAGE_FROM_MAIL': msg_from_mail,
-            'MESSAGE_SENDER': str(msg_sender) if msg_sender else '',
-            'MESSAGE_SENDER_NAME': msg_sender_name,
-            'MESSAGE_SENDER_MAIL': msg_sender_mail,
-            'MESSAGE_TO': str(msg_to) if msg_to else '',
-            'MESSAGE_TO_NAME': msg_to_name,
-            'MESSAGE_TO_MAIL': msg_to_mail,
-        }
+            'MESSAGE_UID': str(uid) if uid else '',
+            'MESSAGE_SEQUENCE_NUMBER': str(sequence_number),
+            'MESSAGE_FLAGS': ' '.join(
+                flag.decode('utf-8', errors='replace') if isinstance(flag, bytes) else str(flag) for flag in flags
+            ),
+        })
+
+    def trigger_message_expunged_command(self, uid: int | None, sequence_number: int):
+        """
+        Run the command for a removed message.
+
+        :param uid: UID of the message or None, if not known
+        :param sequence_number: sequence number of the message before it was removed
+        """
+
+        if not self.__on_message_expunged:
+            return
+
+        self.__launch(self.__on_message_expunged, Priority.NORMAL, {
+            **self.__additional_env,
+            'MESSAGE_UID': str(uid) if uid else '',
+            'MESSAGE_SEQUENCE_NUMBER': str(sequence_number),
+        })
+
+    def trigger_new_message_command(
+            self,
+            event: MessageEvent,
+            headers: dict[str, str] | None = None,
+            files: dict[str, str] | None = None,
+    ):
+        """
+        Run the command for a new message and send the event to subscribers of the event publisher.
+
+        :param event: new message
+        :param headers: additional message headers
+        :param files: paths of spooled files by environment variable, these are removed after the command finished
+        """
+
+        if not self.__on_new_message and not self.__publisher:
+            raise Exception('No command for new message configured.')
+
+        # skip messages, that were already processed by any other handler
+        if self.__deduplicator:
+            key = self.__deduplicator.get_key(
+                message_id=event.message_id,
+                date=event.date,
+                author=event.author_mail,
+                subject=event.subject,
+            )
+            if self.__deduplicator.is_duplicate(key):
+                self.__logger.info(
+                    'Ignore duplicate message %s.', event.message_id if event.message_id else '(without Message-Id)'
+                )
+                remove_files(files)
+                return
+
+        if self.__journal:
+            self.__journal.record(event)
+        if self.__publisher:
+            self.__publisher.publish(event)
+        if not self.__on_new_message:
+            remove_files(files)
+            return
+
+        # environment variables of the event are rendered only once and shared by all handlers
+        environment = {**self.__additional_env, **event.get_environment()} if self.__additional_env \
+            else event.get_environment()
+        if files:
+            environment = {**environment, **files}
+
+        priority = self.__priority_rules.get_priority(event.author_mail, headers) \
+            if self.__priority_rules else Priority.NORMAL
+        self.__launch(
+            self.__on_new_message, priority, environment,
+            on_output=self.__get_output_handler(event.uid),
+            on_finished=(lambda: remove_files(files)) if files else None,
+        )
+
+    def __get_output_handler(self, uid: int | None) -> Callable[[bytes], None] | None:
+        """
+        Get a handler for the output of a new message command, if the command might return actions.
+
+        :param uid: UID of the message or None, if not known
+        :return: output handler or None, if the output is not captured
+        """
+
+        if not self.__actions or not uid:
+            return None
+
+        def process_output(output: bytes):
+            forward_output(self.__actions.submit(uid, output))
+
+        return process_output
+
+    def __launch(
+            self,
+            command: CallbackCommand,
+            priority: Priority,
+            environment: dict,
+            on_output: Callable[[bytes], None] | None = None,
+            on_finished: Callable[[], None] | None = None,
+    ):
+        """
+        Launch a callback command immediately or queue it, if a dispatcher is used.
+
+        :param command: callback command
+        :param priority: priority lane, if a dispatcher is used
+        :param environment: environment variables
+        :param on_output: called with the output, after the command finished successfully
+        :param on_finished: called after the command finished or failed to launch
+        """
+
+        if self.__dispatcher:
+            self.__dispatcher.submit(
+                name=self.__name,
+                priority=priority,
+                run=lambda: self.__run(command, environment, on_output, on_finished),
+                on_dropped=on_finished,
+            )
+            return
+
+        if command.argv:
+            launched = self.__spawn(
+                command, environment,
+                on_exit=(lambda exit_code: on_finished()) if on_finished else None,
+                on_output=on_output,
+            )
+            if not launched and on_finished:
+                on_finished()
+            return
 
         CallbackThread(
             name=self.__name,
-            command=self.__on_new_message,
+            command=command.command,
             environment=environment,
+            on_output=on_output,
+            on_finished=on_finished,
         ).start()
 
+    def __run(
+            self,
+            command: CallbackCommand,
+            environment: dict,
+            on_output: Callable[[bytes], None] | None = None,
+            on_finished: Callable[[], None] | None = None,
+    ):
+        """
+        Run the callback command and wait until it finished.
+
+        :param command: callback command
+        :param environment: environment variables
+        :param on_output: called with the output, after the command finished successfully
+        :param on_finished: called after the command finished or failed to launch
+        """
+
+        if not command.argv:
+            CallbackThread(
+                name=self.__name,
+                command=command.command,
+                environment=environment,
+                on_output=on_output,
+                on_finished=on_finished,
+            ).run()
+            return
+
+        finished = Event()
+        try:
+            if self.__spawn(command, environment, on_exit=lambda exit_code: finished.set(), on_output=on_output):
+                finished.wait()
+        finally:
+            if on_finished:
+                on_finished()
+
+    def __spawn(
+            self,
+            command: CallbackCommand,
+            environment: dict,
+            on_exit: Callable[[int], None] | None = None,
+            on_output: Callable[[bytes], None] | None = None,
+    ) -> bool:
+        """
+        Launch a command directly, without a shell and without a separate thread.
+        The exit code is collected by the process wide reaper.
+
+        :param command: callback command
+        :param environment: environment variables
+        :param on_exit: called with the exit code, after the command finished
+        :param on_output: called with the output, after the command finished successfully
+        :return: True, if the command was launched
+        """
+
+        # the output is written to an anonymous temporary file, that is read after the command finished
+        output = tempfile.TemporaryFile() if on_output else None
+
+        def exited(exit_code: int):
+            try:
+                output.seek(0)
+                if exit_code == 0:
+                    on_output(output.read(self.MAX_OUTPUT_SIZE))
+                else:
+                    forward_output(output.read(self.MAX_OUTPUT_SIZE))
+            finally:
+                output.close()
+                if on_exit:
+                    on_exit(exit_code)
+
+        try:
+            self.__logger.debug('Launching "%s" from working directory "%s"...', command.command, getcwd())
+            get_process_reaper().spawn(
+                argv=command.argv,
+                environment=environment,
+                logger=self.__logger,
+                on_exit=exited if output else on_exit,
+                stdout=output.fileno() if output else None,
+            )
+            return True
+        except Exception as ex:
+            if output:
+                output.close()
+            self.__logger.exception('Unexpected callback error. %s', str(ex))
+            return False
+
 
 class CallbackThread:
     """
@@ -110,19 +384,25 @@ class CallbackThread:
             name: str,
             command: str,
             environment: dict,
+            on_output: Callable[[bytes], None] | None = None,
+            on_finished: Callable[[], None] | None = None,
     ):
         self.__name = name.strip()
         self.__command = command
-        self.__environment = {**environment}
+        self.__environment = environment
+        self.__on_output = on_output
+        self.__on_finished = on_finished
         self.__thread = Thread(target=self.__run)
         self.__logger = create_logger(self.__name)
 
         # make sure, that environment dict does not contain None values
-        # as it might lead to errors on execution
-        for key, value in self.__environment.items():
-            if value is None:
-                self.__logger.warning('Environment variable "%s" has None value.', key)
-                self.__environment[key] = ''
+        # as it might lead to errors on execution, the dict is only copied if required
+        if None in environment.values():
+            self.__environment = {**environment}
+            for key, value in environment.items():
+                if value is None:
+                    self.__logger.warning('Environment variable "%s" has None value.', key)
+                    self.__environment[key] = ''
 
     def start(self):
         """
@@ -131,6 +411,13 @@ class CallbackThread:
 
         self.__thread.start()
 
+    def run(self):
+        """
+        Run the command within the current thread.
+        """
+
+        self.__run()
+
     def join(self):
         """
         Join the thread.
@@ -144,16 +431,18 @@ class CallbackThread:
         """
 
         try:
-            self.__logger.info('Running "%s" from working directory "%s"...', self.__command, getcwd())
+            self.__logger.debug('Running "%s" from working directory "%s"...', self.__command, getcwd())
 
             result: subprocess.CompletedProcess = subprocess.run(
                 self.__command,
                 shell=True,
                 env=self.__environment,
-                cwd=getcwd()
+                cwd=getcwd(),
+                stdout=subprocess.PIPE if self.__on_output else None,
             )
 
             if result.returncode != 0:
+                forward_output(result.stdout)
                 self.__logger.warning(
                     'Callback script "%s" returned non-zero exit code (%s)!',
                     self.__command,
@@ -161,5 +450,12 @@ class CallbackThread:
                 )
                 return
 
+            if self.__on_output:
+                self.__on_output(result.stdout[:CallbackHandler.MAX_OUTPUT_SIZE])
+
         except Exception as ex:
             self.__logger.exception('Unexpected callback error. %s', str(ex))
+
+        finally:
+            if self.__on_finished:
+                self.__on_finished()
@@ -0,0 +1,407 @@
+#
+# Copyright 2023 OpenIndex.de.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import imaplib
+import select
+import socket
+import ssl
+import zlib
+from threading import Lock
+from time import monotonic
+from typing import Callable
+
+from imapclient import IMAPClient
+from imapclient.imapclient import join_message_ids, seq_to_parenstr_upper
+from imapclient.response_parser import parse_fetch_response
+
+
+class SocketIMAP4(imaplib.IMAP4):
+    """
+    IMAP4 protocol implementation on top of an already connected socket.
+
+    Optionally the stream is compressed according to RFC 4978 (COMPRESS=DEFLATE). Sent and received bytes are counted
+    on the IMAP stream (compressed, if compression is enabled) and as plain protocol data.
+
+    IMAPClient.idle_check() swallows socket errors and the end of stream. Therefore, a closed or broken connection is
+    remembered here, so that it can be noticed by the caller.
+    """
+
+    READ_SIZE: int = 65536
+    """
+    Maximal number of bytes read from the socket at once, if compression is enabled.
+    """
+
+    def __init__(self, host: str, port: int, create_socket: Callable[[], socket.socket]):
+        self.__create_socket = create_socket
+        self.__compressor = None
+        self.__decompressor = None
+        self.__buffer = bytearray()
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.data_sent = 0
+        self.data_received = 0
+        self.received_at = monotonic()
+        self.connection_lost = False
+        imaplib.IMAP4.__init__(self, host, port)
+
+    @property
+    def compressed(self) -> bool:
+        return self.__compressor is not None
+
+    def open(self, host: str = '', port: int = imaplib.IMAP4_PORT, timeout: float | None = None):
+        self.host = host
+        self.port = port
+        self.sock = self.__create_socket()
+        self.file = self.sock.makefile('rb')
+
+    def start_compression(self):
+        """
+        Compress the stream from now on.
+        This must be called directly after the server accepted the COMPRESS command.
+        """
+
+        self.__compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        self.__decompressor = zlib.decompressobj(-15)
+
+        # the server might have sent compressed data, that was already buffered by the file object
+        timeout = self.sock.gettimeout()
+        self.sock.setblocking(False)
+        try:
+            self.__decompress(self.file.read1(self.READ_SIZE) or b'')
+        except (BlockingIOError, ssl.SSLWantReadError):
+            pass
+        finally:
+            self.sock.settimeout(timeout)
+
+    def read(self, size: int) -> bytes:
+        if not self.__decompressor:
+            try:
+                data = self.file.read(size)
+            except OSError as ex:
+                self.__failed(ex)
+                raise
+            self.__received(data)
+            self.bytes_received += len(data)
+            self.data_received += len(data)
+            return data
+
+        while len(self.__buffer) < size:
+            if not self.__receive():
+                break
+
+        data = bytes(self.__buffer[:size])
+        del self.__buffer[:size]
+        return data
+
+    def readline(self) -> bytes:
+        if not self.__decompressor:
+            try:
+                line = imaplib.IMAP4.readline(self)
+            except OSError as ex:
+                self.__failed(ex)
+                raise
+            self.__received(line)
+            self.bytes_received += len(line)
+            self.data_received += len(line)
+            return line
+
+        while True:
+            end = self.__buffer.find(b'\n')
+            if end >= 0:
+                line = bytes(self.__buffer[:end + 1])
+                del self.__buffer[:end + 1]
+                return line
+            if len(self.__buffer) > imaplib._MAXLINE:
+                raise self.error('got more than %d bytes' % imaplib._MAXLINE)
+            if not self.__receive():
+                # connection closed
+                line = bytes(self.__buffer)
+                self.__buffer.clear()
+                return line
+
+    def send(self, data: bytes):
+        self.data_sent += len(data)
+        if self.__compressor:
+            data = self.__compressor.compress(data) + self.__compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.bytes_sent += len(data)
+        imaplib.IMAP4.send(self, data)
+
+    def __receive(self) -> bool:
+        """
+        Receive and decompress data from the socket.
+        If the socket is non-blocking and no data is available, the socket error is passed to the caller.
+
+        :return: False, if the connection was closed
+        """
+
+        try:
+            data = self.sock.recv(self.READ_SIZE)
+        except OSError as ex:
+            self.__failed(ex)
+            raise
+        self.__received(data)
+        if not data:
+            return False
+        self.__decompress(data)
+        return True
+
+    def __received(self, data: bytes | None):
+        """
+        Remember the time of received data or a closed connection.
+
+        :param data: received data, an empty result marks the end of stream
+        """
+
+        if data:
+            self.received_at = monotonic()
+        elif data is not None and self.__is_closed():
+            self.connection_lost = True
+
+    def __is_closed(self) -> bool:
+        """
+        Check, if an empty read was caused by the end of stream.
+        A buffered read on a non-blocking socket returns an empty result as well, if no data is available.
+
+        :return: True, if the server closed the connection
+        """
+
+        if self.sock.gettimeout() != 0:
+            return True
+        try:
+            # peek on the TCP stream, as SSL sockets don't support flags
+            return not socket.socket.recv(self.sock, 1, socket.MSG_PEEK)
+        except (BlockingIOError, InterruptedError):
+            return False
+        except OSError:
+            return True
+
+    def __failed(self, ex: OSError):
+        """
+        Remember a broken connection.
+        A non-blocking socket without available data is not considered as broken.
+
+        :param ex: socket error
+        """
+
+        if not isinstance(ex, (BlockingIOError, InterruptedError, ssl.SSLWantReadError, ssl.SSLWantWriteError)):
+            self.connection_lost = True
+
+    def __decompress(self, data: bytes):
+        """
+        Decompress received data into the buffer.
+
+        :param data: compressed data
+        """
+
+        if not data:
+            return
+        self.bytes_received += len(data)
+        decompressed = self.__decompressor.decompress(data)
+        self.data_received += len(decompressed)
+        self.__buffer.extend(decompressed)
+
+
+class ImapWatcherClient(IMAPClient):
+    """
+    IMAP client, that uses a socket created by the connector instead of connecting on its own.
+    This way the connector controls name resolution, TCP connection and TLS handshake.
+
+    This relies on IMAPClient._create_IMAP4(), on the socket polling of IMAPClient.idle_check() and on the command
+    handling of IMAPClient.fetch() of IMAPClient 2.3.1.
+    """
+
+    def __init__(self, host: str, create_socket: Callable[[], socket.socket], **kwargs):
+        self.__create_socket = create_socket
+
+        # wakes up idle_check() from other threads, created on the first IDLE check
+        self.__wakeup: tuple[socket.socket, socket.socket] | None = None
+        self.__wakeup_lock = Lock()
+        self.__interrupted = False
+        super().__init__(host, **kwargs)
+
+    def _create_IMAP4(self):
+        return SocketIMAP4(self.host, self.port, self.__create_socket)
+
+    def _poll_socket(self, sock, timeout=None):
+        wakeup = self.__get_wakeup()
+        poller = select.poll()
+        poller.register(sock.fileno(), select.POLLIN)
+        poller.register(wakeup.fileno(), select.POLLIN)
+        events = poller.poll(timeout * 1000 if timeout is not None else None)
+        if any(fd == wakeup.fileno() for fd, _ in events):
+            self.__clear_wakeup()
+        return [(fd, event) for fd, event in events if fd != wakeup.fileno()]
+
+    def _select_poll_socket(self, sock, timeout=None):
+        wakeup = self.__get_wakeup()
+        readable = select.select([sock, wakeup], [], [], timeout)[0]
+        if wakeup in readable:
+            self.__clear_wakeup()
+        return [s for s in readable if s is not wakeup]
+
+    def interrupt_idle(self):
+        """
+        Wake up idle_check() from another thread, so that it returns immediately without responses.
+        If idle_check() is not waiting yet, its next call returns immediately.
+        """
+
+        with self.__wakeup_lock:
+            self.__interrupted = True
+            if self.__wakeup:
+                # noinspection PyBroadException
+                try:
+                    self.__wakeup[1].send(b'\0')
+                except Exception:
+                    pass
+
+    def logout(self):
+        try:
+            return super().logout()
+        finally:
+            self.__close_wakeup()
+
+    def shutdown(self):
+        try:
+            super().shutdown()
+        finally:
+            self.__close_wakeup()
+
+    def __get_wakeup(self) -> socket.socket:
+        """
+        Get the socket, that becomes readable on interruptions.
+
+        :return: receiving end of the wakeup socket pair
+        """
+
+        with self.__wakeup_lock:
+            if not self.__wakeup:
+                self.__wakeup = socket.socketpair()
+                self.__wakeup[0].setblocking(False)
+                if self.__interrupted:
+                    self.__wakeup[1].send(b'\0')
+            return self.__wakeup[0]
+
+    def __clear_wakeup(self):
+        """
+        Consume pending interruptions.
+        """
+
+        with self.__wakeup_lock:
+            try:
+                while self.__wakeup[0].recv(64):
+                    pass
+            except (BlockingIOError, InterruptedError):
+                pass
+
+    def __close_wakeup(self):
+        """
+        Close the wakeup socket pair.
+        """
+
+        with self.__wakeup_lock:
+            if self.__wakeup:
+                for s in self.__wakeup:
+                    s.close()
+                self.__wakeup = None
+
+    def compress(self) -> bool:
+        """
+        Enable compression of the connection (RFC 4978), if the server supports it.
+        This should be called after login.
+
+        :return: True, if compression was enabled
+        """
+
+        if b'COMPRESS=DEFLATE' not in self.capabilities():
+            return False
+
+        typ, _ = self._raw_command(b'COMPRESS', [b'DEFLATE'], uid=False)
+        if typ != 'OK':
+            return False
+
+        self._imap.start_compression()
+        return True
+
+    def fetch_pipelined(self, chunks: list[list[int]], data: list[str]) -> dict[int, dict]:
+        """
+        Fetch multiple chunks of messages with pipelined FETCH commands.
+        All commands are sent at once, before the responses are read. This avoids a round trip for each chunk.
+
+        :param chunks: lists of message numbers (or UIDs, if UIDs are used)
+        :param data: items to fetch for each message
+        :return: fetched data by message number (or UID, if UIDs are used)
+        """
+
+        tags = []
+        for chunk in chunks:
+            args = ['FETCH', join_message_ids(chunk), seq_to_parenstr_upper(data)]
+            if self.use_uid:
+                args.insert(0, 'UID')
+            tags.append(self._imap._command(*args))
+
+        # all responses are read, even if a command failed, so that the connection stays in sync with the server
+        typ, response = None, None
+        error: Exception | None = None
+        for tag in tags:
+            try:
+                typ, response = self._imap._command_complete('FETCH', tag)
+                self._checkok('fetch', typ, response)
+            except (imaplib.IMAP4.abort, OSError):
+                # the remaining responses can't be read, the connection must not be used anymore
+                self._imap.connection_lost = True
+                raise
+            except imaplib.IMAP4.error as ex:
+                error = error or ex
+        if error:
+            # responses of successful commands must not be returned by the next command
+            self._imap.untagged_responses.pop('FETCH', None)
+            raise error
+
+        typ, response = self._imap._untagged_response(typ, response, 'FETCH')
+        return parse_fetch_response(response, self.normalise_times, self.use_uid)
+
+    def is_connection_lost(self) -> bool:
+        """
+        Check, if the server closed the connection or the connection broke (e.g. detected by TCP keepalive).
+
+        :return: True, if the connection can't be used anymore
+        """
+
+        return self._imap.connection_lost
+
+    def get_idle_seconds(self) -> float:
+        """
+        Get the time since data was received from the server.
+
+        :return: number of seconds
+        """
+
+        return monotonic() - self._imap.received_at
+
+    def get_traffic(self) -> dict[str, int]:
+        """
+        Get the number of bytes sent and received on this connection.
+        "bytes_*" are counted on the (possibly compressed) stream, "data_*" are counted on the plain protocol data.
+
+        :return: byte counters
+        """
+
+        return {
+            'bytes_sent': self._imap.bytes_sent,
+            'bytes_received': self._imap.bytes_received,
+            'data_sent': self._imap.data_sent,
+            'data_received': self._imap.data_received,
+        }
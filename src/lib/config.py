@@ -17,15 +17,40 @@
 import logging
 import os
 import sys
+import threading
 from configparser import ConfigParser
 
-from . import Encryption, EncryptionCertificateCheck
+from . import Encryption, EncryptionCertificateCheck, configure_logging
+from .actions import MailboxActionExecutor, MailboxActions
+from .backfill import BackfillProgress, MessageBackfill
+from .budget import ConnectionBudget
 from .callback import CallbackHandler
 from .connector import ImapConnector
+from .dedup import MessageDeduplicator
+from .fetcher import MessageFetcher
 from .idle import ImapIdleHandler
+from .inventory import Inventory, \
+    ConfigInventory, \
+    DirectoryInventory, \
+    TableFileInventory, \
+    SqliteInventory, \
+    CombinedInventory
+from .journal import EventJournal
+from .lease import SectionLeases
+from .priority import CallbackDispatcher, PriorityRules, Priority, get_priority
+from .publisher import EventPublisher
+from .reconnect import ReconnectIntervals
+from .spool import MessageSpooler
+from .startup import StartupScheduler
 
+GLOBAL_SECTION: str = 'global'
+"""
+Name of the configuration section with application wide settings.
+This section is not treated as a mailbox.
+"""
 
-def get_config(logger: logging.Logger) -> ConfigParser | None:
+
+def get_config_path(logger: logging.Logger) -> str | None:
     if len(sys.argv) < 2:
         logger.error('Please provide a config file as first argument!')
         return None
@@ -35,11 +60,115 @@ def get_config(logger: logging.Logger) -> ConfigParser | None:
         logger.error('Can\'t find config file at "%s"!' % config_path)
         return None
 
+    return config_path
+
+
+def get_config(logger: logging.Logger) -> ConfigParser | None:
+    config_path = get_config_path(logger=logger)
+    if not config_path:
+        return None
+
+    return read_config(config_path=config_path, logger=logger)
+
+
+def read_config(config_path: str, logger: logging.Logger) -> ConfigParser | None:
     config = ConfigParser()
-    config.read(config_path)
+    try:
+        with open(config_path, 'r', encoding='utf-8') as f:
+            config.read_file(f, source=config_path)
+    except Exception as ex:
+        logger.error('Can\'t read config file at "%s"! %s' % (config_path, str(ex)))
+        return None
+
     return config
 
 
+def get_section_fingerprint(config: ConfigParser, section: str) -> tuple:
+    """
+    Get a comparable representation of all options within a section.
+
+    :param config: configuration
+    :param section: section name
+    :return: sorted option names and their raw values
+    """
+
+    if not config.has_section(section):
+        return ()
+
+    return tuple(sorted(config.items(section, raw=True)))
+
+
+def __get_boolean(config: ConfigParser, section: str, option: str, fallback: bool) -> bool:
+    value: str | None = config.get(section, option, fallback=None)
+    if value is None or not value.strip():
+        return fallback
+    return value.strip().lower() in ('1', 'true')
+
+
+def __get_integer(config: ConfigParser, section: str, option: str, fallback: int) -> int:
+    value: str | None = config.get(section, option, fallback=None)
+    if value is None or not value.strip():
+        return fallback
+    try:
+        return int(value.strip())
+    except ValueError:
+        raise Exception('Can\'t read number "%s" for option "%s".' % (value, option))
+
+
+def create_external_inventory(
+        config: ConfigParser
+) -> Inventory | None:
+    inventories: list[Inventory] = []
+
+    accounts_dir: str | None = config.get(GLOBAL_SECTION, 'accounts_dir', fallback=None)
+    if accounts_dir and accounts_dir.strip():
+        inventories.append(DirectoryInventory(path=accounts_dir.strip()))
+
+    accounts_file: str | None = config.get(GLOBAL_SECTION, 'accounts_file', fallback=None)
+    if accounts_file and accounts_file.strip():
+        inventories.append(TableFileInventory(path=accounts_file.strip()))
+
+    accounts_sqlite: str | None = config.get(GLOBAL_SECTION, 'accounts_sqlite', fallback=None)
+    if accounts_sqlite and accounts_sqlite.strip():
+        inventories.append(SqliteInventory(
+            path=accounts_sqlite.strip(),
+            table=config.get(GLOBAL_SECTION, 'accounts_sqlite_table', fallback='accounts').strip(),
+        ))
+
+    if not inventories:
+        return None
+    return inventories[0] if len(inventories) == 1 else CombinedInventory(inventories)
+
+
+def create_inventory(
+        config: ConfigParser,
+        external: Inventory | None = None
+) -> Inventory:
+    inventory = ConfigInventory(config=config, exclude=(GLOBAL_SECTION,))
+    return CombinedInventory([inventory, external]) if external else inventory
+
+
+def create_account_config(
+        config: ConfigParser,
+        name: str,
+        options: dict[str, str]
+) -> ConfigParser:
+    """
+    Create a configuration for a single account, that might be passed to the create_* functions.
+
+    :param config: main configuration
+    :param name: account name
+    :param options: account options
+    :return: configuration with the global section and the account section
+    """
+
+    account_config = ConfigParser(interpolation=None)
+    if config.has_section(GLOBAL_SECTION):
+        account_config.read_dict({GLOBAL_SECTION: dict(config.items(GLOBAL_SECTION, raw=True))})
+    account_config.read_dict({name: options})
+    return account_config
+
+
 def get_imap_folder(
         config: ConfigParser,
         section: str
@@ -50,9 +179,222 @@ def get_imap_folder(
     )
 
 
-def create_callback_handler(
+def setup_logging(
+        config: ConfigParser
+):
+    level_name = config.get(GLOBAL_SECTION, 'log_level', fallback='info').strip().upper()
+    level = logging.getLevelName(level_name)
+    if not isinstance(level, int):
+        raise Exception('Can\'t read log level "%s".' % level_name)
+
+    configure_logging(
+        level=level,
+        json_format=config.get(GLOBAL_SECTION, 'log_format', fallback='text').strip().lower() == 'json',
+        rate_limit=__get_integer(config, GLOBAL_SECTION, 'log_rate_limit', 20),
+        rate_limit_window=__get_integer(config, GLOBAL_SECTION, 'log_rate_limit_window', 60),
+    )
+
+
+def setup_threads(
+        config: ConfigParser
+):
+    stack_size = __get_integer(config, GLOBAL_SECTION, 'thread_stack_size', 0)
+    if stack_size > 0:
+        try:
+            threading.stack_size(stack_size * 1024)
+        except (ValueError, RuntimeError) as ex:
+            raise Exception('Can\'t set thread stack size to %s KiB.' % stack_size) from ex
+
+
+def get_config_watch_interval(
+        config: ConfigParser
+) -> int:
+    return __get_integer(config, GLOBAL_SECTION, 'config_watch_interval', 0)
+
+
+def create_message_deduplicator(
+        config: ConfigParser
+) -> MessageDeduplicator | None:
+    if not __get_boolean(config, GLOBAL_SECTION, 'dedup', False):
+        return None
+
+    return MessageDeduplicator(
+        max_entries=__get_integer(config, GLOBAL_SECTION, 'dedup_max_entries', 10000),
+        ttl=__get_integer(config, GLOBAL_SECTION, 'dedup_ttl', 86400),
+        use_fallback_hash=__get_boolean(config, GLOBAL_SECTION, 'dedup_fallback_hash', False),
+        file=config.get(
+            GLOBAL_SECTION, 'dedup_file',
+            fallback=None,
+        ),
+    )
+
+
+def create_startup_scheduler(
+        config: ConfigParser
+) -> StartupScheduler:
+    try:
+        rate = float(config.get(GLOBAL_SECTION, 'idle_connect_rate_per_host', fallback='5').strip())
+    except ValueError:
+        raise Exception('Can\'t read number "%s" for option "idle_connect_rate_per_host".'
+                        % config.get(GLOBAL_SECTION, 'idle_connect_rate_per_host'))
+
+    return StartupScheduler(
+        max_concurrent_per_host=__get_integer(config, GLOBAL_SECTION, 'idle_connect_concurrency_per_host', 10),
+        connections_per_second_per_host=rate,
+    )
+
+
+def create_reconnect_intervals(
+        config: ConfigParser
+) -> ReconnectIntervals:
+    return ReconnectIntervals(
+        initial=__get_integer(config, GLOBAL_SECTION, 'reconnect_interval', 600),
+        minimum=__get_integer(config, GLOBAL_SECTION, 'reconnect_interval_min', 60),
+        maximum=__get_integer(config, GLOBAL_SECTION, 'reconnect_interval_max', 1740),
+        adaptive=__get_boolean(config, GLOBAL_SECTION, 'reconnect_interval_adaptive', True),
+    )
+
+
+def create_backfill_progress(
+        config: ConfigParser
+) -> BackfillProgress:
+    return BackfillProgress(
+        file=config.get(
+            GLOBAL_SECTION, 'backfill_file',
+            fallback=None,
+        ),
+    )
+
+
+def create_connection_budget(
+        config: ConfigParser
+) -> ConnectionBudget | None:
+    max_connections_per_host = __get_integer(config, GLOBAL_SECTION, 'max_connections_per_host', 0)
+    max_connections_per_user = __get_integer(config, GLOBAL_SECTION, 'max_connections_per_user', 0)
+    if max_connections_per_host < 1 and max_connections_per_user < 1:
+        return None
+
+    return ConnectionBudget(
+        max_connections_per_host=max_connections_per_host,
+        max_connections_per_user=max_connections_per_user,
+    )
+
+
+def create_section_leases(
+        config: ConfigParser,
+        stop_timeout: float = 5,
+) -> SectionLeases | None:
+    path: str | None = config.get(GLOBAL_SECTION, 'coordination_file', fallback=None)
+    if not path or not path.strip():
+        return None
+
+    return SectionLeases(
+        path=path.strip(),
+        owner=config.get(GLOBAL_SECTION, 'coordination_instance', fallback=None),
+        ttl=__get_integer(config, GLOBAL_SECTION, 'coordination_lease_duration', 10),
+        stop_timeout=stop_timeout,
+    )
+
+
+def create_message_fetcher(
+        config: ConfigParser
+) -> MessageFetcher | None:
+    workers = __get_integer(config, GLOBAL_SECTION, 'fetch_workers', 4)
+    if workers < 1:
+        return None
+
+    return MessageFetcher(
+        workers=workers,
+        max_queued=__get_integer(config, GLOBAL_SECTION, 'fetch_queue_size', 1000),
+        max_batch=__get_integer(config, GLOBAL_SECTION, 'fetch_batch_size', 50),
+        max_per_host=__get_integer(config, GLOBAL_SECTION, 'fetch_workers_per_host', 2),
+    )
+
+
+def create_callback_dispatcher(
+        config: ConfigParser
+) -> CallbackDispatcher | None:
+    workers = __get_integer(config, GLOBAL_SECTION, 'callback_workers', 0)
+    if workers < 1:
+        return None
+
+    return CallbackDispatcher(
+        workers=workers,
+        aging=__get_integer(config, GLOBAL_SECTION, 'callback_priority_aging', 60),
+        max_queued=__get_integer(config, GLOBAL_SECTION, 'callback_queue_size', 10000),
+    )
+
+
+def create_event_publisher(
+        config: ConfigParser
+) -> EventPublisher | None:
+    path: str | None = config.get(GLOBAL_SECTION, 'publisher_socket', fallback=None)
+    if not path or not path.strip():
+        return None
+
+    return EventPublisher(
+        path=path.strip(),
+        buffer_size=__get_integer(config, GLOBAL_SECTION, 'publisher_buffer_size', 1000),
+        slow_consumer=config.get(GLOBAL_SECTION, 'publisher_slow_consumer', fallback='drop'),
+        replay_size=__get_integer(config, GLOBAL_SECTION, 'publisher_replay_size', 0),
+    )
+
+
+def create_event_journal(
+        config: ConfigParser
+) -> EventJournal | None:
+    directory: str | None = config.get(GLOBAL_SECTION, 'journal_directory', fallback=None)
+    if not directory or not directory.strip():
+        return None
+
+    return EventJournal(
+        directory=directory.strip(),
+        max_size=__get_integer(config, GLOBAL_SECTION, 'journal_max_size', 67108864),
+        max_files=__get_integer(config, GLOBAL_SECTION, 'journal_max_files', 10),
+    )
+
+
+def create_action_executor(
+        config: ConfigParser
+) -> MailboxActionExecutor:
+    return MailboxActionExecutor(
+        delay=__get_integer(config, GLOBAL_SECTION, 'action_delay', 1),
+        idle_timeout=__get_integer(config, GLOBAL_SECTION, 'action_connection_timeout', 60),
+        workers=max(1, __get_integer(config, GLOBAL_SECTION, 'action_workers', 4)),
+    )
+
+
+def get_callback_stats_interval(
+        config: ConfigParser
+) -> int:
+    return __get_integer(config, GLOBAL_SECTION, 'callback_stats_interval', 300)
+
+
+def create_priority_rules(
         config: ConfigParser,
         section: str
+) -> PriorityRules:
+    senders: list[tuple[str, Priority]] = []
+    for priority in (Priority.HIGH, Priority.LOW):
+        patterns: str = config.get(section, 'priority_%s_senders' % priority.name.lower(), fallback='')
+        senders.extend((pattern, priority) for pattern in patterns.split(',') if pattern.strip())
+
+    return PriorityRules(
+        default=get_priority(config.get(section, 'priority', fallback='normal')),
+        senders=senders,
+        use_headers=__get_boolean(config, section, 'priority_headers', False),
+    )
+
+
+def create_callback_handler(
+        config: ConfigParser,
+        section: str,
+        deduplicator: MessageDeduplicator | None = None,
+        dispatcher: CallbackDispatcher | None = None,
+        connector: ImapConnector | None = None,
+        executor: MailboxActionExecutor | None = None,
+        publisher: EventPublisher | None = None,
+        journal: EventJournal | None = None
 ) -> CallbackHandler:
     env = {}
     for option in config.options(section):
@@ -67,13 +409,52 @@ def create_callback_handler(
             fallback=None,
         ),
         additional_env=env,
+        deduplicator=deduplicator if __get_boolean(config, section, 'dedup', True) else None,
+        on_message_flags_changed=config.get(
+            section, 'on_message_flags_changed',
+            fallback=None,
+        ),
+        on_message_expunged=config.get(
+            section, 'on_message_expunged',
+            fallback=None,
+        ),
+        use_shell=__get_boolean(config, section, 'on_new_message_shell', True),
+        priority_rules=create_priority_rules(config, section) if dispatcher else None,
+        dispatcher=dispatcher,
+        actions=MailboxActions(
+            name=section,
+            connector=connector,
+            folder=get_imap_folder(config, section),
+            executor=executor,
+        ) if connector and executor and __get_boolean(config, section, 'callback_actions', False) else None,
+        publisher=publisher if __get_boolean(config, section, 'publish', True) else None,
+        journal=journal,
     )
 
 
+def get_password(
+        config: ConfigParser,
+        section: str
+) -> str | None:
+    password_file: str | None = config.get(section, 'password_file', fallback=None)
+    if not password_file or not password_file.strip():
+        return config.get(
+            section, 'password',
+            fallback=None,
+        )
+
+    try:
+        with open(password_file.strip(), 'r', encoding='utf-8') as f:
+            return f.readline().rstrip('\r\n')
+    except OSError as ex:
+        raise Exception('Can\'t read password file "%s".' % password_file.strip()) from ex
+
+
 def create_imap_connector(
         config: ConfigParser,
         section: str,
-        use_uid=False
+        use_uid=False,
+        budget: ConnectionBudget | None = None
 ) -> ImapConnector:
     try:
         port: int = int(config.get(
@@ -93,10 +474,7 @@ def create_imap_connector(
             section, 'username',
             fallback=None,
         ),
-        password=config.get(
-            section, 'password',
-            fallback=None,
-        ),
+        password=get_password(config=config, section=section),
         encryption=config.get(
             section, 'encryption',
             fallback=Encryption.NONE,
@@ -114,6 +492,59 @@ def create_imap_connector(
             fallback=None,
         ),
         use_uid=use_uid,
+        budget=budget,
+        budget_timeout=__get_integer(config, GLOBAL_SECTION, 'connection_wait_timeout', 60),
+        compression=__get_boolean(config, section, 'compression', False),
+        tcp_keepalive=__get_integer(config, section, 'tcp_keepalive', 60),
+        connect_timeout=__get_integer(config, section, 'connect_timeout', 15),
+        read_timeout=__get_integer(config, section, 'read_timeout', 60),
+        dns_cache_ttl=__get_integer(config, section, 'dns_cache_ttl', 300),
+    )
+
+
+def create_message_spooler(
+        config: ConfigParser,
+        section: str
+) -> MessageSpooler | None:
+    directory: str = config.get(section, 'spool_directory', fallback='').strip()
+    if not directory:
+        return None
+
+    sections: str = config.get(section, 'spool_sections', fallback='')
+    return MessageSpooler(
+        directory=directory,
+        sections=[value for value in sections.split(',') if value.strip()],
+        max_size=__get_integer(config, section, 'spool_max_size', 26214400),
+    )
+
+
+def create_message_backfill(
+        config: ConfigParser,
+        section: str,
+        connector: ImapConnector,
+        progress: BackfillProgress | None = None,
+        spooler: MessageSpooler | None = None
+) -> MessageBackfill | None:
+    criteria: str = config.get(section, 'backfill', fallback='').strip()
+    if not criteria:
+        return None
+
+    try:
+        rate = float(config.get(section, 'backfill_rate', fallback='10').strip())
+    except ValueError:
+        raise Exception('Can\'t read number "%s" for option "backfill_rate".' % config.get(section, 'backfill_rate'))
+
+    return MessageBackfill(
+        name=section,
+        connector=connector,
+        criteria=criteria,
+        folder=get_imap_folder(config=config, section=section),
+        mode=config.get(section, 'backfill_mode', fallback='once'),
+        progress=progress,
+        chunk_size=__get_integer(config, section, 'backfill_chunk_size', 100),
+        pipeline=__get_integer(config, section, 'backfill_pipeline', 4),
+        rate=rate,
+        spooler=spooler,
     )
 
 
@@ -121,11 +552,24 @@ def create_imap_idle_handler(
         config: ConfigParser,
         section: str,
         connector: ImapConnector,
-        callback: CallbackHandler
+        callback: CallbackHandler,
+        startup_scheduler: StartupScheduler | None = None,
+        fetcher: MessageFetcher | None = None,
+        reconnect_intervals: ReconnectIntervals | None = None,
+        backfill_progress: BackfillProgress | None = None
 ) -> ImapIdleHandler:
+    spooler: MessageSpooler | None = create_message_spooler(config, section)
     return ImapIdleHandler(
         name=section,
         connector=connector,
         callback=callback,
         folder=get_imap_folder(config=config, section=section),
+        startup_scheduler=startup_scheduler,
+        single_connection=__get_boolean(config, section, 'single_connection', False),
+        fetcher=fetcher,
+        spooler=spooler,
+        reconnect_intervals=reconnect_intervals,
+        heartbeat_interval=__get_integer(config, section, 'heartbeat_interval', 0),
+        heartbeat_noop=__get_boolean(config, section, 'heartbeat_noop', False),
+        backfill=create_message_backfill(config, section, connector, backfill_progress, spooler),
     )
@@ -14,12 +14,112 @@
 # limitations under the License.
 #
 
+import errno
+import os
+import selectors
+import socket
 import ssl
+import sys
+from collections import deque
+from threading import Lock
+from time import perf_counter, monotonic
 
-from imapclient import IMAPClient
+from imapclient import IMAPClient, SocketTimeout
 
 from . import Encryption
 from . import EncryptionCertificateCheck
+from .budget import ConnectionBudget, ConnectionLease
+from .client import ImapWatcherClient
+
+
+def interleave_addresses(addresses: list[tuple]) -> list[tuple]:
+    """
+    Order resolved addresses alternating by address family, starting with the family of the first address.
+    see https://datatracker.ietf.org/doc/html/rfc8305#section-4
+
+    :param addresses: results of socket.getaddrinfo()
+    :return: reordered addresses
+    """
+
+    if not addresses:
+        return []
+    primary = [address for address in addresses if address[0] == addresses[0][0]]
+    secondary = [address for address in addresses if address[0] != addresses[0][0]]
+
+    result = []
+    for i in range(max(len(primary), len(secondary))):
+        if i < len(primary):
+            result.append(primary[i])
+        if i < len(secondary):
+            result.append(secondary[i])
+    return result
+
+
+def connect_parallel(addresses: list[tuple], timeout: float | None = None, delay: float = 0.25) -> socket.socket:
+    """
+    Connect to the first reachable address ("Happy Eyeballs").
+    The next address is tried, if the previous attempt failed or did not succeed within the delay, while previous
+    attempts keep running. This way a broken address family (e.g. IPv6) does not delay the connection.
+    see https://datatracker.ietf.org/doc/html/rfc8305#section-5
+
+    :param addresses: results of socket.getaddrinfo() in the order of attempts
+    :param timeout: maximal number of seconds for all attempts or None to wait infinitely
+    :param delay: number of seconds to wait for an attempt, before the next attempt is started
+    :return: the connected socket in blocking mode
+    """
+
+    deadline = monotonic() + timeout if timeout else None
+    pending = deque(addresses)
+    attempts: set[socket.socket] = set()
+    error: OSError | None = None
+    selector = selectors.DefaultSelector()
+    try:
+        next_attempt_at = monotonic()
+        while True:
+            now = monotonic()
+            if pending and (not attempts or now >= next_attempt_at):
+                family, socket_type, proto, _, address = pending.popleft()
+                sock = socket.socket(family, socket_type, proto)
+                try:
+                    sock.setblocking(False)
+                    result = sock.connect_ex(address)
+                    if result not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN):
+                        raise OSError(result, os.strerror(result))
+                except OSError as ex:
+                    error = ex
+                    sock.close()
+                    continue
+                attempts.add(sock)
+                selector.register(sock, selectors.EVENT_WRITE)
+                next_attempt_at = now + delay
+                continue
+
+            if not attempts:
+                raise error if error else OSError('No address to connect to.')
+
+            wait = max(0.0, next_attempt_at - now) if pending else None
+            if deadline is not None:
+                if now >= deadline:
+                    raise TimeoutError('Connection timed out after %s seconds.' % timeout)
+                wait = min(wait, deadline - now) if wait is not None else deadline - now
+
+            for key, _ in selector.select(wait):
+                sock = key.fileobj
+                selector.unregister(sock)
+                attempts.discard(sock)
+                result = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if result == 0:
+                    sock.setblocking(True)
+                    return sock
+
+                # start the next attempt right away
+                error = OSError(result, os.strerror(result))
+                sock.close()
+                next_attempt_at = monotonic()
+    finally:
+        for sock in attempts:
+            sock.close()
+        selector.close()
 
 
 class ImapConnector:
@@ -27,6 +127,52 @@ class ImapConnector:
     Holds IMAP configuration and provides a connection method.
     """
 
+    __slots__ = (
+        '__host',
+        '__port',
+        '__username',
+        '__password',
+        '__encryption',
+        '__encryption_hostname_check',
+        '__encryption_certificate_check',
+        '__encryption_certificate_ca_file',
+        '__use_uid',
+        '__compression',
+        '__tcp_keepalive',
+        '__connect_timeout',
+        '__read_timeout',
+        '__dns_cache_ttl',
+        '__addresses',
+        '__addresses_expire_at',
+        '__addresses_lock',
+        '__budget',
+        '__budget_timeout',
+        '__leases',
+        '__leases_lock',
+    )
+
+    __ssl_contexts: dict[tuple, ssl.SSLContext] = {}
+    """
+    SSL contexts shared by all connectors with the same encryption settings.
+    """
+
+    __ssl_contexts_lock: Lock = Lock()
+
+    TCP_KEEPALIVE_INTERVAL: int = 10
+    """
+    Number of seconds between TCP keepalive probes, if the server did not respond.
+    """
+
+    TCP_KEEPALIVE_COUNT: int = 3
+    """
+    Number of unanswered TCP keepalive probes, until the connection is considered as broken.
+    """
+
+    CONNECTION_ATTEMPT_DELAY: float = 0.25
+    """
+    Number of seconds to wait for a connection attempt, before the next address is tried in parallel.
+    """
+
     def __init__(
             self,
             host: str = 'localhost',
@@ -38,88 +184,340 @@ class ImapConnector:
             encryption_certificate_check: EncryptionCertificateCheck = EncryptionCertificateCheck.REQUIRED,
             encryption_certificate_ca_file: str | None = None,
             use_uid: bool = True,
+            budget: ConnectionBudget | None = None,
+            budget_timeout: float | None = 60,
+            compression: bool = False,
+            tcp_keepalive: int = 60,
+            connect_timeout: float | None = 15,
+            read_timeout: float | None = 60,
+            dns_cache_ttl: int = 300,
     ):
-        self.__host = host.strip()
+        # values shared by many mailboxes are interned
+        self.__host = sys.intern(host.strip())
         self.__port = port
         self.__username = username.strip() if username else None
         self.__password = password.strip() if password else None
-        self.__encryption = encryption
+        self.__encryption = Encryption(encryption.strip().lower()) \
+            if isinstance(encryption, str) else encryption
         self.__encryption_hostname_check = encryption_hostname_check
-        self.__encryption_certificate_check = encryption_certificate_check
-        self.__encryption_certificate_ca_file = encryption_certificate_ca_file.strip() \
+        self.__encryption_certificate_check = EncryptionCertificateCheck(encryption_certificate_check.strip().lower()) \
+            if isinstance(encryption_certificate_check, str) else encryption_certificate_check
+        self.__encryption_certificate_ca_file = sys.intern(encryption_certificate_ca_file.strip()) \
             if encryption_certificate_ca_file else None
         self.__use_uid = use_uid
+        self.__compression = compression
+        self.__tcp_keepalive = max(0, tcp_keepalive)
+        self.__connect_timeout = connect_timeout if connect_timeout and connect_timeout > 0 else None
+        self.__read_timeout = read_timeout if read_timeout and read_timeout > 0 else None
+
+        # resolved addresses are cached, so that reconnects don't wait for name resolution
+        self.__dns_cache_ttl = max(0, dns_cache_ttl)
+        self.__addresses: list[tuple] | None = None
+        self.__addresses_expire_at = 0.0
+        self.__addresses_lock = Lock()
+        self.__budget = budget
+        self.__budget_timeout = budget_timeout
 
-    def __create_client(self) -> IMAPClient:
+        # leases are only tracked, if a budget is used
+        self.__leases: dict[int, ConnectionLease] | None = {} if budget else None
+        self.__leases_lock: Lock | None = Lock() if budget else None
+
+    @property
+    def host(self) -> str:
+        return self.__host
+
+    @property
+    def port(self) -> int:
+        return self.__port
+
+    @property
+    def username(self) -> str | None:
+        return self.__username
+
+    @property
+    def budgeted(self) -> bool:
+        return self.__budget is not None
+
+    def __create_client(self, timings: dict[str, float] | None = None) -> IMAPClient:
         """
         Creates an IMAP client.
 
+        :param timings: if provided, the duration of each connection phase is stored in seconds
         :return: the created IMAP client
         """
 
         is_ssl = self.__encryption == Encryption.SSL
 
-        return IMAPClient(
+        started_at = perf_counter()
+        client = ImapWatcherClient(
             self.__host,
+            create_socket=lambda: self.__create_socket(timings),
             port=self.__port,
             ssl=is_ssl,
             ssl_context=self.__create_ssl_context() if is_ssl else None,
-            use_uid=self.__use_uid
+            use_uid=self.__use_uid,
+            timeout=SocketTimeout(connect=self.__connect_timeout, read=self.__read_timeout),
         )
 
+        if timings is not None:
+            timings['greeting'] = perf_counter() - started_at - sum(
+                timings.get(phase, 0.0) for phase in ('dns', 'tcp', 'tls')
+            )
+
+        return client
+
+    def __create_socket(self, timings: dict[str, float] | None = None) -> socket.socket:
+        """
+        Creates a socket connected to the IMAP server, that is wrapped by SSL if necessary.
+
+        :param timings: if provided, the duration of each connection phase is stored in seconds
+        :return: the connected socket
+        """
+
+        started_at = perf_counter()
+        addresses = self.__resolve()
+        if timings is not None:
+            timings['dns'] = perf_counter() - started_at
+
+        started_at = perf_counter()
+        try:
+            sock = connect_parallel(addresses, timeout=self.__connect_timeout, delay=self.CONNECTION_ATTEMPT_DELAY)
+        except OSError:
+            # the host might have moved to other addresses
+            self.__forget_addresses()
+            raise
+        if timings is not None:
+            timings['tcp'] = perf_counter() - started_at
+
+        # TLS handshake and greeting must be completed within the connect timeout as well,
+        # IMAPClient applies the read timeout afterwards
+        sock.settimeout(self.__connect_timeout)
+
+        if self.__tcp_keepalive > 0:
+            self.__enable_keepalive(sock)
+
+        if self.__encryption == Encryption.SSL:
+            started_at = perf_counter()
+            try:
+                sock = self.__create_ssl_context().wrap_socket(sock, server_hostname=self.__host)
+            except Exception:
+                sock.close()
+                raise
+            if timings is not None:
+                timings['tls'] = perf_counter() - started_at
+
+        return sock
+
+    def __resolve(self) -> list[tuple]:
+        """
+        Resolve the addresses of the IMAP server or take them from the cache.
+
+        :return: addresses in the order of connection attempts
+        """
+
+        if self.__dns_cache_ttl > 0:
+            with self.__addresses_lock:
+                if self.__addresses and monotonic() < self.__addresses_expire_at:
+                    return self.__addresses
+
+        addresses = interleave_addresses(socket.getaddrinfo(self.__host, self.__port, type=socket.SOCK_STREAM))
+        if not addresses:
+            raise OSError('No address found for "%s".' % self.__host)
+
+        if self.__dns_cache_ttl > 0:
+            with self.__addresses_lock:
+                self.__addresses = addresses
+                self.__addresses_expire_at = monotonic() + self.__dns_cache_ttl
+        return addresses
+
+    def __forget_addresses(self):
+        """
+        Remove cached addresses, so that the name is resolved again on the next connection.
+        """
+
+        with self.__addresses_lock:
+            self.__addresses = None
+
+    def __enable_keepalive(self, sock: socket.socket):
+        """
+        Enable TCP keepalive on a socket, so that broken connections are detected by the operating system.
+        The timing options are only applied, if they are supported on the current platform.
+
+        :param sock: connected socket
+        """
+
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+        # macOS provides TCP_KEEPALIVE instead of TCP_KEEPIDLE
+        idle_option = getattr(socket, 'TCP_KEEPIDLE', getattr(socket, 'TCP_KEEPALIVE', None))
+        for option, value in (
+                (idle_option, self.__tcp_keepalive),
+                (getattr(socket, 'TCP_KEEPINTVL', None), self.TCP_KEEPALIVE_INTERVAL),
+                (getattr(socket, 'TCP_KEEPCNT', None), self.TCP_KEEPALIVE_COUNT),
+        ):
+            if option is None:
+                continue
+            try:
+                sock.setsockopt(socket.IPPROTO_TCP, option, value)
+            except OSError:
+                pass
+
     def __create_ssl_context(self) -> ssl.SSLContext | None:
         """
-        Creates a SSL context for encryption.
+        Get a SSL context for encryption.
+        Connectors with equal encryption settings share the same SSL context,
+        so that CA certificates are loaded only once.
         see https://imapclient.readthedocs.io/en/2.3.1/concepts.html#tls-ssl
 
-        :return: the created SSL context or None, if no SSL encryption is used
+        :return: the SSL context or None, if no SSL encryption is used
         """
 
         if self.__encryption not in (Encryption.SSL, Encryption.STARTTLS):
             return None
 
-        ssl_context = ssl.create_default_context(cafile=self.__encryption_certificate_ca_file)
-        ssl_context.check_hostname = self.__encryption_hostname_check
+        key = (
+            self.__encryption_certificate_ca_file,
+            self.__encryption_hostname_check,
+            self.__encryption_certificate_check,
+        )
+
+        with ImapConnector.__ssl_contexts_lock:
+            ssl_context = ImapConnector.__ssl_contexts.get(key)
+            if ssl_context is not None:
+                return ssl_context
 
-        if self.__encryption_certificate_check == EncryptionCertificateCheck.REQUIRED:
-            ssl_context.verify_mode = ssl.CERT_REQUIRED
-        elif self.__encryption_certificate_check == EncryptionCertificateCheck.OPTIONAL:
-            ssl_context.verify_mode = ssl.CERT_OPTIONAL
-        else:
-            ssl_context.verify_mode = ssl.CERT_NONE
+            ssl_context = ssl.create_default_context(cafile=self.__encryption_certificate_ca_file)
+            ssl_context.check_hostname = self.__encryption_hostname_check
 
-        return ssl_context
+            if self.__encryption_certificate_check == EncryptionCertificateCheck.REQUIRED:
+                ssl_context.verify_mode = ssl.CERT_REQUIRED
+            elif self.__encryption_certificate_check == EncryptionCertificateCheck.OPTIONAL:
+                ssl_context.verify_mode = ssl.CERT_OPTIONAL
+            else:
+                ssl_context.verify_mode = ssl.CERT_NONE
 
-    def connect(self, select_folder: str | None = None, select_folder_readonly: bool = False) -> IMAPClient:
+            ImapConnector.__ssl_contexts[key] = ssl_context
+            return ssl_context
+
+    def connect(
+            self,
+            select_folder: str | None = None,
+            select_folder_readonly: bool = False,
+            timings: dict[str, float] | None = None,
+            long_lived: bool = False,
+    ) -> IMAPClient:
         """
         Creates an IMAP client according to the provided configuration.
 
         :param select_folder: if provided, a folder is automatically selected after login
         :param select_folder_readonly: if a folder is automatically selected, it might be used read only
+        :param timings: if provided, the duration of each connection phase is stored in seconds
+        (dns, tcp, tls, greeting, login, compress, select)
+        :param long_lived: whether the connection is kept open for a long time (e.g. IDLE), see ConnectionBudget
         :return: create IMAP client
         """
 
-        try:
-            client = self.__create_client()
-        except Exception as ex:
-            raise Exception('Can\t create client instance.') from ex
+        lease: ConnectionLease | None = None
+        if self.__budget:
+            lease = self.__budget.acquire(self.__host, self.__username, timeout=self.__budget_timeout,
+                                          long_lived=long_lived)
+            if not lease:
+                raise Exception('No connection available within budget after %s seconds.' % self.__budget_timeout)
 
-        if self.__encryption == Encryption.STARTTLS:
+        client: IMAPClient | None = None
+        try:
             try:
-                client.starttls(ssl_context=self.__create_ssl_context())
+                client = self.__create_client(timings)
             except Exception as ex:
-                raise Exception('STARTTLS encryption failed.') from ex
+                raise Exception('Can\t create client instance.') from ex
 
-        if self.__username:
-            try:
-                client.login(self.__username, self.__password if self.__password else '')
-            except Exception as ex:
-                raise Exception('Login failed.') from ex
+            if self.__encryption == Encryption.STARTTLS:
+                started_at = perf_counter()
+                try:
+                    client.starttls(ssl_context=self.__create_ssl_context())
+                except Exception as ex:
+                    raise Exception('STARTTLS encryption failed.') from ex
+                if timings is not None:
+                    timings['tls'] = perf_counter() - started_at
 
-        if select_folder:
-            try:
-                client.select_folder(select_folder, readonly=select_folder_readonly)
-            except Exception as ex:
-                raise Exception('Folder selection failed.') from ex
+            if self.__username:
+                started_at = perf_counter()
+                try:
+                    client.login(self.__username, self.__password if self.__password else '')
+                except Exception as ex:
+                    raise Exception('Login failed.') from ex
+                if timings is not None:
+                    timings['login'] = perf_counter() - started_at
+
+            # compression is only enabled, if the server advertises COMPRESS=DEFLATE
+            if self.__compression:
+                started_at = perf_counter()
+                try:
+                    client.compress()
+                except Exception as ex:
+                    raise Exception('Compression failed.') from ex
+                if timings is not None:
+                    timings['compress'] = perf_counter() - started_at
+
+            if select_folder:
+                started_at = perf_counter()
+                try:
+                    client.select_folder(select_folder, readonly=select_folder_readonly)
+                except Exception as ex:
+                    raise Exception('Folder selection failed.') from ex
+                if timings is not None:
+                    timings['select'] = perf_counter() - started_at
+
+        except Exception:
+            if client:
+                self.__shutdown(client)
+            if lease:
+                self.__budget.release(lease)
+            raise
+
+        if lease:
+            with self.__leases_lock:
+                self.__leases[id(client)] = lease
 
         return client
+
+    def disconnect(self, client: IMAPClient | None):
+        """
+        Logout and close an IMAP client, that was created by connect().
+
+        :param client: IMAP client
+        """
+
+        if not client:
+            return
+
+        try:
+            # a lost connection would block or fail on logout
+            if isinstance(client, ImapWatcherClient) and client.is_connection_lost():
+                self.__shutdown(client)
+                return
+
+            # noinspection PyBroadException
+            try:
+                client.logout()
+            except Exception:
+                self.__shutdown(client)
+        finally:
+            if self.__budget:
+                with self.__leases_lock:
+                    lease = self.__leases.pop(id(client), None)
+                self.__budget.release(lease)
+
+    @staticmethod
+    def __shutdown(client: IMAPClient):
+        """
+        Close the socket of an IMAP client without logout.
+
+        :param client: IMAP client
+        """
+
+        # noinspection PyBroadException
+        try:
+            client.shutdown()
+        except Exception:
+            pass
@@ -0,0 +1,222 @@
+#
+# Copyright 2023 OpenIndex.de.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import json
+import os
+from collections import OrderedDict
+from datetime import datetime
+from hashlib import blake2b
+from threading import Thread, Lock, Event
+from time import time
+
+from . import root_logger
+
+
+class MessageDeduplicator:
+    """
+    Remembers recently processed messages in order to suppress duplicate callbacks.
+
+    A single instance is shared by all callback handlers of the process. Messages are identified by their
+    "Message-Id" header or optionally by a hash of date, author and subject, if no "Message-Id" is available.
+    Only a fixed size digest is stored for each message, the number of entries is limited (least recently used
+    entries are removed first) and entries expire after a certain amount of time.
+    """
+
+    SECONDS_BETWEEN_SAVES: int = 10
+    """
+    Minimal number of seconds between two writes of the persistence file.
+    The file is written by a background thread, so that callbacks are not delayed.
+    """
+
+    def __init__(
+            self,
+            max_entries: int = 10000,
+            ttl: int = 86400,
+            use_fallback_hash: bool = False,
+            file: str | None = None,
+    ):
+        self.__max_entries = max(1, max_entries)
+        self.__ttl = ttl
+        self.__use_fallback_hash = use_fallback_hash
+        self.__file = file.strip() if file else None
+        self.__entries: OrderedDict[bytes, float] = OrderedDict()
+        self.__lock = Lock()
+        self.__save_lock = Lock()
+        self.__save_requested = Event()
+        self.__save_thread: Thread | None = None
+        self.__saved_at = 0.0
+        self.__changed = False
+
+        if self.__file:
+            self.__load()
+
+    def get_key(
+            self,
+            message_id: str | None,
+            date: datetime | str | None = None,
+            author: str | None = None,
+            subject: str | None = None,
+    ) -> bytes | None:
+        """
+        Creates the key of a message.
+
+        :param message_id: "Message-Id" header value
+        :param date: message date
+        :param author: message author
+        :param subject: message subject
+        :return: digest of the message or None, if the message can't be identified
+        """
+
+        if message_id and message_id.strip():
+            value = 'id:%s' % message_id.strip()
+        elif self.__use_fallback_hash and (date or author or subject):
+            value = 'hash:%s|%s|%s' % (
+                str(date) if date else '',
+                author.strip().lower() if author else '',
+                subject.strip() if subject else '',
+            )
+        else:
+            return None
+
+        return blake2b(value.encode('utf-8', errors='replace'), digest_size=16).digest()
+
+    def is_duplicate(self, key: bytes | None) -> bool:
+        """
+        Checks, if a message was already seen and remembers it otherwise.
+
+        :param key: message key created by get_key()
+        :return: True, if the message was already seen within the configured time to live
+        """
+
+        if key is None:
+            return False
+
+        now = time()
+        with self.__lock:
+            seen_at = self.__entries.get(key)
+            if seen_at is not None and (self.__ttl <= 0 or now - seen_at < self.__ttl):
+                self.__entries[key] = now
+                self.__entries.move_to_end(key)
+                return True
+
+            self.__entries[key] = now
+            self.__entries.move_to_end(key)
+            self.__changed = True
+            self.__cleanup(now)
+
+        if self.__file and now - self.__saved_at >= self.SECONDS_BETWEEN_SAVES:
+            self.__request_save()
+
+        return False
+
+    def size(self) -> int:
+        """
+        Get the number of currently remembered messages.
+
+        :return: number of entries
+        """
+
+        with self.__lock:
+            return len(self.__entries)
+
+    def save(self):
+        """
+        Write remembered messages into the persistence file, if configured.
+        """
+
+        if not self.__file:
+            return
+
+        # saves are serialized, so that an older snapshot never replaces a newer one
+        with self.__save_lock:
+            with self.__lock:
+                if not self.__changed:
+                    return
+                data = {key.hex(): seen_at for key, seen_at in self.__entries.items()}
+                self.__changed = False
+                self.__saved_at = time()
+
+            tmp_file = '%s.%s.tmp' % (self.__file, os.getpid())
+            try:
+                with open(tmp_file, 'w', encoding='utf-8') as f:
+                    json.dump(data, f)
+                os.replace(tmp_file, self.__file)
+            except Exception as ex:
+                root_logger.warning('Can\'t write deduplication file "%s". %s', self.__file, str(ex))
+
+    def __request_save(self):
+        """
+        Let the background thread write the persistence file.
+        """
+
+        with self.__lock:
+            # the thread is started on demand
+            if self.__save_thread is None:
+                self.__save_thread = Thread(target=self.__run_saves, name='dedup-save', daemon=True)
+                self.__save_thread.start()
+        self.__save_requested.set()
+
+    def __run_saves(self):
+        """
+        Write the persistence file, whenever a save was requested.
+        """
+
+        while True:
+            self.__save_requested.wait()
+            self.__save_requested.clear()
+            self.save()
+
+    def __cleanup(self, now: float):
+        """
+        Remove expired entries and the least recently used entries, that exceed the maximal size.
+        Must be called while holding the lock.
+
+        :param now: current timestamp
+        """
+
+        if self.__ttl > 0:
+            while self.__entries:
+                key, seen_at = next(iter(self.__entries.items()))
+                if now - seen_at < self.__ttl:
+                    break
+                del self.__entries[key]
+
+        while len(self.__entries) > self.__max_entries:
+            self.__entries.popitem(last=False)
+
+    def __load(self):
+        """
+        Read remembered messages from the persistence file.
+        """
+
+        if not os.path.isfile(self.__file):
+            return
+
+        try:
+            with open(self.__file, 'r', encoding='utf-8') as f:
+                data: dict = json.load(f)
+        except Exception as ex:
+            root_logger.warning('Can\'t read deduplication file "%s". %s', self.__file, str(ex))
+            return
+
+        now = time()
+        for key, seen_at in sorted(data.items(), key=lambda item: item[1]):
+            try:
+                self.__entries[bytes.fromhex(key)] = float(seen_at)
+            except (TypeError, ValueError):
+                continue
+
+        self.__cleanup(now)
@@ -0,0 +1,273 @@
+#
+# Copyright 2023 OpenIndex.de.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import json
+from datetime import datetime
+from string import Template
+
+from imapclient.response_types import Envelope, Address
+
+from . import get_envelope_message_id, \
+    get_envelope_in_reply_to, \
+    get_envelope_date, \
+    get_envelope_subject, \
+    get_envelope_from_first, \
+    get_envelope_sender_first, \
+    get_envelope_to_first, \
+    get_address_name, \
+    get_address_mail
+
+
+def get_address_parts(address: Address | None) -> tuple[str, str, str]:
+    """
+    Get the decoded parts of an address.
+
+    :param address: address
+    :return: complete address, name and mail address (empty, if not available)
+    """
+
+    if not address:
+        return '', '', ''
+    name = get_address_name(address) if address.name else ''
+    mail = get_address_mail(address) if address.host and address.mailbox else ''
+    return str(address), name or '', mail or ''
+
+
+class MessageEvent:
+    """
+    A new message, that was received by a watched mailbox.
+
+    Events are immutable and created once per message. The environment variables, JSON and template representations
+    are rendered on first use and cached, so that they are shared by all callback transports.
+    """
+
+    __slots__ = (
+        'section',
+        'folder',
+        'uid',
+        'message_id',
+        'reply_to_id',
+        'date',
+        'subject',
+        'author',
+        'author_name',
+        'author_mail',
+        'from_',
+        'from_name',
+        'from_mail',
+        'sender',
+        'sender_name',
+        'sender_mail',
+        'to',
+        'to_name',
+        'to_mail',
+        '_environment',
+        '_json',
+        '_templates',
+    )
+
+    def __init__(
+            self,
+            section: str,
+            folder: str,
+            uid: int | None = None,
+            message_id: str = '',
+            reply_to_id: str = '',
+            date: datetime | None = None,
+            subject: str = '',
+            author: str = '',
+            author_name: str = '',
+            author_mail: str = '',
+            from_: str = '',
+            from_name: str = '',
+            from_mail: str = '',
+            sender: str = '',
+            sender_name: str = '',
+            sender_mail: str = '',
+            to: str = '',
+            to_name: str = '',
+            to_mail: str = '',
+    ):
+        values = locals()
+        for name in self.__slots__:
+            object.__setattr__(self, name, values[name] if not name.startswith('_') else None)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('MessageEvent is immutable.')
+
+    def __delattr__(self, name):
+        raise AttributeError('MessageEvent is immutable.')
+
+    def __repr__(self) -> str:
+        return 'MessageEvent(section=%r, folder=%r, uid=%r, message_id=%r)' % (
+            self.section, self.folder, self.uid, self.message_id
+        )
+
+    @classmethod
+    def from_envelope(
+            cls,
+            section: str,
+            folder: str,
+            envelope: Envelope,
+            uid: int | None = None,
+    ) -> 'MessageEvent':
+        """
+        Create an event from the envelope of a message.
+
+        :param section: name of the mailbox section
+        :param folder: watched folder
+        :param envelope: message envelope
+        :param uid: UID of the message or None, if not known
+        :return: event
+        """
+
+        msg_id: str | None = get_envelope_message_id(envelope)
+        msg_reply_to_id: str | None = get_envelope_in_reply_to(envelope)
+        msg_subject: str | None = get_envelope_subject(envelope)
+
+        msg_from: Address | None = get_envelope_from_first(envelope)
+        msg_sender: Address | None = get_envelope_sender_first(envelope)
+        from_, from_name, from_mail = get_address_parts(msg_from)
+        sender, sender_name, sender_mail = get_address_parts(msg_sender)
+        to, to_name, to_mail = get_address_parts(get_envelope_to_first(envelope))
+
+        # the author is taken from the "From" header or from the "Sender" header, if "From" is not available
+        author, author_name, author_mail = (from_, from_name, from_mail) if msg_from \
+            else (sender, sender_name, sender_mail)
+
+        return cls(
+            section=section,
+            folder=folder,
+            uid=uid,
+            message_id=str(msg_id) if msg_id else '',
+            reply_to_id=str(msg_reply_to_id) if msg_reply_to_id else '',
+            date=get_envelope_date(envelope),
+            subject=msg_subject.strip() if msg_subject else '',
+            author=author,
+            author_name=author_name,
+            author_mail=author_mail,
+            from_=from_,
+            from_name=from_name,
+            from_mail=from_mail,
+            sender=sender,
+            sender_name=sender_name,
+            sender_mail=sender_mail,
+            to=to,
+            to_name=to_name,
+            to_mail=to_mail,
+        )
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'MessageEvent':
+        """
+        Create an event from its JSON representation (see to_json()).
+
+        :param data: parsed JSON object
+        :return: event
+        """
+
+        date = data.get('date')
+        return cls(
+            section=data.get('section') or '',
+            folder=data.get('folder') or '',
+            uid=data.get('uid'),
+            date=datetime.fromisoformat(date) if date else None,
+            from_=data.get('from') or '',
+            **{
+                name: data.get(name) or ''
+                for name in cls.__slots__
+                if not name.startswith('_') and name not in ('section', 'folder', 'uid', 'date', 'from_')
+            },
+        )
+
+    def get_environment(self) -> dict[str, str]:
+        """
+        Get environment variables for callback scripts.
+        The returned dict is shared and must not be modified.
+
+        :return: environment variables
+        """
+
+        if self._environment is None:
+            object.__setattr__(self, '_environment', {
+                'MESSAGE_ID': self.message_id,
+                'MESSAGE_REPLY_TO_ID': self.reply_to_id,
+                'MESSAGE_DATE': str(self.date) if self.date else '',
+                'MESSAGE_SUBJECT': self.subject,
+                'MESSAGE_AUTHOR': self.author,
+                'MESSAGE_AUTHOR_NAME': self.author_name,
+                'MESSAGE_AUTHOR_MAIL': self.author_mail,
+                'MESSAGE_FROM': self.from_,
+                'MESSAGE_FROM_NAME': self.from_name,
+                'MESSAGE_FROM_MAIL': self.from_mail,
+                'MESSAGE_SENDER': self.sender,
+                'MESSAGE_SENDER_NAME': self.sender_name,
+                'MESSAGE_SENDER_MAIL': self.sender_mail,
+                'MESSAGE_TO': self.to,
+                'MESSAGE_TO_NAME': self.to_name,
+                'MESSAGE_TO_MAIL': self.to_mail,
+                'MESSAGE_UID': str(self.uid) if self.uid else '',
+                'MESSAGE_FOLDER': self.folder,
+            })
+        return self._environment
+
+    def to_json(self) -> str:
+        """
+        Get a JSON representation of the event.
+
+        :return: JSON object on a single line
+        """
+
+        if self._json is None:
+            object.__setattr__(self, '_json', json.dumps({
+                'section': self.section,
+                'folder': self.folder,
+                'uid': self.uid,
+                'message_id': self.message_id,
+                'reply_to_id': self.reply_to_id,
+                'date': self.date.isoformat() if self.date else None,
+                'subject': self.subject,
+                'author': self.author,
+                'author_name': self.author_name,
+                'author_mail': self.author_mail,
+                'from': self.from_,
+                'from_name': self.from_name,
+                'from_mail': self.from_mail,
+                'sender': self.sender,
+                'sender_name': self.sender_name,
+                'sender_mail': self.sender_mail,
+                'to': self.to,
+                'to_name': self.to_name,
+                'to_mail': self.to_mail,
+            }, ensure_ascii=False))
+        return self._json
+
+    def render(self, template: str) -> str:
+        """
+        Render a template with "$VARIABLE" placeholders for the environment variables of the event.
+        Unknown placeholders are kept as they are.
+
+        :param template: template text
+        :return: rendered text
+        """
+
+        if self._templates is None:
+            object.__setattr__(self, '_templates', {})
+        rendered = self._templates.get(template)
+        if rendered is None:
+            rendered = Template(template).safe_substitute(self.get_environment())
+            self._templates[template] = rendered
+        return rendered
@@ -0,0 +1,243 @@
+#
+# Copyright 2023 OpenIndex.de.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+from collections import OrderedDict
+from threading import Thread, Condition
+from time import monotonic
+from typing import Callable
+
+from . import root_logger, create_logger
+from .connector import ImapConnector
+from .spool import MessageSpooler, remove_files
+
+
+class FetchRequest:
+    """
+    Request to fetch a new message, that was reported on an IDLE connection.
+    """
+
+    __slots__ = ('name', 'connector', 'folder', 'message_number', 'items', 'deliver', 'spooler', 'queued_at')
+
+    def __init__(
+            self,
+            name: str,
+            connector: ImapConnector,
+            folder: str,
+            message_number: int,
+            items: list[str],
+            deliver: Callable[[int, dict, dict[str, str]], None],
+            spooler: MessageSpooler | None = None,
+    ):
+        self.name = name
+        self.connector = connector
+        self.folder = folder
+        self.message_number = message_number
+        self.items = items
+        self.deliver = deliver
+        self.spooler = spooler
+        self.queued_at = monotonic()
+
+    @property
+    def account(self) -> tuple:
+        """
+        Requests for the same account and folder are fetched together.
+        """
+
+        return self.connector.host, self.connector.port, self.connector.username, self.folder
+
+
+class MessageFetcher:
+    """
+    Fetches new messages on separate connections for all IDLE handlers.
+
+    IDLE handlers only queue fetch requests, so that they keep reading their IDLE connections, while messages are
+    fetched. Queued requests for the same account and folder (even from different mailbox sections) are fetched with
+    a single connection and a single FETCH command.
+
+    Each IMAP host is served by a limited number of workers at the same time. This way a slow or unreachable host
+    (waiting for connection timeouts or connection limits) does not block fetching messages from other hosts.
+    """
+
+    def __init__(self, workers: int = 4, max_queued: int = 1000, max_batch: int = 50, max_per_host: int = 2):
+        if workers < 1:
+            raise Exception('At least one fetch worker is required.')
+
+        self.__workers = workers
+        self.__max_queued = max(1, max_queued)
+        self.__max_batch = max(1, max_batch)
+        self.__max_per_host = min(workers, max(1, max_per_host))
+        self.__accounts: OrderedDict[tuple, list[FetchRequest]] = OrderedDict()
+        self.__busy_hosts: dict[str, int] = {}
+        self.__queued = 0
+        self.__condition = Condition()
+        self.__threads: list[Thread] = []
+        self.__stopped = False
+
+    def submit(self, request: FetchRequest) -> bool:
+        """
+        Queue a fetch request. This never blocks.
+
+        :param request: fetch request
+        :return: False, if the queue is full or the fetcher was stopped
+        """
+
+        with self.__condition:
+            if self.__stopped or self.__queued >= self.__max_queued:
+                return False
+
+            self.__accounts.setdefault(request.account, []).append(request)
+            self.__queued += 1
+            self.__condition.notify()
+
+            # worker threads are started on demand
+            if len(self.__threads) < self.__workers:
+                thread = Thread(target=self.__work, name='fetch-%s' % len(self.__threads), daemon=True)
+                self.__threads.append(thread)
+                thread.start()
+
+        return True
+
+    def stop(self):
+        """
+        Stop fetching. Running fetches are not interrupted, queued requests are dropped.
+        """
+
+        with self.__condition:
+            self.__stopped = True
+            self.__accounts.clear()
+            self.__queued = 0
+            self.__condition.notify_all()
+
+    def get_usage(self) -> dict[str, int]:
+        """
+        Get the number of queued requests.
+
+        :return: number of queued requests and accounts
+        """
+
+        with self.__condition:
+            return {
+                'queued': self.__queued,
+                'accounts': len(self.__accounts),
+            }
+
+    def __next(self) -> list[FetchRequest] | None:
+        """
+        Take queued requests of the account, that waits the longest and whose host is not fully occupied.
+        Must be called while holding the lock.
+
+        :return: requests for the same account and folder or None, if no account can be processed
+        """
+
+        account = next((
+            account for account in self.__accounts
+            if self.__busy_hosts.get(account[0], 0) < self.__max_per_host
+        ), None)
+        if account is None:
+            return None
+
+        requests = self.__accounts[account]
+        batch = requests[:self.__max_batch]
+        if len(requests) > len(batch):
+            # remaining requests are processed next, but after other waiting accounts
+            self.__accounts[account] = requests[len(batch):]
+            self.__accounts.move_to_end(account)
+        else:
+            del self.__accounts[account]
+        self.__queued -= len(batch)
+        self.__busy_hosts[account[0]] = self.__busy_hosts.get(account[0], 0) + 1
+        return batch
+
+    def __work(self):
+        """
+        Process queued requests.
+        """
+
+        while True:
+            with self.__condition:
+                batch = self.__next()
+                while batch is None:
+                    if self.__stopped:
+                        return
+                    self.__condition.wait()
+                    batch = self.__next()
+
+            try:
+                self.__fetch(batch)
+            except Exception as ex:
+                root_logger.exception('Unexpected fetch error. %s', str(ex))
+            finally:
+                host = batch[0].account[0]
+                with self.__condition:
+                    self.__busy_hosts[host] -= 1
+                    if self.__busy_hosts[host] < 1:
+                        del self.__busy_hosts[host]
+                    # requests of this host might wait for a worker
+                    self.__condition.notify_all()
+
+    @staticmethod
+    def __fetch(batch: list[FetchRequest]):
+        """
+        Fetch all requested messages of an account with a single connection and deliver the results.
+
+        :param batch: requests for the same account and folder
+        """
+
+        first = batch[0]
+        logger = create_logger(first.name)
+
+        message_numbers = sorted({request.message_number for request in batch})
+        items: list[str] = []
+        for request in batch:
+            items.extend(item for item in request.items if item not in items)
+
+        logger.info('Fetching envelope for message nr %s.', ', '.join(str(number) for number in message_numbers))
+
+        client = None
+        files: dict[int, dict[str, str]] = {}
+        try:
+            client = first.connector.connect(
+                select_folder=first.folder,
+                select_folder_readonly=True
+            )
+            result = client.fetch(message_numbers, items)
+
+            # message content is spooled on the same connection
+            for i, request in enumerate(batch):
+                message_result = result.get(request.message_number, {})
+                uid = message_result.get(b'UID')
+                if request.spooler and uid:
+                    request_logger = create_logger(request.name)
+                    try:
+                        files[i] = request.spooler.spool(client, uid, request_logger, message_result)
+                    except Exception as ex:
+                        request_logger.exception('Spooling message UID %s failed. %s', uid, str(ex))
+        except Exception as ex:
+            logger.exception('Separate IMAP connection failed. %s', str(ex))
+            for request_files in files.values():
+                remove_files(request_files)
+            return
+        finally:
+            first.connector.disconnect(client)
+
+        for i, request in enumerate(batch):
+            if request.message_number not in result:
+                create_logger(request.name).warning('No data found for message nr %s.', request.message_number)
+                continue
+            try:
+                request.deliver(request.message_number, result[request.message_number], files.get(i, {}))
+            except Exception as ex:
+                create_logger(request.name).exception('Callback failed. %s', str(ex))
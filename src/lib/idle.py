@@ -14,15 +14,27 @@
 # limitations under the License.
 #
 
-from threading import Thread
-from time import time, sleep
+import logging
+import sys
+from collections import deque
+from threading import Thread, Event
+from time import monotonic
+from typing import Callable
 
 from imapclient import IMAPClient
 from imapclient.response_types import Envelope
 
-from . import create_logger
+from . import create_logger, get_header_fields
+from .backfill import MessageBackfill
 from .callback import CallbackHandler
+from .client import ImapWatcherClient
 from .connector import ImapConnector
+from .event import MessageEvent
+from .fetcher import MessageFetcher, FetchRequest
+from .reconnect import ReconnectIntervals
+from .spool import MessageSpooler, remove_files
+from .startup import StartupScheduler, StartupTicket
+from .uidmap import UidMap
 
 
 class ImapIdleHandler:
@@ -31,6 +43,32 @@ class ImapIdleHandler:
     see https://imapclient.readthedocs.io/en/2.3.1/advanced.html#watching-a-mailbox-using-idle
     """
 
+    __slots__ = (
+        '__name',
+        '__folder',
+        '__connector',
+        '__callback',
+        '__startup_scheduler',
+        '__startup_ticket',
+        '__logger',
+        '__thread',
+        '__thread_stopped',
+        '__client',
+        '__lost_silently',
+        '__connected_at',
+        '__imap_error_count',
+        '__uid_map',
+        '__single_connection',
+        '__last_uid',
+        '__fetcher',
+        '__uid_updates',
+        '__spooler',
+        '__reconnect_intervals',
+        '__heartbeat_interval',
+        '__heartbeat_noop',
+        '__backfill',
+    )
+
     MAX_IMAP_ERROR_COUNT: int = 0
     """
     Maximum number of errors until an IMAP thread is stopped.
@@ -44,7 +82,7 @@ class ImapIdleHandler:
 
     SECONDS_TO_RECONNECT_AFTER: int = 600
     """
-    Number of seconds after a new IMAP connection is established.
+    Number of seconds after a new IMAP connection is established, if no reconnect intervals are learned.
     This is suggested behaviour by the IMAPClient developers.
     see https://imapclient.readthedocs.io/en/2.3.1/advanced.html#watching-a-mailbox-using-idle
     """
@@ -55,46 +93,129 @@ class ImapIdleHandler:
     As defined by the IMAP standard, we should not wait for longer than 30 seconds. 
     """
 
+    SECONDS_TO_WAIT_FOR_HEARTBEAT: int = 30
+    """
+    How many seconds the client should wait for the server to answer a heartbeat or to leave IDLE mode.
+    If the server does not answer in time, the connection is considered as lost.
+    """
+
+    SECONDS_TO_WAIT_FOR_STOP: int = 5
+    """
+    How many seconds the client should wait for the server to leave IDLE mode, when the handler is stopped.
+    The handler stops within this time, unless it is busy with fetching a message or with a reconnection.
+    """
+
     def __init__(
             self,
             name: str,
             connector: ImapConnector,
             callback: CallbackHandler,
             folder: str = 'INBOX',
+            startup_scheduler: StartupScheduler | None = None,
+            single_connection: bool = False,
+            fetcher: MessageFetcher | None = None,
+            spooler: MessageSpooler | None = None,
+            reconnect_intervals: ReconnectIntervals | None = None,
+            heartbeat_interval: int = 0,
+            heartbeat_noop: bool = False,
+            backfill: MessageBackfill | None = None,
     ):
         self.__name = name.strip()
-        self.__folder = folder.strip()
+        self.__folder = sys.intern(folder.strip())
         self.__connector = connector
         self.__callback = callback
+        self.__startup_scheduler = startup_scheduler
+        self.__startup_ticket: StartupTicket | None = None
         self.__logger = create_logger(self.__name)
 
-        # Prepare thread.
-        self.__thread = Thread(target=self.__idle)
-        self.__thread_stopped = False
+        # The thread is created on start, in order to keep idle handlers small.
+        self.__thread: Thread | None = None
+        self.__thread_stopped = Event()
+        self.__client: IMAPClient | None = None
+        self.__lost_silently = False
         self.__connected_at = None
         self.__imap_error_count = 0
-        # self.__event = Event()
+        self.__uid_map: UidMap | None = None
+
+        # messages are fetched on the IDLE connection instead of a separate connection
+        self.__single_connection = single_connection
+        self.__last_uid: int | None = None
+
+        # new messages are fetched by a shared fetcher, UIDs of fetched messages are passed back to this thread
+        self.__fetcher = fetcher
+        self.__uid_updates: deque[tuple[int, int]] | None = None
+
+        # content of new messages is written into files on the same connection, that fetches the envelope
+        self.__spooler = spooler
+
+        # reconnect intervals are learned per host, heartbeats detect silently dropped connections
+        self.__reconnect_intervals = reconnect_intervals
+        self.__heartbeat_interval = max(0, heartbeat_interval)
+        self.__heartbeat_noop = heartbeat_noop
+
+        # callbacks for existing messages are triggered by a separate thread, while the IDLE connection keeps running
+        self.__backfill = backfill
+
+    @property
+    def name(self) -> str:
+        return self.__name
+
+    @property
+    def host(self) -> str:
+        return self.__connector.host
 
     def start(self):
         """
         Start the thread.
         """
 
+        if self.__thread is None:
+            self.__thread = Thread(target=self.__idle, name=self.__name)
         self.__thread.start()
 
+        if self.__backfill:
+            if self.__callback.has_new_message_command:
+                self.__backfill.start(
+                    items=self.__get_fetch_items(),
+                    deliver=self.__deliver_backfill,
+                    logger=self.__logger,
+                )
+            else:
+                self.__logger.warning('Backfill is skipped, as no callback for new messages is configured.')
+
     def stop(self):
         """
         Stop the thread.
+        A waiting IDLE check is interrupted, so that IDLE mode is left immediately.
         """
 
-        self.__thread_stopped = True
+        self.__thread_stopped.set()
+        client = self.__client
+        if isinstance(client, ImapWatcherClient):
+            client.interrupt_idle()
+        if self.__backfill:
+            self.__backfill.stop()
 
-    def join(self):
+    def join(self, timeout: float | None = None):
         """
         Join the thread.
+
+        :param timeout: maximal number of seconds to wait or None to wait infinitely
+        """
+
+        if self.__thread:
+            self.__thread.join(timeout=timeout)
+        if self.__backfill:
+            self.__backfill.join(timeout=timeout)
+
+    def is_alive(self) -> bool:
+        """
+        Check, if the thread is running.
+
+        :return: True, if the thread is running
         """
 
-        self.__thread.join()
+        return self.__thread.is_alive() if self.__thread else False
 
     def __idle(self):
         """
@@ -105,16 +226,29 @@ class ImapIdleHandler:
         """
 
         while True:
-            if self.__thread_stopped:
+            if self.__thread_stopped.is_set():
                 self.__logger.info('Thread stopped.')
                 break
 
+            # wait for permission to connect, in order to not flood the server with logins
+            if self.__startup_scheduler:
+                self.__startup_ticket = self.__startup_scheduler.acquire(
+                    name=self.__name,
+                    host=self.__connector.host,
+                    cancel=self.__thread_stopped,
+                )
+                if not self.__startup_ticket:
+                    continue
+
+            client = None
             try:
                 client = self.__connector.connect(
                     select_folder=self.__folder,
-                    select_folder_readonly=True
+                    select_folder_readonly=True,
+                    long_lived=True,
                 )
             except Exception as ex:
+                self.__release_startup_ticket()
                 self.__logger.exception('Connection failed. %s', str(ex))
 
                 # noinspection DuplicatedCode
@@ -122,15 +256,16 @@ class ImapIdleHandler:
                     self.__imap_error_count += 1
                     if self.__imap_error_count > self.MAX_IMAP_ERROR_COUNT:
                         self.__logger.warning('Leaving the thread after %s errors.', self.__imap_error_count)
-                        return
+                        break
 
                 if self.SECONDS_TO_WAIT_AFTER_ERROR > 0:
-                    sleep(self.SECONDS_TO_WAIT_AFTER_ERROR)
+                    self.__thread_stopped.wait(self.SECONDS_TO_WAIT_AFTER_ERROR)
 
                 # Trying again.
                 continue
 
             try:
+                self.__client = client
                 self.__idle_client(client)
             except Exception as ex:
                 self.__logger.exception('IDLE failed. %s', str(ex))
@@ -140,21 +275,35 @@ class ImapIdleHandler:
                     self.__imap_error_count += 1
                     if self.__imap_error_count > self.MAX_IMAP_ERROR_COUNT:
                         self.__logger.warning('Leaving the thread after %s errors.', self.__imap_error_count)
-                        return
+                        break
 
                 if self.SECONDS_TO_WAIT_AFTER_ERROR > 0:
-                    sleep(self.SECONDS_TO_WAIT_AFTER_ERROR)
+                    self.__thread_stopped.wait(self.SECONDS_TO_WAIT_AFTER_ERROR)
 
                 # Trying again.
                 continue
 
             finally:
-                # noinspection PyBroadException
-                try:
-                    if client:
-                        client.logout()
-                except Exception:
-                    pass
+                self.__client = None
+                self.__release_startup_ticket()
+
+                if client and self.__logger.isEnabledFor(logging.DEBUG):
+                    self.__logger.debug('Traffic: %s', client.get_traffic())
+                self.__connector.disconnect(client)
+
+        if self.__startup_scheduler:
+            self.__startup_scheduler.forget(self.__name)
+
+    def __release_startup_ticket(self, idle: bool = False):
+        """
+        Give back the permission to connect.
+
+        :param idle: True, if IDLE mode was entered successfully
+        """
+
+        if self.__startup_scheduler and self.__startup_ticket:
+            self.__startup_scheduler.release(self.__startup_ticket, idle=idle)
+            self.__startup_ticket = None
 
     def __idle_client(self, client: IMAPClient):
         """
@@ -162,50 +311,154 @@ class ImapIdleHandler:
 
         As suggested bei the IMAPClient developers, we are closing the IDLE connection after a certain amount of time
         and do a reconnect (https://imapclient.readthedocs.io/en/2.3.1/advanced.html#watching-a-mailbox-using-idle).
+        The amount of time is adapted to the observed lifetime of connections to the host, if reconnect intervals are
+        learned.
 
         :param client: IMAP client
         """
 
-        if self.__thread_stopped:
+        if self.__thread_stopped.is_set():
             return
 
+        # Sequence numbers are resolved to UIDs for flag changes and expunged messages.
+        self.__uid_map = None
+        self.__uid_updates = None
+        self.__last_uid = None
+        if self.__callback.has_message_change_commands:
+            try:
+                self.__uid_map = self.__load_uid_map(client)
+            except Exception as ex:
+                raise Exception('Loading UIDs failed.') from ex
+            if len(self.__uid_map) > 0:
+                self.__last_uid = self.__uid_map.get(len(self.__uid_map))
+            if self.__fetcher:
+                self.__uid_updates = deque()
+
         # Start IDLE mode
         try:
             self.__logger.info('Enter IDLE mode.')
-            self.__connected_at = int(time())
+            self.__connected_at = monotonic()
             client.idle()
         except Exception as ex:
             raise Exception('IDLE mode failed.') from ex
 
+        self.__release_startup_ticket(idle=True)
+
+        reconnect_after = self.__reconnect_intervals.get(self.__connector.host) if self.__reconnect_intervals \
+            else self.SECONDS_TO_RECONNECT_AFTER
+        enforced_after: float | None = None
+        self.__lost_silently = False
         try:
             # self.__logger.info('Connection is now in IDLE mode.')
             while True:
-                if self.__thread_stopped:
+                if self.__thread_stopped.is_set():
                     break
 
-                # Enforce reconnection after 10 minutes.
-                if self.SECONDS_TO_RECONNECT_AFTER > 0:
-                    age = int(time()) - self.__connected_at
-                    if age > self.SECONDS_TO_RECONNECT_AFTER:
-                        self.__logger.info('Enforce reconnection.')
-                        break
+                # Enforce reconnection after the reconnect interval.
+                age = monotonic() - self.__connected_at
+                if 0 < reconnect_after < age:
+                    self.__logger.info('Enforce reconnection.')
+                    enforced_after = age
+                    break
 
                 try:
                     self.__idle_loop(client)
                     self.__imap_error_count = 0
                 except KeyboardInterrupt:
                     self.__logger.info('Stopped by keyboard interruption.')
-                    self.__thread_stopped = True
+                    self.__thread_stopped.set()
                     break
                 except Exception as ex:
-                    raise Exception('IDLE check failed.') from ex
+                    if not client.is_connection_lost():
+                        raise Exception('IDLE check failed.') from ex
+
+                # IMAPClient.idle_check() does not raise errors for closed or broken connections
+                if client.is_connection_lost():
+                    age = monotonic() - self.__connected_at
+
+                    # only silently dropped connections show the lifetime of connections to the host
+                    if not self.__lost_silently:
+                        self.__logger.warning('Connection closed by the server after %s seconds.', int(age))
+                        break
+
+                    self.__logger.warning('Connection lost after %s seconds.', int(age))
+                    if self.__reconnect_intervals:
+                        self.__reconnect_intervals.dropped(self.__connector.host, age)
+                    break
         finally:
-            # noinspection PyBroadException
-            try:
-                self.__logger.info('Leaving IDLE mode.')
-                client.idle_done()
-            except Exception:
-                pass
+            self.__leave_idle(client, enforced_after)
+
+    def __leave_idle(self, client: IMAPClient, enforced_after: float | None = None):
+        """
+        Leave IDLE mode, unless the connection was lost.
+
+        :param client: IMAP client in IDLE mode
+        :param enforced_after: connection age in seconds, if a reconnection is enforced
+        """
+
+        if client.is_connection_lost():
+            return
+
+        # a stopped handler does not wait as long for a slow server, the connection is closed without logout instead
+        timeout = self.SECONDS_TO_WAIT_FOR_STOP if self.__thread_stopped.is_set() else None
+
+        # noinspection PyBroadException
+        try:
+            self.__logger.info('Leaving IDLE mode.')
+            self.__call_with_timeout(client, client.idle_done, timeout)
+        except Exception:
+            pass
+
+        # the connection survived until reconnection, if the server answered in time
+        if enforced_after is not None and self.__reconnect_intervals:
+            if client.is_connection_lost():
+                self.__logger.warning('Connection lost after %s seconds.', int(enforced_after))
+                self.__reconnect_intervals.dropped(self.__connector.host, enforced_after)
+            else:
+                self.__reconnect_intervals.survived(self.__connector.host, enforced_after)
+
+    def __call_with_timeout(self, client: IMAPClient, function: Callable, timeout: float | None = None):
+        """
+        Call a function, that waits for a server response, with a limited socket timeout.
+        If the server does not answer in time, the connection is marked as lost by the client.
+
+        :param client: IMAP client
+        :param function: function to call
+        :param timeout: number of seconds to wait or None to wait for SECONDS_TO_WAIT_FOR_HEARTBEAT
+        :return: result of the function
+        """
+
+        sock = client.socket()
+        previous_timeout = sock.gettimeout()
+        sock.settimeout(timeout if timeout is not None else self.SECONDS_TO_WAIT_FOR_HEARTBEAT)
+        try:
+            return function()
+        finally:
+            if not client.is_connection_lost():
+                sock.settimeout(previous_timeout)
+
+    def __heartbeat(self, client: IMAPClient) -> list:
+        """
+        Restart IDLE mode (and send NOOP, if configured) in order to check, whether the server is still reachable.
+        This also resets idle timers of the server and of NAT gateways on the way.
+
+        :param client: IMAP client in IDLE mode
+        :return: responses received while leaving IDLE mode
+        """
+
+        def restart() -> list:
+            _, done_responses = client.idle_done()
+            noop_responses = client.noop()[1] if self.__heartbeat_noop else []
+            client.idle()
+            return [*done_responses, *noop_responses]
+
+        self.__logger.debug('Sending heartbeat.')
+        try:
+            return self.__call_with_timeout(client, restart)
+        except Exception:
+            # the connection was dropped silently, if the heartbeat was not answered
+            self.__lost_silently = client.is_connection_lost()
+            raise
 
     def __idle_loop(self, client: IMAPClient):
         """
@@ -215,24 +468,307 @@ class ImapIdleHandler:
         """
 
         responses = client.idle_check(timeout=self.SECONDS_TO_WAIT_FOR_IDLE_RESPONSE)
+        if client.is_connection_lost():
+            # a server, that closes the connection on purpose, says goodbye (e.g. "* BYE" on shutdown)
+            self.__lost_silently = not responses
+            return
+
+        # check a silent connection with a heartbeat, unless the check was interrupted by stop()
+        if not responses and 0 < self.__heartbeat_interval <= client.get_idle_seconds() \
+                and not self.__thread_stopped.is_set():
+            responses = self.__heartbeat(client)
+
+        # UIDs of messages, that were fetched by the shared fetcher in the meantime
+        while self.__uid_updates:
+            sequence_number, uid = self.__uid_updates.popleft()
+            if self.__uid_map.get(sequence_number) is None:
+                self.__uid_map.set(sequence_number, uid)
+
         if not responses:
             return
 
-        self.__logger.info('Received: %s', str(responses))
+        if self.__logger.isEnabledFor(logging.DEBUG):
+            self.__logger.debug('Received: %s', responses)
+        if self.__uid_map is not None:
+            self.__process_message_changes(responses)
+            if any(type(response) is tuple and response[1:2] == (b'EXISTS',) for response in responses):
+                self.__fetch_unknown_uids(client)
+
         message_nr = self.__get_new_message_number(responses)
-        if not message_nr:
+        if not message_nr or not self.__callback.has_new_message_command:
             # self.__logger.info('Ignore message.')
             return
 
-        self.__logger.info('Fetching envelope for message nr %s.', message_nr)
-        envelope = self.__get_message_envelope(message_nr)
-        if not envelope:
+        if self.__single_connection:
+            messages = self.__fetch_on_idle_connection(client, message_nr)
+        elif self.__fetcher:
+            # keep reading the IDLE connection, while the message is fetched
+            queued = self.__fetcher.submit(FetchRequest(
+                name=self.__name,
+                connector=self.__connector,
+                folder=self.__folder,
+                message_number=message_nr,
+                items=self.__get_fetch_items(),
+                deliver=self.__deliver_message,
+                spooler=self.__spooler,
+            ))
+            if not queued:
+                self.__logger.error('Fetch queue is full. Dropped message nr %s.', message_nr)
+            return
+        else:
+            self.__logger.info('Fetching envelope for message nr %s.', message_nr)
+            message = self.__get_message_envelope(message_nr)
+            messages = [(message_nr, *message)] if message else []
+
+        for sequence_number, envelope, headers, uid, files in messages:
+            if uid and self.__uid_map is not None:
+                self.__uid_map.set(sequence_number, uid)
+
+            try:
+                self.__trigger_new_message(envelope, headers, uid, files)
+            except Exception as ex:
+                remove_files(files)
+                self.__logger.exception('Callback failed. %s', str(ex))
+
+    def __deliver_message(self, message_number: int, message_result: dict, files: dict[str, str]):
+        """
+        Trigger the callback for a message, that was fetched by the shared fetcher.
+        This is called by a fetcher thread.
+
+        :param message_number: sequence number of the message
+        :param message_result: fetched data of the message
+        :param files: paths of spooled files
+        """
+
+        message = self.__parse_message(message_result)
+        if not message:
+            remove_files(files)
+            self.__logger.warning('No envelope data found for message nr %s.', message_number)
             return
 
+        envelope, headers, uid = message
+        uid_updates = self.__uid_updates
+        if uid and uid_updates is not None:
+            uid_updates.append((message_number, uid))
+
         try:
-            self.__callback.trigger_new_message_command(envelope=envelope)
+            self.__trigger_new_message(envelope, headers, uid, files)
+        except Exception:
+            remove_files(files)
+            raise
+
+    def __deliver_backfill(self, message_result: dict, uid: int, files: dict[str, str]):
+        """
+        Trigger the callback for an existing message, that was fetched by the backfill.
+        This is called by the backfill thread.
+
+        :param message_result: fetched data of the message
+        :param uid: UID of the message
+        :param files: paths of spooled files
+        """
+
+        message = self.__parse_message(message_result)
+        if not message:
+            remove_files(files)
+            self.__logger.warning('No envelope data found for message UID %s.', uid)
+            return
+
+        envelope, headers, _ = message
+        try:
+            self.__trigger_new_message(envelope, headers, uid, files)
+        except Exception:
+            remove_files(files)
+            raise
+
+    def __trigger_new_message(
+            self,
+            envelope: Envelope,
+            headers: dict[str, str],
+            uid: int | None,
+            files: dict[str, str],
+    ):
+        """
+        Trigger the callback for a new message.
+
+        :param envelope: message envelope
+        :param headers: additional message headers
+        :param uid: UID of the message or None, if not known
+        :param files: paths of spooled files, these are removed after the callback finished
+        """
+
+        event = MessageEvent.from_envelope(section=self.__name, folder=self.__folder, envelope=envelope, uid=uid)
+        self.__callback.trigger_new_message_command(event=event, headers=headers, files=files)
+
+    def __spool(self, client: IMAPClient, uid: int | None, message_result: dict) -> dict[str, str]:
+        """
+        Write the content of a new message into files, if spooling is enabled.
+
+        :param client: IMAP client with the folder selected
+        :param uid: UID of the message
+        :param message_result: fetched data of the message
+        :return: paths of spooled files
+        """
+
+        if not self.__spooler or not uid:
+            return {}
+        try:
+            return self.__spooler.spool(client, uid, self.__logger, message_result)
+        except Exception as ex:
+            self.__logger.exception('Spooling message UID %s failed. %s', uid, str(ex))
+            return {}
+
+    def __fetch_on_idle_connection(
+            self,
+            client: IMAPClient,
+            message_number: int,
+    ) -> list[tuple[int, Envelope, dict[str, str], int | None, dict[str, str]]]:
+        """
+        Leave IDLE mode, fetch new messages on the same connection and enter IDLE mode again.
+
+        After the UID of the latest message is known, all messages with a greater UID are fetched with a single
+        UID FETCH command. This way messages are not missed, if the server reports multiple messages at once.
+
+        :param client: IMAP client in IDLE mode
+        :param message_number: sequence number of the new message
+        :return: sequence number, envelope, headers, UID and spooled files of each new message
+        """
+
+        _, responses = client.idle_done()
+        if responses and self.__uid_map is not None:
+            self.__process_message_changes(responses)
+
+        messages: list[tuple[int, Envelope, dict[str, str], int | None, dict[str, str]]] = []
+        message_results: list[dict] = []
+        use_uid = client.use_uid
+        try:
+            if self.__last_uid:
+                self.__logger.info('Fetching envelopes for messages with UID %s:*.', self.__last_uid + 1)
+                client.use_uid = True
+                result = client.fetch('%s:*' % (self.__last_uid + 1), self.__get_fetch_items())
+            else:
+                self.__logger.info('Fetching envelope for message nr %s.', message_number)
+                client.use_uid = False
+                result = client.fetch([message_number], self.__get_fetch_items())
+
+            for key, message_result in result.items():
+                message = self.__parse_message(message_result)
+                if not message:
+                    continue
+                # results of UID FETCH are keyed by UID
+                envelope, headers, uid = message
+                uid = key if client.use_uid else uid
+                # "UID FETCH n:*" returns the latest message, even if its UID is lower than n
+                if self.__last_uid and (not uid or uid <= self.__last_uid):
+                    continue
+                messages.append((message_result.get(b'SEQ', message_number), envelope, headers, uid, {}))
+                message_results.append(message_result)
+
+            for message, message_result in zip(messages, message_results):
+                message[4].update(self.__spool(client, message[3], message_result))
+
         except Exception as ex:
-            self.__logger.exception('Callback failed. %s', str(ex))
+            self.__logger.exception('Fetching on IDLE connection failed. %s', str(ex))
+
+        finally:
+            client.use_uid = use_uid
+            client.idle()
+
+        messages.sort(key=lambda m: m[0])
+        for message in messages:
+            if message[3]:
+                self.__last_uid = max(self.__last_uid or 0, message[3])
+        return messages
+
+    def __fetch_unknown_uids(self, client: IMAPClient):
+        """
+        Fetch UIDs of new messages on the IDLE connection, so that later flag changes and expunged messages can be
+        resolved to UIDs. All messages starting with the first unknown UID are fetched with a single command, even if
+        the server reported multiple new messages at once.
+
+        :param client: IMAP client in IDLE mode
+        """
+
+        first = self.__uid_map.get_first_unknown()
+        if first is None:
+            return
+
+        _, responses = client.idle_done()
+        if responses:
+            self.__process_message_changes(responses)
+
+        use_uid = client.use_uid
+        try:
+            client.use_uid = False
+            for sequence_number, data in client.fetch('%s:*' % first, ['UID']).items():
+                uid = data.get(b'UID')
+                if uid:
+                    self.__uid_map.set(sequence_number, uid)
+        except Exception as ex:
+            self.__logger.warning('Can\'t fetch UIDs of new messages. %s', str(ex))
+        finally:
+            client.use_uid = use_uid
+            client.idle()
+
+    @staticmethod
+    def __load_uid_map(client: IMAPClient) -> UidMap:
+        """
+        Load UIDs of all messages in the selected folder.
+
+        :param client: IMAP client
+        :return: map of sequence numbers to UIDs
+        """
+
+        use_uid = client.use_uid
+        client.use_uid = True
+        try:
+            return UidMap(sorted(client.search('ALL')))
+        finally:
+            client.use_uid = use_uid
+
+    def __process_message_changes(self, responses):
+        """
+        Update the map of sequence numbers to UIDs and run callbacks for flag changes and expunged messages.
+
+        Responses for flag changes should look somehow like
+        [(3, b'FETCH', (b'FLAGS', (b'\\Seen',), b'UID', 103)), (2, b'EXPUNGE')]
+
+        :param responses: received IMAP idle responses
+        """
+
+        if not (type(responses) is list):
+            return
+
+        for response in responses:
+            if not (type(response) is tuple) or len(response) < 2 or not isinstance(response[0], int):
+                continue
+
+            sequence_number, kind = response[0], response[1]
+            try:
+                if kind == b'EXISTS':
+                    self.__uid_map.exists(sequence_number)
+
+                elif kind == b'EXPUNGE':
+                    uid = self.__uid_map.expunge(sequence_number)
+                    self.__callback.trigger_message_expunged_command(uid=uid, sequence_number=sequence_number)
+
+                elif kind == b'FETCH' and len(response) > 2 and type(response[2]) is tuple:
+                    data = response[2]
+                    items = {data[i]: data[i + 1] for i in range(0, len(data) - 1, 2)}
+                    if b'FLAGS' not in items:
+                        continue
+                    uid = items.get(b'UID')
+                    if uid:
+                        self.__uid_map.set(sequence_number, uid)
+                    else:
+                        uid = self.__uid_map.get(sequence_number)
+                    self.__callback.trigger_message_flags_changed_command(
+                        uid=uid,
+                        sequence_number=sequence_number,
+                        flags=items[b'FLAGS'],
+                    )
+
+            except Exception as ex:
+                self.__logger.exception('Callback failed. %s', str(ex))
 
     @staticmethod
     def __get_new_message_number(responses) -> int | None:
@@ -273,13 +809,50 @@ class ImapIdleHandler:
 
         return None
 
-    def __get_message_envelope(self, message_number) -> Envelope | None:
+    def __get_fetch_items(self) -> list[str]:
+        """
+        Get the items to fetch for a new message.
+
+        :return: fetch items
+        """
+
+        # sizes are fetched along with the envelope, so that large messages are not spooled
+        items = ['ENVELOPE', 'UID', *(self.__spooler.fetch_items if self.__spooler else [])]
+
+        header_names = self.__callback.headers
+        if not header_names:
+            return items
+        return [*items, 'BODY.PEEK[HEADER.FIELDS (%s)]' % ' '.join(header_names).upper()]
+
+    @staticmethod
+    def __parse_message(message_result: dict) -> tuple[Envelope, dict[str, str], int | None] | None:
         """
-        Get envelope data for a certain message.
+        Get envelope, headers and UID from fetched message data.
+
+        :param message_result: fetched data of a message
+        :return: message envelope, headers with lower case names and UID or None, if no envelope was fetched
+        """
+
+        if b'ENVELOPE' not in message_result:
+            return None
+
+        headers: dict[str, str] = {}
+        for key, value in message_result.items():
+            if isinstance(key, bytes) and key.startswith(b'BODY[HEADER.FIELDS') and isinstance(value, bytes):
+                headers = get_header_fields(value)
+
+        return message_result[b'ENVELOPE'], headers, message_result.get(b'UID')
+
+    def __get_message_envelope(
+            self,
+            message_number,
+    ) -> tuple[Envelope, dict[str, str], int | None, dict[str, str]] | None:
+        """
+        Get envelope data and headers required by the callback for a certain message.
         We are using a separate client connection in order to keep the IDLE connection untouched.
 
         :param message_number: message number to fetch
-        :return: message envelope or None, if not found
+        :return: message envelope, headers with lower case names, UID and spooled files or None, if not found
         """
 
         client = None
@@ -289,26 +862,21 @@ class ImapIdleHandler:
                 select_folder_readonly=True
             )
 
-            result = client.fetch([message_number], ['ENVELOPE'])
+            result = client.fetch([message_number], self.__get_fetch_items())
             if message_number not in result:
                 self.__logger.warning('No data found for message nr %s.', message_number)
                 return None
 
-            message_result = result[message_number]
-            if b'ENVELOPE' not in message_result:
+            message = self.__parse_message(result[message_number])
+            if not message:
                 self.__logger.warning('No envelope data found for message nr %s.', message_number)
                 return None
 
-            return message_result[b'ENVELOPE']
+            return *message, self.__spool(client, message[2], result[message_number])
 
         except Exception as ex:
             self.__logger.exception('Separate IMAP connection failed. %s', str(ex))
             return None
 
         finally:
-            # noinspection PyBroadException
-            try:
-                if client:
-                    client.logout()
-            except Exception:
-                pass
+            self.__connector.disconnect(client)
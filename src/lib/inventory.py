@@ -0,0 +1,503 @@
+#
+# Copyright 2023 OpenIndex.de.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import csv
+import glob
+import json
+import os
+import sqlite3
+from configparser import ConfigParser
+from hashlib import blake2b
+from typing import BinaryIO, Iterator
+from urllib.request import pathname2url
+
+from . import root_logger
+
+
+def get_options_fingerprint(options: dict[str, str]) -> str:
+    """
+    Get a comparable representation of account options.
+
+    :param options: option names and values
+    :return: digest of all options
+    """
+
+    digest = blake2b(digest_size=16)
+    for key, value in sorted(options.items()):
+        digest.update(key.encode('utf-8', errors='replace'))
+        digest.update(b'\0')
+        digest.update(str(value).encode('utf-8', errors='replace'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def get_file_state(path: str) -> tuple[int, int] | None:
+    """
+    Get modification time and size of a file.
+
+    :param path: file path
+    :return: modification time in nanoseconds and size or None, if the file does not exist
+    """
+
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+class Inventory:
+    """
+    Source of mailbox accounts.
+
+    Accounts are identified by their name and provide the same options as a mailbox section within the configuration
+    file. Inventories provide cheap fingerprints of all accounts, so that only added or changed accounts are loaded.
+    """
+
+    def get_fingerprints(self) -> dict[str, str]:
+        """
+        Get fingerprints of all accounts.
+
+        :return: fingerprint for each account name
+        """
+
+        raise NotImplementedError()
+
+    def load(self, name: str) -> dict[str, str] | None:
+        """
+        Load options of an account.
+
+        :param name: account name
+        :return: option names and values or None, if the account does not exist
+        """
+
+        raise NotImplementedError()
+
+    def has_changed(self) -> bool:
+        """
+        Check, if the source of accounts was modified since fingerprints were requested the last time.
+
+        :return: True, if the source was modified
+        """
+
+        return True
+
+
+class ConfigInventory(Inventory):
+    """
+    Accounts from mailbox sections of a configuration.
+    """
+
+    def __init__(self, config: ConfigParser, exclude: tuple[str, ...] = ()):
+        self.__config = config
+        self.__exclude = exclude
+
+    def get_fingerprints(self) -> dict[str, str]:
+        return {
+            section: get_options_fingerprint(dict(self.__config.items(section, raw=True)))
+            for section in self.__config.sections() if section not in self.__exclude
+        }
+
+    def load(self, name: str) -> dict[str, str] | None:
+        if name in self.__exclude or not self.__config.has_section(name):
+            return None
+        return dict(self.__config.items(name))
+
+    def has_changed(self) -> bool:
+        return False
+
+
+class DirectoryInventory(Inventory):
+    """
+    Accounts from a directory of INI files.
+    Each file might contain one or more sections. Only new or modified files are parsed again. Only fingerprints are
+    kept in memory, the options of an account are read from its file on request.
+    """
+
+    def __init__(self, path: str, pattern: str = '*.ini'):
+        self.__path = path
+        self.__pattern = pattern
+        self.__files: dict[str, tuple[tuple[int, int], dict[str, str]]] = {}
+        self.__states: dict[str, tuple[int, int]] | None = None
+        self.__owners: dict[str, str] = {}
+        self.__fingerprints: dict[str, str] = {}
+
+    def get_fingerprints(self) -> dict[str, str]:
+        states = self.__get_states()
+        if states == self.__states:
+            return {**self.__fingerprints}
+
+        files: dict[str, tuple[tuple[int, int], dict[str, str]]] = {}
+        owners: dict[str, str] = {}
+        fingerprints: dict[str, str] = {}
+
+        for file, state in sorted(states.items()):
+            cached = self.__files.get(file)
+            if cached and cached[0] == state:
+                files[file] = cached
+            else:
+                # keep previously loaded accounts of a broken file
+                sections = self.__read(file)
+                files[file] = (state, {
+                    section: get_options_fingerprint(options) for section, options in sections.items()
+                }) if sections is not None else (state, cached[1] if cached else {})
+
+            for section, fingerprint in files[file][1].items():
+                if section in fingerprints:
+                    root_logger.warning('Ignoring duplicate account "%s" in "%s".', section, file)
+                    continue
+                fingerprints[section] = fingerprint
+                owners[section] = file
+
+        self.__files = files
+        self.__states = states
+        self.__owners = owners
+        self.__fingerprints = fingerprints
+        return {**fingerprints}
+
+    def load(self, name: str) -> dict[str, str] | None:
+        file = self.__owners.get(name)
+        if not file:
+            return None
+        sections = self.__read(file)
+        options = sections.get(name) if sections else None
+        return {**options} if options is not None else None
+
+    def has_changed(self) -> bool:
+        return self.__get_states() != self.__states
+
+    def __get_states(self) -> dict[str, tuple[int, int]]:
+        """
+        Get modification time and size of all account files.
+
+        :return: state for each file
+        """
+
+        states: dict[str, tuple[int, int]] = {}
+        for file in glob.glob(os.path.join(self.__path, self.__pattern)):
+            state = get_file_state(file)
+            if state:
+                states[file] = state
+        return states
+
+    @staticmethod
+    def __read(file: str) -> dict[str, dict[str, str]] | None:
+        """
+        Read accounts from an INI file.
+
+        :param file: file path
+        :return: options for each section or None, if the file is not readable
+        """
+
+        config = ConfigParser()
+        try:
+            with open(file, 'r', encoding='utf-8') as f:
+                config.read_file(f, source=file)
+        except Exception as ex:
+            root_logger.error('Can\'t read account file "%s". %s', file, str(ex))
+            return None
+
+        try:
+            return {section: dict(config.items(section)) for section in config.sections()}
+        except Exception as ex:
+            root_logger.error('Can\'t read account file "%s". %s', file, str(ex))
+            return None
+
+
+class TableFileInventory(Inventory):
+    """
+    Accounts from a CSV file (with a header line) or a JSON lines file.
+    Each row / line contains the options of an account, the account name is taken from the "name" column.
+
+    Only fingerprints and the position of each account within the file are kept in memory, the options of an account
+    are read from its position on request.
+    """
+
+    NAME_COLUMN: str = 'name'
+    """
+    Column, that contains the account name.
+    """
+
+    def __init__(self, path: str):
+        self.__path = path
+        self.__is_json = path.lower().endswith(('.jsonl', '.ndjson', '.json'))
+        self.__state: tuple[int, int] | None = None
+        self.__header: list[str] | None = None
+        self.__offsets: dict[str, int] = {}
+        self.__fingerprints: dict[str, str] = {}
+
+    def get_fingerprints(self) -> dict[str, str]:
+        state = get_file_state(self.__path)
+        if state != self.__state:
+            if state:
+                self.__scan()
+            else:
+                self.__offsets = {}
+                self.__fingerprints = {}
+            self.__state = state
+
+        return {**self.__fingerprints}
+
+    def load(self, name: str) -> dict[str, str] | None:
+        # positions are only valid for the scanned file
+        if get_file_state(self.__path) != self.__state:
+            self.get_fingerprints()
+
+        offset = self.__offsets.get(name)
+        if offset is None:
+            return None
+
+        try:
+            with open(self.__path, 'rb') as f:
+                f.seek(offset)
+                row = next(self.__read_rows(f, self.__header), (None, None))[1]
+        except Exception as ex:
+            root_logger.error('Can\'t read account file "%s". %s', self.__path, str(ex))
+            return None
+
+        account = self.__parse_row(row)
+        return account[1] if account and account[0] == name else None
+
+    def has_changed(self) -> bool:
+        return get_file_state(self.__path) != self.__state
+
+    def __scan(self):
+        """
+        Read all accounts from the file and remember their fingerprints and positions.
+        Previously loaded accounts are kept, if the file is not readable.
+        """
+
+        offsets: dict[str, int] = {}
+        fingerprints: dict[str, str] = {}
+        try:
+            with open(self.__path, 'rb') as f:
+                header = None
+                if not self.__is_json:
+                    header = next(csv.reader(self.__read_lines(f)), None)
+                    if header is None:
+                        header = []
+
+                for offset, row in self.__read_rows(f, header):
+                    account = self.__parse_row(row)
+                    if not account:
+                        continue
+                    name, options = account
+                    if name in offsets:
+                        root_logger.warning('Ignoring duplicate account "%s" in "%s".', name, self.__path)
+                        continue
+                    offsets[name] = offset
+                    fingerprints[name] = get_options_fingerprint(options)
+        except Exception as ex:
+            root_logger.error('Can\'t read account file "%s". %s', self.__path, str(ex))
+            return
+
+        self.__header = header
+        self.__offsets = offsets
+        self.__fingerprints = fingerprints
+
+    @staticmethod
+    def __read_lines(f: BinaryIO) -> Iterator[str]:
+        """
+        Read decoded lines from the current position of a file, without reading ahead.
+
+        :param f: file opened in binary mode
+        :return: lines including line breaks
+        """
+
+        while True:
+            line = f.readline()
+            if not line:
+                return
+            yield line.decode('utf-8')
+
+    def __read_rows(self, f: BinaryIO, header: list[str] | None) -> Iterator[tuple[int, dict | None]]:
+        """
+        Read rows from the current position of a file.
+
+        :param f: file opened in binary mode
+        :param header: column names of a CSV file or None for a JSON lines file
+        :return: position and content of each row, invalid rows are None
+        """
+
+        lines = self.__read_lines(f)
+        reader = csv.reader(lines) if header is not None else None
+        while True:
+            offset = f.tell()
+            if reader is None:
+                line = next(lines, None)
+                if line is None:
+                    return
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    yield offset, json.loads(line)
+                except ValueError as ex:
+                    root_logger.error('Invalid account at position %s of "%s". %s', offset, self.__path, ex)
+                    yield offset, None
+            else:
+                values = next(reader, None)
+                if values is None:
+                    return
+                yield offset, dict(zip(header, values))
+
+    def __parse_row(self, row: dict | None) -> tuple[str, dict[str, str]] | None:
+        """
+        Get name and options of an account from a row.
+
+        :param row: content of a row
+        :return: account name and options or None, if the row does not contain an account
+        """
+
+        if not isinstance(row, dict):
+            return None
+        name = str(row.get(self.NAME_COLUMN) or '').strip()
+        if not name:
+            return None
+
+        # empty values are omitted, so that default values are used
+        return name, {
+            str(key).strip().lower(): str(value)
+            for key, value in row.items()
+            if key and key != self.NAME_COLUMN and value is not None and str(value) != ''
+        }
+
+
+class OptionsDigest:
+    """
+    SQLite aggregate function, that calculates the fingerprint of an account from its options.
+    The result does not depend on the order of the rows.
+    """
+
+    def __init__(self):
+        self.__sum = 0
+
+    def step(self, option, value):
+        if value is None:
+            return
+        digest = blake2b(digest_size=16)
+        digest.update(str(option).strip().lower().encode('utf-8', errors='replace'))
+        digest.update(b'\0')
+        digest.update(str(value).encode('utf-8', errors='replace'))
+        self.__sum = (self.__sum + int.from_bytes(digest.digest(), 'big')) % (1 << 128)
+
+    def finalize(self):
+        return '%032x' % self.__sum
+
+
+class SqliteInventory(Inventory):
+    """
+    Accounts from a SQLite table with the columns "section", "option" and "value".
+    Fingerprints are calculated within the database and only read again, if the database was modified. The options
+    of an account are queried on request.
+    """
+
+    def __init__(self, path: str, table: str = 'accounts'):
+        if not table.replace('_', '').isalnum():
+            raise Exception('Invalid table name "%s".' % table)
+
+        self.__path = path
+        self.__table = table
+        self.__state: tuple | None = None
+        self.__fingerprints: dict[str, str] = {}
+
+    def get_fingerprints(self) -> dict[str, str]:
+        state = self.__get_state()
+        if state == self.__state:
+            return {**self.__fingerprints}
+
+        try:
+            rows = self.__query('SELECT section, options_digest(option, value) FROM %s GROUP BY section' % self.__table)
+        except Exception as ex:
+            # keep previously loaded accounts, if the database is not available temporarily
+            root_logger.error('Can\'t read accounts from "%s". %s', self.__path, str(ex))
+            return {**self.__fingerprints}
+
+        self.__state = state
+        self.__fingerprints = {str(section): fingerprint for section, fingerprint in rows}
+        return {**self.__fingerprints}
+
+    def load(self, name: str) -> dict[str, str] | None:
+        rows = self.__query('SELECT option, value FROM %s WHERE section = ?' % self.__table, (name,))
+        if not rows:
+            return None
+        return {str(option).strip().lower(): str(value) for option, value in rows if value is not None}
+
+    def has_changed(self) -> bool:
+        return self.__get_state() != self.__state
+
+    def __get_state(self) -> tuple:
+        """
+        Get modification time and size of the database and its write-ahead log.
+
+        :return: state of the database files
+        """
+
+        return get_file_state(self.__path), get_file_state('%s-wal' % self.__path)
+
+    def __query(self, query: str, parameters: tuple = ()) -> list[tuple]:
+        """
+        Run a query on a read only connection.
+
+        :param query: SQL query
+        :param parameters: query parameters
+        :return: result rows
+        """
+
+        try:
+            connection = sqlite3.connect('file:%s?mode=ro' % pathname2url(self.__path), uri=True)
+            connection.create_aggregate('options_digest', 2, OptionsDigest)
+        except sqlite3.Error as ex:
+            raise Exception('Can\'t open account database "%s".' % self.__path) from ex
+
+        try:
+            return connection.execute(query, parameters).fetchall()
+        except sqlite3.Error as ex:
+            raise Exception('Can\'t query account database "%s".' % self.__path) from ex
+        finally:
+            connection.close()
+
+
+class CombinedInventory(Inventory):
+    """
+    Accounts from multiple inventories.
+    If an account name is provided by multiple inventories, the first one is used.
+    """
+
+    def __init__(self, inventories: list[Inventory]):
+        self.__inventories = inventories
+        self.__owners: dict[str, Inventory] = {}
+
+    def get_fingerprints(self) -> dict[str, str]:
+        owners: dict[str, Inventory] = {}
+        fingerprints: dict[str, str] = {}
+        for inventory in self.__inventories:
+            for name, fingerprint in inventory.get_fingerprints().items():
+                if name in fingerprints:
+                    root_logger.warning('Ignoring duplicate account "%s".', name)
+                    continue
+                fingerprints[name] = fingerprint
+                owners[name] = inventory
+
+        self.__owners = owners
+        return fingerprints
+
+    def load(self, name: str) -> dict[str, str] | None:
+        inventory = self.__owners.get(name)
+        return inventory.load(name) if inventory else None
+
+    def has_changed(self) -> bool:
+        return any(inventory.has_changed() for inventory in self.__inventories)
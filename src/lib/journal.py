@@ -0,0 +1,211 @@
+#
+# Copyright 2023 OpenIndex.de.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import gzip
+import json
+import os
+import shutil
+from datetime import datetime
+from threading import Thread, Lock
+from time import time
+from typing import Iterator, TextIO
+
+from . import root_logger
+from .event import MessageEvent
+
+JOURNAL_FILE: str = 'events.jsonl'
+"""
+Name of the journal file, that is currently written.
+Rotated files are named "events-<timestamp>.jsonl.gz".
+"""
+
+
+def get_journal_files(directory: str) -> list[str]:
+    """
+    Get the journal files of a directory in chronological order.
+
+    :param directory: journal directory
+    :return: paths of rotated files followed by the current file
+    """
+
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return []
+
+    # an uncompressed file is still complete, while it is compressed
+    rotated = sorted(
+        name for name in names
+        if name.startswith('events-') and (
+            name.endswith('.jsonl') or (name.endswith('.jsonl.gz') and name[:-3] not in names)
+        )
+    )
+    files = [os.path.join(directory, name) for name in rotated]
+    if JOURNAL_FILE in names:
+        files.append(os.path.join(directory, JOURNAL_FILE))
+    return files
+
+
+def read_journal(
+        directory: str,
+        start: float | None = None,
+        end: float | None = None,
+) -> Iterator[tuple[float, dict]]:
+    """
+    Read recorded events of a time range in order of their recording.
+    Incomplete lines (e.g. written while the application crashed) are skipped.
+
+    :param directory: journal directory
+    :param start: timestamp of the first event or None to start with the oldest event
+    :param end: timestamp after the last event or None to read until the latest event
+    :return: recording timestamps and events
+    """
+
+    for path in get_journal_files(directory):
+        opener = gzip.open if path.endswith('.gz') else open
+        try:
+            with opener(path, 'rt', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        data: dict = json.loads(line)
+                        recorded_at = float(data.pop('time'))
+                    except (ValueError, TypeError, KeyError, AttributeError):
+                        continue
+                    if start is not None and recorded_at < start:
+                        continue
+                    # the clock might have been set back, so later lines might still be within the range
+                    if end is not None and recorded_at >= end:
+                        continue
+                    yield recorded_at, data
+        except FileNotFoundError:
+            # the file was rotated in the meantime
+            continue
+
+
+class EventJournal:
+    """
+    Records new message events in an append-only journal, so that they can be replayed later.
+
+    Each event is written as a single JSON line with its recording timestamp. If the journal file exceeds the maximal
+    size, it is renamed and compressed in the background. The oldest rotated files are removed, if there are more than
+    the maximal number of files.
+    """
+
+    def __init__(
+            self,
+            directory: str,
+            max_size: int = 67108864,
+            max_files: int = 10,
+    ):
+        self.__directory = directory.strip()
+        self.__max_size = max(1024, max_size)
+        self.__max_files = max(1, max_files)
+        self.__file: TextIO | None = None
+        self.__size = 0
+        self.__lock = Lock()
+
+        try:
+            os.makedirs(self.__directory, exist_ok=True)
+        except OSError as ex:
+            raise Exception('Can\'t create journal directory "%s".' % self.__directory) from ex
+
+    def record(self, event: MessageEvent):
+        """
+        Append an event to the journal.
+
+        :param event: new message
+        """
+
+        data = event.to_json()[1:]
+        with self.__lock:
+            # the recording timestamp is added to the cached JSON of the event, lines are written in order of their time
+            line = '{"time": %.3f, %s\n' % (time(), data)
+            try:
+                if self.__file is None:
+                    self.__open()
+                self.__file.write(line)
+                self.__file.flush()
+                self.__size += len(line.encode('utf-8'))
+                if self.__size >= self.__max_size:
+                    self.__rotate()
+            except Exception as ex:
+                root_logger.warning('Can\'t write journal in "%s". %s', self.__directory, str(ex))
+                self.__close()
+
+    def close(self):
+        """
+        Close the journal file.
+        """
+
+        with self.__lock:
+            self.__close()
+
+    def __open(self):
+        """
+        Open the journal file for appending.
+        Must be called while holding the lock.
+        """
+
+        path = os.path.join(self.__directory, JOURNAL_FILE)
+        self.__file = open(path, 'a', encoding='utf-8')
+        self.__size = self.__file.tell()
+
+    def __close(self):
+        """
+        Close the journal file.
+        Must be called while holding the lock.
+        """
+
+        if self.__file is None:
+            return
+        try:
+            self.__file.close()
+        except OSError:
+            pass
+        self.__file = None
+
+    def __rotate(self):
+        """
+        Rename the journal file and compress it in the background.
+        Must be called while holding the lock.
+        """
+
+        self.__close()
+        path = os.path.join(self.__directory, 'events-%s.jsonl' % datetime.now().strftime('%Y%m%d-%H%M%S-%f'))
+        os.replace(os.path.join(self.__directory, JOURNAL_FILE), path)
+        Thread(target=self.__compress, args=(path,), name='journal', daemon=True).start()
+
+    def __compress(self, path: str):
+        """
+        Compress a rotated journal file and remove the oldest rotated files.
+
+        :param path: path of the rotated file
+        """
+
+        try:
+            with open(path, 'rb') as source, gzip.open('%s.gz.tmp' % path, 'wb') as target:
+                shutil.copyfileobj(source, target)
+            os.replace('%s.gz.tmp' % path, '%s.gz' % path)
+            os.remove(path)
+        except Exception as ex:
+            root_logger.warning('Can\'t compress journal file "%s". %s', path, str(ex))
+
+        rotated = [file for file in get_journal_files(self.__directory) if not file.endswith(JOURNAL_FILE)]
+        for file in rotated[:-self.__max_files]:
+            try:
+                os.remove(file)
+            except OSError as ex:
+                root_logger.warning('Can\'t remove journal file "%s". %s', file, str(ex))
@@ -0,0 +1,323 @@
+#
+# Copyright 2023 OpenIndex.de.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import math
+import os
+import socket
+import sqlite3
+from threading import Thread, Lock, Event
+from time import time, monotonic
+from typing import Callable
+
+from . import root_logger
+from .inventory import Inventory
+
+
+class SectionLeases:
+    """
+    Coordinates multiple instances, that watch the same accounts.
+
+    Each account is owned by a single instance at a time. Ownership is stored as leases in a SQLite database, that is
+    shared by all instances. Leases are balanced across all running instances, each instance owns at most its fair
+    share.
+
+    Leases are renewed regularly by incrementing their version. Other instances consider a lease as expired, if its
+    version did not change for the lease duration, measured by their own monotonic clock. This way the clocks of the
+    instances don't need to be synchronized. An instance gives up its accounts, if it could not renew its leases within
+    the lease duration minus the time to stop handlers, so that its handlers are stopped before other instances take
+    over. Leases above the fair share are kept and renewed until their handlers have stopped, they are removed
+    afterwards, so that other instances can take over immediately.
+    """
+
+    def __init__(self, path: str, owner: str | None = None, ttl: float = 10.0, stop_timeout: float = 5.0):
+        if ttl <= stop_timeout:
+            raise Exception('The lease duration must be longer than %s seconds, that are required to stop handlers.'
+                            % stop_timeout)
+
+        self.__path = path
+        self.__owner = owner.strip() if owner and owner.strip() else '%s:%s' % (socket.gethostname(), os.getpid())
+        self.__ttl = ttl
+        self.__stop_timeout = stop_timeout
+        self.__owned: set[str] = set()
+        self.__sections: list[str] = []
+        self.__observed: dict[tuple[str, str], tuple[tuple[str, int], float]] = {}
+        self.__get_running: Callable[[], set[str]] | None = None
+        self.__renewed_at = monotonic()
+        self.__lock = Lock()
+        self.__changed = Event()
+        self.__stopped = Event()
+        self.__thread: Thread | None = None
+        self.__create_tables()
+
+    @property
+    def owner(self) -> str:
+        return self.__owner
+
+    @property
+    def renew_interval(self) -> float:
+        """
+        Number of seconds between renewals, leases are renewed five times within their duration.
+        """
+
+        return self.__ttl / 5
+
+    def update(self, sections: list[str]) -> set[str]:
+        """
+        Renew owned leases, hand over leases above the fair share and acquire free leases up to the fair share.
+
+        :param sections: names of all accounts
+        :return: names of the owned accounts
+        """
+
+        with self.__lock:
+            previous = self.__owned
+            self.__sections = list(sections)
+            running = self.__get_running() if self.__get_running else set()
+            try:
+                self.__owned = self.__update(self.__sections, running)
+                self.__renewed_at = monotonic()
+            except Exception as ex:
+                root_logger.error('Can\'t update leases in "%s". %s', self.__path, str(ex))
+
+                # other instances take over after the lease duration, handlers must be stopped before
+                if self.__owned and monotonic() - self.__renewed_at >= self.__ttl - self.__stop_timeout:
+                    root_logger.warning('Leases of %s accounts expired.', len(self.__owned))
+                    self.__owned = set()
+
+            if self.__owned != previous:
+                self.__changed.set()
+            return set(self.__owned)
+
+    def start(self, get_running: Callable[[], set[str]] | None = None):
+        """
+        Start renewing leases in a background thread.
+        Renewals must not be delayed by starting or stopping handlers, otherwise leases might expire.
+
+        :param get_running: provides names of accounts, whose handlers are still running
+        (leases of these accounts are not handed over to other instances)
+        """
+
+        self.__get_running = get_running
+        if self.__thread is None:
+            self.__thread = Thread(target=self.__renew, name='leases', daemon=True)
+            self.__thread.start()
+
+    def stop(self):
+        """
+        Stop renewing leases.
+        """
+
+        self.__stopped.set()
+        if self.__thread:
+            self.__thread.join()
+
+    def has_changed(self) -> bool:
+        """
+        Check, if the owned accounts have changed since the last call.
+
+        :return: True, if accounts were acquired or released
+        """
+
+        changed = self.__changed.is_set()
+        self.__changed.clear()
+        return changed
+
+    def release(self):
+        """
+        Release all leases of this instance, so that other instances take over immediately.
+        This must be called after all handlers were stopped.
+        """
+
+        self.stop()
+        try:
+            connection = self.__connect()
+            try:
+                connection.execute('BEGIN IMMEDIATE')
+                connection.execute('DELETE FROM leases WHERE owner = ?', (self.__owner,))
+                connection.execute('DELETE FROM instances WHERE owner = ?', (self.__owner,))
+                connection.execute('COMMIT')
+            finally:
+                connection.close()
+        except Exception as ex:
+            root_logger.error('Can\'t release leases in "%s". %s', self.__path, str(ex))
+
+        self.__owned = set()
+
+    def __renew(self):
+        """
+        Renew leases regularly with the most recently provided accounts.
+        """
+
+        while not self.__stopped.wait(self.renew_interval):
+            self.update(self.__sections)
+
+    def __update(self, sections: list[str], running: set[str]) -> set[str]:
+        """
+        Update leases within a single transaction.
+
+        :param sections: names of all accounts
+        :param running: names of accounts, whose handlers are still running
+        :return: names of the owned accounts
+        """
+
+        now = monotonic()
+        observed: dict[tuple[str, str], tuple[tuple[str, int], float]] = {}
+
+        def is_expired(kind: str, name: str, owner: str, version: int) -> bool:
+            # a lease is expired, if its version did not change for the lease duration
+            key = (kind, name)
+            first_seen = self.__observed.get(key)
+            if first_seen is None or first_seen[0] != (owner, version):
+                first_seen = ((owner, version), now)
+            observed[key] = first_seen
+            return now - first_seen[1] >= self.__ttl
+
+        connection = self.__connect()
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+
+            # the timestamp is only informative, clocks of the instances might differ
+            connection.execute(
+                'INSERT INTO instances (owner, expires, version) VALUES (?, ?, 0) '
+                'ON CONFLICT (owner) DO UPDATE SET expires = excluded.expires, version = instances.version + 1',
+                (self.__owner, time() + self.__ttl)
+            )
+            instances = 0
+            for owner, version in connection.execute('SELECT owner, version FROM instances').fetchall():
+                if owner != self.__owner and is_expired('instance', owner, owner, version):
+                    connection.execute('DELETE FROM instances WHERE owner = ? AND version = ?', (owner, version))
+                else:
+                    instances += 1
+            fair_share = math.ceil(len(sections) / max(1, instances))
+
+            leases: dict[str, tuple[str, int]] = {
+                section: (owner, version)
+                for section, owner, version in connection.execute('SELECT section, owner, version FROM leases')
+            }
+
+            wanted = set(sections)
+            owned = sorted(
+                section for section, (owner, _) in leases.items() if owner == self.__owner and section in wanted
+            )
+
+            # leases of removed accounts and above the fair share are handed over after their handlers stopped
+            handed_over = [section for section, (owner, _) in leases.items()
+                           if owner == self.__owner and section not in wanted] + owned[fair_share:]
+            owned = owned[:fair_share]
+            for section in handed_over:
+                if section in running:
+                    connection.execute(
+                        'UPDATE leases SET version = version + 1 WHERE section = ? AND owner = ?',
+                        (section, self.__owner)
+                    )
+                else:
+                    connection.execute('DELETE FROM leases WHERE section = ? AND owner = ?', (section, self.__owner))
+
+            # acquire free or expired leases up to the fair share
+            for section in sorted(wanted):
+                if len(owned) >= fair_share:
+                    break
+                if section in owned or section in handed_over:
+                    continue
+                lease = leases.get(section)
+                if lease and not is_expired('lease', section, *lease):
+                    continue
+                owned.append(section)
+
+            connection.executemany(
+                'INSERT INTO leases (section, owner, expires, version) VALUES (?, ?, ?, 0) '
+                'ON CONFLICT (section) DO UPDATE SET owner = excluded.owner, expires = excluded.expires, '
+                'version = leases.version + 1',
+                [(section, self.__owner, time() + self.__ttl) for section in owned]
+            )
+
+            # leases, that were not checked in this round, are observed from now on
+            for section, (owner, version) in leases.items():
+                if owner != self.__owner and ('lease', section) not in observed:
+                    is_expired('lease', section, owner, version)
+
+            connection.execute('COMMIT')
+            self.__observed = observed
+            return set(owned)
+
+        except Exception:
+            if connection.in_transaction:
+                connection.execute('ROLLBACK')
+            raise
+
+        finally:
+            connection.close()
+
+    def __connect(self) -> sqlite3.Connection:
+        """
+        Open the lease database.
+
+        :return: database connection in autocommit mode
+        """
+
+        try:
+            return sqlite3.connect(self.__path, timeout=self.__ttl / 3, isolation_level=None)
+        except sqlite3.Error as ex:
+            raise Exception('Can\'t open lease database "%s".' % self.__path) from ex
+
+    def __create_tables(self):
+        """
+        Create the tables of the lease database, if they do not exist yet.
+        """
+
+        connection = self.__connect()
+        try:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS leases '
+                '(section TEXT PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL, '
+                'version INTEGER NOT NULL DEFAULT 0)'
+            )
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS instances '
+                '(owner TEXT PRIMARY KEY, expires REAL NOT NULL, version INTEGER NOT NULL DEFAULT 0)'
+            )
+
+            # databases of previous versions don't provide a version
+            for table in ('leases', 'instances'):
+                columns = [row[1] for row in connection.execute('PRAGMA table_info(%s)' % table)]
+                if 'version' not in columns:
+                    connection.execute('ALTER TABLE %s ADD COLUMN version INTEGER NOT NULL DEFAULT 0' % table)
+        except sqlite3.Error as ex:
+            raise Exception('Can\'t create tables in lease database "%s".' % self.__path) from ex
+        finally:
+            connection.close()
+
+
+class LeasedInventory(Inventory):
+    """
+    Accounts of another inventory, that are owned by this instance.
+    Leases are updated on each request of fingerprints and renewed in the background afterwards.
+    """
+
+    def __init__(self, inventory: Inventory, leases: SectionLeases):
+        self.__inventory = inventory
+        self.__leases = leases
+
+    def get_fingerprints(self) -> dict[str, str]:
+        fingerprints = self.__inventory.get_fingerprints()
+        owned = self.__leases.update(sorted(fingerprints))
+        return {section: fingerprint for section, fingerprint in fingerprints.items() if section in owned}
+
+    def load(self, name: str) -> dict[str, str] | None:
+        return self.__inventory.load(name)
+
+    def has_changed(self) -> bool:
+        return self.__inventory.has_changed()
@@ -0,0 +1,182 @@
+#
+# Copyright 2023 OpenIndex.de.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import copy
+import json
+import logging
+from datetime import datetime
+from logging.handlers import QueueHandler
+from queue import Queue, Full
+from threading import Lock
+from time import monotonic
+
+TEXT_DATE_FORMAT: str = '%Y-%m-%d %H:%M:%S'
+
+
+class TextFormatter(logging.Formatter):
+    """
+    Formats log records as plain text lines.
+    The logger name is omitted for messages of the application logger.
+    """
+
+    # noinspection SpellCheckingInspection
+    APP_FORMAT: str = '[%(levelname)s] %(asctime)s | %(message)s'
+
+    # noinspection SpellCheckingInspection
+    SECTION_FORMAT: str = '[%(levelname)s:%(name)s] %(asctime)s | %(message)s'
+
+    def __init__(self, app_name: str = 'app'):
+        super().__init__(fmt=self.SECTION_FORMAT, datefmt=TEXT_DATE_FORMAT)
+        self.__app_name = app_name
+        self.__app_formatter = logging.Formatter(fmt=self.APP_FORMAT, datefmt=TEXT_DATE_FORMAT)
+
+    def format(self, record: logging.LogRecord) -> str:
+        if record.name == self.__app_name:
+            return self.__app_formatter.format(record)
+        return super().format(record)
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats log records as JSON lines.
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            'time': datetime.fromtimestamp(record.created).astimezone().isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exception'] = record.exc_text
+
+        return json.dumps(data, ensure_ascii=False)
+
+
+class RepeatFilter(logging.Filter):
+    """
+    Limits the number of similar messages of each logger within a time window.
+
+    Messages are similar, if they were logged by the same logger with the same level and message template.
+    The first message after a window with suppressed messages notes the number of suppressed messages.
+    """
+
+    MAX_TRACKED_MESSAGES: int = 10000
+    """
+    Maximal number of tracked message templates, before expired entries are removed.
+    """
+
+    def __init__(self, max_messages: int = 20, window: float = 60):
+        super().__init__()
+        self.__max_messages = max_messages
+        self.__window = window
+        self.__counters: dict[tuple, list] = {}
+        self.__lock = Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.__max_messages < 1:
+            return True
+
+        key = (record.name, record.levelno, record.msg if isinstance(record.msg, str) else id(record.msg))
+        now = monotonic()
+
+        with self.__lock:
+            counter = self.__counters.get(key)
+            if counter is None:
+                if len(self.__counters) >= self.MAX_TRACKED_MESSAGES:
+                    self.__cleanup(now)
+                # window start, number of messages, number of suppressed messages
+                counter = [now, 0, 0]
+                self.__counters[key] = counter
+
+            suppressed = 0
+            if now - counter[0] >= self.__window:
+                suppressed = counter[2]
+                counter[0], counter[1], counter[2] = now, 0, 0
+
+            counter[1] += 1
+            if counter[1] > self.__max_messages:
+                counter[2] += 1
+                return False
+
+        if suppressed > 0 and isinstance(record.msg, str):
+            record.msg += ' (%d similar messages suppressed)' % suppressed
+
+        return True
+
+    def __cleanup(self, now: float):
+        """
+        Remove counters of expired windows without suppressed messages.
+        Must be called while holding the lock.
+
+        :param now: current timestamp
+        """
+
+        for key in [key for key, counter in self.__counters.items()
+                    if now - counter[0] >= self.__window and counter[2] < 1]:
+            del self.__counters[key]
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """
+    Passes log records into a bounded queue, that is processed by a background thread.
+    Records are dropped instead of blocking the logging thread, if the queue is full.
+    """
+
+    def __init__(self, queue: Queue):
+        super().__init__(queue)
+        self.__dropped = 0
+        self.__lock = Lock()
+        self.__exception_formatter = logging.Formatter()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # merge message and arguments and render the traceback, as both might change until the record is written
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = self.__exception_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            with self.__lock:
+                self.__dropped += 1
+            return
+
+        if self.__dropped > 0:
+            with self.__lock:
+                dropped, self.__dropped = self.__dropped, 0
+            if dropped > 0:
+                warning = logging.makeLogRecord({
+                    'name': record.name,
+                    'levelno': logging.WARNING,
+                    'levelname': logging.getLevelName(logging.WARNING),
+                    'msg': 'Dropped %d log messages, because the log queue was full.' % dropped,
+                })
+                try:
+                    self.queue.put_nowait(warning)
+                except Full:
+                    with self.__lock:
+                        self.__dropped += dropped
@@ -0,0 +1,381 @@
+#
+# Copyright 2023 OpenIndex.de.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+from collections import deque
+from enum import IntEnum
+from fnmatch import fnmatchcase
+from threading import Thread, Condition
+from time import monotonic
+from typing import Callable
+
+from . import root_logger
+
+
+class Priority(IntEnum):
+    """
+    Priority lanes of callbacks, lower values are processed first.
+    """
+
+    HIGH = 0
+    NORMAL = 1
+    LOW = 2
+
+
+def get_priority(value: str) -> Priority:
+    """
+    Get a priority by its name.
+
+    :param value: priority name ("high", "normal" or "low")
+    :return: priority
+    """
+
+    try:
+        return Priority[value.strip().upper()]
+    except KeyError:
+        raise Exception('Unsupported priority "%s".' % value)
+
+
+class PriorityRules:
+    """
+    Determines the priority of a message by its author and its headers.
+    """
+
+    __slots__ = ('__default', '__senders', '__use_headers')
+
+    HEADERS: tuple[str, ...] = ('X-Priority', 'Importance', 'Priority')
+    """
+    Message headers, that are evaluated, if headers are used.
+    """
+
+    def __init__(
+            self,
+            default: Priority = Priority.NORMAL,
+            senders: list[tuple[str, Priority]] | None = None,
+            use_headers: bool = False,
+    ):
+        self.__default = default
+        self.__senders = tuple((pattern.strip().lower(), priority) for pattern, priority in senders or [])
+        self.__use_headers = use_headers
+
+    @property
+    def use_headers(self) -> bool:
+        return self.__use_headers
+
+    def get_priority(self, author: str | None, headers: dict[str, str] | None = None) -> Priority:
+        """
+        Get the priority of a message.
+        Sender rules are checked first (in configured order), then message headers.
+
+        :param author: mail address of the author
+        :param headers: message headers with lower case names
+        :return: priority
+        """
+
+        if author and self.__senders:
+            author = author.strip().lower()
+            for pattern, priority in self.__senders:
+                if fnmatchcase(author, pattern):
+                    return priority
+
+        if self.__use_headers and headers:
+            priority = self.__get_header_priority(headers)
+            if priority is not None:
+                return priority
+
+        return self.__default
+
+    @staticmethod
+    def __get_header_priority(headers: dict[str, str]) -> Priority | None:
+        """
+        Get the priority from "X-Priority", "Importance" or "Priority" headers.
+
+        :param headers: message headers with lower case names
+        :return: priority or None, if no priority header is present
+        """
+
+        # e.g. "1 (Highest)" or "5 (Lowest)"
+        value = headers.get('x-priority', '').strip()
+        if value[:1].isdigit():
+            level = int(value[:1])
+            if level <= 2:
+                return Priority.HIGH
+            if level >= 4:
+                return Priority.LOW
+            return Priority.NORMAL
+
+        value = headers.get('importance', '').strip().lower()
+        if value == 'high':
+            return Priority.HIGH
+        if value == 'low':
+            return Priority.LOW
+
+        value = headers.get('priority', '').strip().lower()
+        if value == 'urgent':
+            return Priority.HIGH
+        if value == 'non-urgent':
+            return Priority.LOW
+
+        return None
+
+
+class CallbackJob:
+    """
+    A queued callback.
+    """
+
+    __slots__ = ('name', 'priority', 'queued_at', 'run', 'on_dropped')
+
+    def __init__(
+            self,
+            name: str,
+            priority: Priority,
+            run: Callable[[], None],
+            on_dropped: Callable[[], None] | None = None,
+    ):
+        self.name = name
+        self.priority = priority
+        self.queued_at = monotonic()
+        self.run = run
+        self.on_dropped = on_dropped
+
+    def drop(self):
+        """
+        Clean up a callback, that is not going to run.
+        """
+
+        if not self.on_dropped:
+            return
+        try:
+            self.on_dropped()
+        except Exception as ex:
+            root_logger.exception('Cleanup of dropped callback for "%s" failed. %s', self.name, str(ex))
+
+
+class CallbackLaneStats:
+    """
+    Statistics of a priority lane.
+    """
+
+    __slots__ = ('processed', 'wait_total', 'wait_max')
+
+    def __init__(self):
+        self.processed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+
+class CallbackDispatcher:
+    """
+    Runs callbacks with a limited number of worker threads.
+
+    Callbacks are queued in priority lanes. Waiting callbacks age, so that a callback is moved up by one lane for
+    each period of aging seconds. This way low priority callbacks are delayed, but never starve.
+    """
+
+    SECONDS_TO_WAIT_FOR_STOP: int = 30
+    """
+    Maximal number of seconds to wait for running callbacks, when the dispatcher is stopped.
+    """
+
+    def __init__(self, workers: int = 4, aging: float = 60.0, max_queued: int = 10000):
+        if workers < 1:
+            raise Exception('At least one callback worker is required.')
+
+        self.__workers = workers
+        self.__aging = max(0.001, aging)
+        self.__max_queued = max(1, max_queued)
+        self.__queued = 0
+        self.__running = 0
+        self.__lanes: dict[Priority, deque[CallbackJob]] = {priority: deque() for priority in Priority}
+        self.__stats: dict[Priority, CallbackLaneStats] = {priority: CallbackLaneStats() for priority in Priority}
+        self.__condition = Condition()
+        self.__threads: list[Thread] = []
+        self.__stopped = False
+
+    def submit(
+            self,
+            name: str,
+            priority: Priority,
+            run: Callable[[], None],
+            on_dropped: Callable[[], None] | None = None,
+    ) -> bool:
+        """
+        Queue a callback.
+
+        :param name: section name
+        :param priority: priority lane
+        :param run: callback, that blocks until the callback command finished
+        :param on_dropped: called instead of the callback, if it is dropped (e.g. to remove spooled files)
+        :return: False, if the callback was dropped because the queue is full or the dispatcher was stopped
+        """
+
+        job = CallbackJob(name=name, priority=priority, run=run, on_dropped=on_dropped)
+        with self.__condition:
+            if self.__stopped:
+                root_logger.warning('Callback dispatcher is stopped. Dropped callback for "%s".', name)
+                accepted = False
+            elif self.__queued >= self.__max_queued:
+                root_logger.warning('Callback queue is full (%s). Dropped callback for "%s".', self.__queued, name)
+                accepted = False
+            else:
+                accepted = True
+
+            if accepted:
+                self.__lanes[priority].append(job)
+                self.__queued += 1
+                self.__condition.notify()
+
+                # worker threads are started on demand
+                if len(self.__threads) < self.__workers:
+                    thread = Thread(target=self.__work, name='callback-%s' % len(self.__threads), daemon=True)
+                    self.__threads.append(thread)
+                    thread.start()
+
+        if not accepted:
+            job.drop()
+        return accepted
+
+    def stop(self):
+        """
+        Stop processing callbacks. Queued callbacks are dropped and running callbacks are awaited for at most
+        SECONDS_TO_WAIT_FOR_STOP seconds.
+        """
+
+        with self.__condition:
+            self.__stopped = True
+            dropped = [job for lane in self.__lanes.values() for job in lane]
+            for lane in self.__lanes.values():
+                lane.clear()
+            self.__queued = 0
+            self.__condition.notify_all()
+            threads = list(self.__threads)
+
+        if dropped:
+            root_logger.warning('Dropped %s queued callbacks.', len(dropped))
+            for job in dropped:
+                job.drop()
+
+        deadline = monotonic() + self.SECONDS_TO_WAIT_FOR_STOP
+        for thread in threads:
+            thread.join(timeout=max(0.0, deadline - monotonic()))
+        running = sum(1 for thread in threads if thread.is_alive())
+        if running > 0:
+            root_logger.warning('Stopped waiting for %s running callbacks.', running)
+
+    def join(self, timeout: float | None = None) -> bool:
+        """
+        Wait until all queued and running callbacks are finished.
+
+        :param timeout: maximal number of seconds to wait or None to wait infinitely
+        :return: True, if all callbacks are finished
+        """
+
+        with self.__condition:
+            return self.__condition.wait_for(lambda: self.__queued == 0 and self.__running == 0, timeout=timeout)
+
+    def get_usage(self) -> dict[str, dict[str, int | float]]:
+        """
+        Get queue depth and wait times of each priority lane.
+
+        :return: statistics for each lane name
+        """
+
+        now = monotonic()
+        with self.__condition:
+            usage: dict[str, dict[str, int | float]] = {}
+            for priority, lane in self.__lanes.items():
+                stats = self.__stats[priority]
+                usage[priority.name.lower()] = {
+                    'depth': len(lane),
+                    'oldest': now - lane[0].queued_at if lane else 0.0,
+                    'processed': stats.processed,
+                    'wait_average': stats.wait_total / stats.processed if stats.processed else 0.0,
+                    'wait_max': stats.wait_max,
+                }
+            return usage
+
+    def log_usage(self):
+        """
+        Log queue depth and wait times of each priority lane.
+        """
+
+        for lane, usage in self.get_usage().items():
+            root_logger.info(
+                'Callback lane "%s": %s queued (oldest %.1f s), %s processed (wait %.2f s average, %.2f s max).',
+                lane,
+                usage['depth'],
+                usage['oldest'],
+                usage['processed'],
+                usage['wait_average'],
+                usage['wait_max'],
+            )
+
+    def __next(self) -> CallbackJob | None:
+        """
+        Take the next callback from the lanes, considering aging of waiting callbacks.
+        Must be called while holding the lock.
+
+        :return: next callback or None, if no callback is queued
+        """
+
+        now = monotonic()
+        selected: deque[CallbackJob] | None = None
+        selected_rank = 0.0
+        for priority, lane in self.__lanes.items():
+            if not lane:
+                continue
+            # the oldest callback of a lane has waited the longest
+            rank = priority - (now - lane[0].queued_at) / self.__aging
+            if selected is None or rank < selected_rank:
+                selected = lane
+                selected_rank = rank
+
+        if selected is None:
+            return None
+
+        job = selected.popleft()
+        self.__queued -= 1
+        self.__running += 1
+        waited = now - job.queued_at
+        stats = self.__stats[job.priority]
+        stats.processed += 1
+        stats.wait_total += waited
+        stats.wait_max = max(stats.wait_max, waited)
+        return job
+
+    def __work(self):
+        """
+        Process queued callbacks.
+        """
+
+        while True:
+            with self.__condition:
+                job = self.__next()
+                while job is None:
+                    if self.__stopped:
+                        return
+                    self.__condition.wait()
+                    job = self.__next()
+
+            try:
+                job.run()
+            except Exception as ex:
+                root_logger.exception('Unexpected callback error for "%s". %s', job.name, str(ex))
+            finally:
+                with self.__condition:
+                    self.__running -= 1
+                    if self.__running == 0 and self.__queued == 0:
+                        self.__condition.notify_all()
@@ -0,0 +1,393 @@
+#
+# Copyright 2023 OpenIndex.de.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import json
+import os
+import selectors
+import socket
+from collections import deque
+from enum import Enum
+from threading import Thread, Lock
+
+from . import root_logger
+from .event import MessageEvent
+
+
+class SlowConsumerPolicy(Enum):
+    """
+    What happens, if the buffer of a subscriber is full.
+    """
+
+    DROP = 'drop'
+    DISCONNECT = 'disconnect'
+
+
+class Subscriber:
+    """
+    A connected subscriber with its buffer of events, that were not sent yet.
+    """
+
+    __slots__ = ('sock', 'queue', 'pending', 'sent_seq', 'dropped', 'request')
+
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self.queue: deque[tuple[int, bytes]] = deque()
+        self.pending: memoryview | None = None
+        self.sent_seq = 0
+        self.dropped = 0
+        self.request = bytearray()
+
+
+class EventPublisher:
+    """
+    Streams new message events as newline delimited JSON to any number of subscribers on a Unix domain socket.
+
+    A single thread accepts subscribers and writes to all of them without blocking. Each subscriber has a bounded
+    buffer. If a subscriber does not read fast enough, the oldest events in its buffer are dropped or the subscriber
+    is disconnected. Recent events are optionally kept in a ring buffer. A subscriber might send a line like
+    {"since": 42} after connecting, in order to receive the buffered events after sequence number 42 first.
+    """
+
+    MAX_REQUEST_SIZE: int = 1024
+    """
+    Maximal number of bytes, that are read from a subscriber until a complete request line is received.
+    """
+
+    def __init__(
+            self,
+            path: str,
+            buffer_size: int = 1000,
+            slow_consumer: SlowConsumerPolicy = SlowConsumerPolicy.DROP,
+            replay_size: int = 0,
+    ):
+        self.__path = path.strip()
+        self.__buffer_size = max(1, buffer_size)
+        self.__slow_consumer = SlowConsumerPolicy(slow_consumer.strip().lower()) \
+            if isinstance(slow_consumer, str) else slow_consumer
+        self.__replay: deque[tuple[int, bytes]] | None = deque(maxlen=replay_size) if replay_size > 0 else None
+        self.__subscribers: dict[int, Subscriber] = {}
+        self.__seq = 0
+        self.__lock = Lock()
+        self.__server: socket.socket | None = None
+        self.__selector: selectors.BaseSelector | None = None
+        self.__wakeup: tuple[int, int] | None = None
+        self.__stopped = False
+        self.__thread: Thread | None = None
+
+    def start(self):
+        """
+        Listen on the socket and start the publisher thread.
+        A stale socket file of a previous run is replaced.
+        """
+
+        if self.__thread is not None:
+            return
+
+        if os.path.exists(self.__path):
+            try:
+                os.remove(self.__path)
+            except OSError as ex:
+                raise Exception('Can\'t remove socket file "%s".' % self.__path) from ex
+
+        self.__server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.__server.bind(self.__path)
+            self.__server.listen()
+        except OSError as ex:
+            self.__server.close()
+            raise Exception('Can\'t listen on socket "%s".' % self.__path) from ex
+        self.__server.setblocking(False)
+
+        self.__wakeup = os.pipe()
+        os.set_blocking(self.__wakeup[0], False)
+        os.set_blocking(self.__wakeup[1], False)
+
+        self.__selector = selectors.DefaultSelector()
+        self.__selector.register(self.__server, selectors.EVENT_READ)
+        self.__selector.register(self.__wakeup[0], selectors.EVENT_READ)
+
+        self.__thread = Thread(target=self.__run, name='publisher', daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        """
+        Disconnect all subscribers and remove the socket file.
+        Events, that were not sent yet, are discarded.
+        """
+
+        if self.__thread is None:
+            return
+
+        with self.__lock:
+            self.__stopped = True
+        self.__wake()
+        self.__thread.join(timeout=5)
+
+    def publish(self, event: MessageEvent):
+        """
+        Send an event to all subscribers.
+        This does not block, the event is written by the publisher thread.
+
+        :param event: new message
+        """
+
+        with self.__lock:
+            if self.__stopped:
+                return
+            self.__seq += 1
+            # the sequence number is added to the cached JSON of the event
+            line = ('{"seq": %d, %s\n' % (self.__seq, event.to_json()[1:])).encode('utf-8')
+            if self.__replay is not None:
+                self.__replay.append((self.__seq, line))
+            for subscriber in self.__subscribers.values():
+                self.__enqueue(subscriber, [(self.__seq, line)])
+            wake = len(self.__subscribers) > 0
+
+        if wake:
+            self.__wake()
+
+    def get_subscriber_count(self) -> int:
+        """
+        Get the number of connected subscribers.
+
+        :return: number of subscribers
+        """
+
+        with self.__lock:
+            return len(self.__subscribers)
+
+    def __enqueue(self, subscriber: Subscriber, lines: list[tuple[int, bytes]]):
+        """
+        Add events to the buffer of a subscriber according to the slow consumer policy.
+        Must be called while holding the lock.
+
+        :param subscriber: subscriber
+        :param lines: sequence numbers and encoded events
+        """
+
+        if subscriber.sock is None or subscriber.dropped < 0:
+            return
+
+        subscriber.queue.extend(lines)
+        overflow = len(subscriber.queue) - self.__buffer_size
+        if overflow <= 0:
+            return
+
+        if self.__slow_consumer == SlowConsumerPolicy.DISCONNECT:
+            root_logger.warning('Disconnect slow event subscriber after %s buffered events.', self.__buffer_size)
+            subscriber.queue.clear()
+            subscriber.dropped = -1
+            return
+
+        for _ in range(overflow):
+            subscriber.queue.popleft()
+        if subscriber.dropped == 0:
+            root_logger.warning('Event subscriber is too slow, dropping events.')
+        subscriber.dropped += overflow
+
+    def __wake(self):
+        """
+        Wake up the publisher thread.
+        """
+
+        try:
+            os.write(self.__wakeup[1], b'\0')
+        except BlockingIOError:
+            # the thread is already woken up
+            pass
+        except OSError:
+            pass
+
+    def __run(self):
+        """
+        Accept subscribers and write buffered events, until the publisher is stopped.
+        """
+
+        try:
+            while True:
+                with self.__lock:
+                    if self.__stopped:
+                        break
+                    self.__update_interests()
+
+                for key, mask in self.__selector.select():
+                    if key.fileobj is self.__server:
+                        self.__accept()
+                    elif key.fileobj == self.__wakeup[0]:
+                        try:
+                            while os.read(self.__wakeup[0], 4096):
+                                pass
+                        except BlockingIOError:
+                            pass
+                    else:
+                        subscriber: Subscriber = key.data
+                        if mask & selectors.EVENT_READ:
+                            self.__read(subscriber)
+                        if mask & selectors.EVENT_WRITE and subscriber.sock is not None:
+                            self.__write(subscriber)
+        except Exception as ex:
+            root_logger.exception('Event publisher failed. %s', str(ex))
+        finally:
+            self.__close()
+
+    def __update_interests(self):
+        """
+        Register subscribers for writing, if they have buffered events, and close disconnected subscribers.
+        Must be called while holding the lock.
+        """
+
+        for fd, subscriber in list(self.__subscribers.items()):
+            if subscriber.dropped < 0:
+                self.__disconnect(subscriber)
+                continue
+            events = selectors.EVENT_READ
+            if subscriber.pending is not None or subscriber.queue:
+                events |= selectors.EVENT_WRITE
+            if self.__selector.get_key(subscriber.sock).events != events:
+                self.__selector.modify(subscriber.sock, events, data=subscriber)
+
+    def __accept(self):
+        """
+        Accept a new subscriber.
+        """
+
+        try:
+            sock, _ = self.__server.accept()
+        except (BlockingIOError, InterruptedError):
+            return
+        sock.setblocking(False)
+        subscriber = Subscriber(sock)
+        with self.__lock:
+            self.__subscribers[sock.fileno()] = subscriber
+        self.__selector.register(sock, selectors.EVENT_READ, data=subscriber)
+        root_logger.info('Event subscriber connected.')
+
+    def __read(self, subscriber: Subscriber):
+        """
+        Read a replay request of a subscriber or notice its disconnection.
+
+        :param subscriber: subscriber
+        """
+
+        try:
+            data = subscriber.sock.recv(self.MAX_REQUEST_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+
+        with self.__lock:
+            if not data:
+                self.__disconnect(subscriber)
+                return
+
+            subscriber.request.extend(data)
+            while b'\n' in subscriber.request:
+                line, _, rest = bytes(subscriber.request).partition(b'\n')
+                subscriber.request = bytearray(rest)
+                self.__replay_events(subscriber, line)
+            if len(subscriber.request) > self.MAX_REQUEST_SIZE:
+                subscriber.request.clear()
+
+    def __replay_events(self, subscriber: Subscriber, line: bytes):
+        """
+        Replace the buffer of a subscriber with events from the ring buffer.
+        Must be called while holding the lock.
+
+        :param subscriber: subscriber
+        :param line: request line, e.g. {"since": 42}
+        """
+
+        try:
+            since = int(json.loads(line).get('since', 0))
+        except (ValueError, TypeError, AttributeError):
+            root_logger.warning('Invalid request of event subscriber: %s', line[:100])
+            return
+
+        if self.__replay is None:
+            return
+
+        # events, that were already sent, are not repeated
+        since = max(since, subscriber.sent_seq)
+        subscriber.queue.clear()
+        self.__enqueue(subscriber, [(seq, event) for seq, event in self.__replay if seq > since])
+
+    def __write(self, subscriber: Subscriber):
+        """
+        Write buffered events to a subscriber, until its socket would block.
+
+        :param subscriber: subscriber
+        """
+
+        while True:
+            if subscriber.pending is None:
+                with self.__lock:
+                    if not subscriber.queue:
+                        return
+                    seq, line = subscriber.queue.popleft()
+                    subscriber.sent_seq = seq
+                subscriber.pending = memoryview(line)
+
+            try:
+                sent = subscriber.sock.send(subscriber.pending)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                with self.__lock:
+                    self.__disconnect(subscriber)
+                return
+
+            subscriber.pending = subscriber.pending[sent:] if sent < len(subscriber.pending) else None
+
+    def __disconnect(self, subscriber: Subscriber):
+        """
+        Close the connection of a subscriber.
+        Must be called while holding the lock.
+
+        :param subscriber: subscriber
+        """
+
+        if subscriber.sock is None:
+            return
+        self.__subscribers.pop(subscriber.sock.fileno(), None)
+        try:
+            self.__selector.unregister(subscriber.sock)
+        except (KeyError, ValueError):
+            pass
+        subscriber.sock.close()
+        subscriber.sock = None
+        subscriber.queue.clear()
+        subscriber.pending = None
+        root_logger.info('Event subscriber disconnected.')
+
+    def __close(self):
+        """
+        Close all connections, the socket and the selector.
+        """
+
+        with self.__lock:
+            self.__stopped = True
+            for subscriber in list(self.__subscribers.values()):
+                self.__disconnect(subscriber)
+
+        self.__selector.close()
+        self.__server.close()
+        for fd in self.__wakeup:
+            os.close(fd)
+        try:
+            os.remove(self.__path)
+        except OSError:
+            pass
@@ -0,0 +1,154 @@
+#
+# Copyright 2023 OpenIndex.de.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+from threading import Lock
+
+from . import root_logger
+
+
+class HostLifetime:
+    """
+    Observed lifetime of IDLE connections to a host.
+    """
+
+    __slots__ = ('interval', 'dropped_after', 'survived_since')
+
+    def __init__(self, interval: int):
+        self.interval = interval
+        self.dropped_after: int | None = None
+        self.survived_since = 0
+
+
+class ReconnectIntervals:
+    """
+    Learns, how long IDLE connections to each host survive, and adapts the interval of enforced reconnections.
+
+    IDLE connections are closed and opened again regularly, because servers or NAT gateways might drop idle connections
+    silently. The interval starts with an initial value and grows with each connection, that survived until it was
+    closed on purpose. If a connection was lost, the interval is reduced below the observed lifetime. This way the
+    interval becomes as long as possible, but shorter than the point, where the host drops connections. After enough
+    connections survived, the interval grows again, so that a single loss doesn't limit the interval forever.
+    """
+
+    GROWTH: float = 1.5
+    """
+    Factor to increase the interval after a connection survived.
+    """
+
+    MARGIN: float = 0.8
+    """
+    Factor to apply on the observed lifetime of a lost connection.
+    """
+
+    RECOVERY_CONNECTIONS: int = 10
+    """
+    Number of connections, that must survive after a connection was lost, before the interval grows again.
+    """
+
+    def __init__(self, initial: int = 600, minimum: int = 60, maximum: int = 1740, adaptive: bool = True):
+        self.__minimum = max(1, minimum)
+        self.__maximum = max(self.__minimum, maximum)
+        self.__initial = min(max(self.__minimum, initial), self.__maximum)
+        self.__adaptive = adaptive
+        self.__hosts: dict[str, HostLifetime] = {}
+        self.__lock = Lock()
+
+    def get(self, host: str) -> int:
+        """
+        Get the current reconnect interval of a host.
+
+        :param host: hostname of the IMAP server
+        :return: number of seconds after an IDLE connection is closed and opened again
+        """
+
+        with self.__lock:
+            lifetime = self.__hosts.get(host)
+            return lifetime.interval if lifetime else self.__initial
+
+    def survived(self, host: str, age: float):
+        """
+        Record a connection, that was closed on purpose.
+
+        :param host: hostname of the IMAP server
+        :param age: number of seconds the connection was open
+        """
+
+        if not self.__adaptive:
+            return
+
+        with self.__lock:
+            lifetime = self.__get_lifetime(host)
+
+            # the connection survived longer than a lost one before, the loss was probably not caused by a timeout
+            if lifetime.dropped_after is not None and age > lifetime.dropped_after:
+                lifetime.dropped_after = None
+
+            # the host might have stopped dropping connections (e.g. after a network problem), the limit is probed again
+            if lifetime.dropped_after is not None:
+                lifetime.survived_since += 1
+                if lifetime.survived_since >= self.RECOVERY_CONNECTIONS:
+                    lifetime.dropped_after = None
+
+            if lifetime.dropped_after is None and age >= lifetime.interval:
+                self.__set_interval(host, lifetime, int(lifetime.interval * self.GROWTH))
+
+    def dropped(self, host: str, age: float):
+        """
+        Record a connection, that was lost.
+
+        :param host: hostname of the IMAP server
+        :param age: number of seconds the connection was open
+        """
+
+        if not self.__adaptive:
+            return
+
+        with self.__lock:
+            lifetime = self.__get_lifetime(host)
+            lifetime.survived_since = 0
+            lifetime.dropped_after = int(age) if lifetime.dropped_after is None \
+                else min(lifetime.dropped_after, int(age))
+            self.__set_interval(host, lifetime, min(lifetime.interval, int(lifetime.dropped_after * self.MARGIN)))
+
+    def __get_lifetime(self, host: str) -> HostLifetime:
+        """
+        Get the observed lifetime of a host.
+        Must be called while holding the lock.
+
+        :param host: hostname of the IMAP server
+        :return: observed lifetime
+        """
+
+        lifetime = self.__hosts.get(host)
+        if lifetime is None:
+            lifetime = HostLifetime(self.__initial)
+            self.__hosts[host] = lifetime
+        return lifetime
+
+    def __set_interval(self, host: str, lifetime: HostLifetime, interval: int):
+        """
+        Change the reconnect interval of a host within the configured limits.
+        Must be called while holding the lock.
+
+        :param host: hostname of the IMAP server
+        :param lifetime: observed lifetime
+        :param interval: new interval in seconds
+        """
+
+        interval = min(max(self.__minimum, interval), self.__maximum)
+        if interval != lifetime.interval:
+            root_logger.info('Reconnect interval for "%s" changed to %s seconds.', host, interval)
+            lifetime.interval = interval
@@ -0,0 +1,238 @@
+#
+# Copyright 2023 OpenIndex.de.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import logging
+import os
+import selectors
+import shlex
+from threading import Thread, Lock, Event
+from typing import Callable
+
+from . import root_logger
+
+
+def parse_command(command: str) -> list[str]:
+    """
+    Split a command line into program and arguments, without using a shell.
+
+    :param command: command line
+    :return: program and arguments
+    """
+
+    argv = shlex.split(command)
+    if not argv:
+        raise Exception('Empty command "%s".' % command)
+    return argv
+
+
+class SpawnedProcess:
+    """
+    A child process, that is watched by the reaper.
+    """
+
+    __slots__ = ('pid', 'label', 'logger', 'on_exit', 'pidfd')
+
+    def __init__(
+            self,
+            pid: int,
+            label: str,
+            logger: logging.Logger,
+            on_exit: Callable[[int], None] | None,
+            pidfd: int | None,
+    ):
+        self.pid = pid
+        self.label = label
+        self.logger = logger
+        self.on_exit = on_exit
+        self.pidfd = pidfd
+
+
+class ProcessReaper:
+    """
+    Launches commands directly (without a shell) and collects the exit codes of all launched processes
+    within a single thread.
+
+    On Linux the reaper waits for process file descriptors, otherwise the processes are polled.
+    """
+
+    SECONDS_BETWEEN_POLLS: float = 0.1
+    """
+    Number of seconds between polls, if process file descriptors are not available.
+    """
+
+    def __init__(self):
+        self.__processes: dict[int, SpawnedProcess] = {}
+        self.__lock = Lock()
+        self.__wakeup = Event()
+        self.__use_pidfd = hasattr(os, 'pidfd_open')
+        self.__selector = selectors.DefaultSelector() if self.__use_pidfd else None
+        self.__wakeup_read, self.__wakeup_write = os.pipe() if self.__use_pidfd else (None, None)
+        if self.__selector:
+            self.__selector.register(self.__wakeup_read, selectors.EVENT_READ)
+        self.__thread = Thread(target=self.__run, name='process-reaper', daemon=True)
+        self.__thread.start()
+
+    def spawn(
+            self,
+            argv: list[str],
+            environment: dict[str, str],
+            logger: logging.Logger = root_logger,
+            on_exit: Callable[[int], None] | None = None,
+            stdout: int | None = None,
+    ) -> int:
+        """
+        Launch a command without a shell.
+
+        :param argv: program and arguments, the program is searched in PATH
+        :param environment: environment variables
+        :param logger: logger for the exit status
+        :param on_exit: called with the exit code, after the process finished
+        :param stdout: file descriptor for the standard output of the process or None, to inherit it
+        :return: process id
+        """
+
+        file_actions = [(os.POSIX_SPAWN_DUP2, stdout, 1)] if stdout is not None else ()
+        pid = os.posix_spawnp(argv[0], argv, environment, file_actions=file_actions)
+
+        pidfd: int | None = None
+        if self.__use_pidfd:
+            try:
+                pidfd = os.pidfd_open(pid)
+            except OSError:
+                pidfd = None
+
+        process = SpawnedProcess(pid=pid, label=argv[0], logger=logger, on_exit=on_exit, pidfd=pidfd)
+        with self.__lock:
+            self.__processes[pid] = process
+            if pidfd is not None:
+                self.__selector.register(pidfd, selectors.EVENT_READ, process)
+
+        self.__wakeup.set()
+        if self.__wakeup_write is not None:
+            os.write(self.__wakeup_write, b'\0')
+
+        return pid
+
+    def get_running_count(self) -> int:
+        """
+        Get the number of running processes.
+
+        :return: number of processes
+        """
+
+        with self.__lock:
+            return len(self.__processes)
+
+    def __run(self):
+        """
+        Wait for launched processes to finish.
+        """
+
+        while True:
+            try:
+                if self.__selector:
+                    self.__wait_for_pidfds()
+                else:
+                    self.__poll()
+            except Exception as ex:
+                root_logger.exception('Process reaper failed. %s', str(ex))
+
+    def __wait_for_pidfds(self):
+        """
+        Wait until any process file descriptor becomes readable and collect finished processes.
+        Processes without a file descriptor (e.g. if the limit of open files was reached) are polled.
+        """
+
+        with self.__lock:
+            unwatched = [process for process in self.__processes.values() if process.pidfd is None]
+
+        for key, _ in self.__selector.select(self.SECONDS_BETWEEN_POLLS if unwatched else None):
+            if key.fd == self.__wakeup_read:
+                os.read(self.__wakeup_read, 1024)
+                continue
+            self.__collect(key.data)
+
+        for process in unwatched:
+            self.__collect(process, block=False)
+
+    def __poll(self):
+        """
+        Poll all launched processes.
+        """
+
+        if not self.__processes:
+            self.__wakeup.wait()
+            self.__wakeup.clear()
+
+        with self.__lock:
+            processes = list(self.__processes.values())
+        for process in processes:
+            self.__collect(process, block=False)
+
+        self.__wakeup.wait(self.SECONDS_BETWEEN_POLLS)
+        self.__wakeup.clear()
+
+    def __collect(self, process: SpawnedProcess, block: bool = True):
+        """
+        Collect the exit status of a process.
+
+        :param process: launched process
+        :param block: whether to wait for the process to finish
+        """
+
+        try:
+            pid, status = os.waitpid(process.pid, 0 if block else os.WNOHANG)
+        except ChildProcessError:
+            pid, status = process.pid, 0
+        if pid == 0:
+            return
+
+        with self.__lock:
+            self.__processes.pop(process.pid, None)
+            if process.pidfd is not None:
+                self.__selector.unregister(process.pidfd)
+                os.close(process.pidfd)
+
+        exit_code = os.waitstatus_to_exitcode(status)
+        if exit_code != 0:
+            process.logger.warning(
+                'Callback script "%s" returned non-zero exit code (%s)!',
+                process.label,
+                exit_code
+            )
+
+        if process.on_exit:
+            try:
+                process.on_exit(exit_code)
+            except Exception as ex:
+                process.logger.exception('Callback exit handler failed. %s', str(ex))
+
+
+__REAPER: list[ProcessReaper | None] = [None]
+__REAPER_LOCK: Lock = Lock()
+
+
+def get_process_reaper() -> ProcessReaper:
+    """
+    Get the process wide reaper, it is created on first use.
+
+    :return: process reaper
+    """
+
+    with __REAPER_LOCK:
+        if __REAPER[0] is None:
+            __REAPER[0] = ProcessReaper()
+        return __REAPER[0]
@@ -0,0 +1,240 @@
+#
+# Copyright 2023 OpenIndex.de.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import logging
+import os
+import re
+import tempfile
+from itertools import takewhile
+
+from imapclient import IMAPClient
+
+from . import root_logger
+
+
+def get_file_variable(section: str) -> str:
+    """
+    Get the name of the environment variable, that contains the path of a spooled file.
+
+    :param section: body section (e.g. "1.2" or "TEXT") or an empty string for the whole message
+    :return: "MESSAGE_FILE" for the whole message or e.g. "MESSAGE_FILE_1_2" for a body section
+    """
+
+    if not section:
+        return 'MESSAGE_FILE'
+    return 'MESSAGE_FILE_%s' % re.sub(r'[^A-Z0-9]', '_', section.upper())
+
+
+def remove_files(files: dict[str, str] | None):
+    """
+    Remove spooled files.
+
+    :param files: paths of spooled files
+    """
+
+    if not files:
+        return
+    for path in files.values():
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as ex:
+            root_logger.warning('Can\'t remove spooled file "%s". %s', path, str(ex))
+
+
+class MessageSpooler:
+    """
+    Writes the content of new messages into files, that are passed to callback commands.
+
+    Messages are fetched in partial chunks on the connection, that already fetched the envelope, and written to disk
+    immediately. The memory usage does not depend on the message size.
+
+    The sizes of the message and of its body parts are fetched along with the envelope (see fetch_items), so that
+    sections, that are larger than the maximal size, are skipped before any content is transferred.
+    """
+
+    __slots__ = ('__directory', '__sections', '__max_size', '__chunk_size')
+
+    CHUNK_SIZE: int = 262144
+    """
+    Number of bytes, that are fetched with a single FETCH command.
+    """
+
+    def __init__(
+            self,
+            directory: str,
+            sections: list[str] | None = None,
+            max_size: int = 26214400,
+            chunk_size: int = CHUNK_SIZE,
+    ):
+        self.__directory = directory
+        self.__sections = [section.strip().upper() for section in sections or [] if section.strip()] or ['']
+        self.__max_size = max(1, max_size)
+        self.__chunk_size = max(1024, chunk_size)
+
+        for section in self.__sections:
+            if not re.fullmatch(r'[0-9.]*(HEADER|TEXT|MIME)?', section) or section.startswith('.'):
+                raise Exception('Invalid body section "%s".' % section)
+
+        try:
+            os.makedirs(self.__directory, exist_ok=True)
+        except OSError as ex:
+            raise Exception('Can\'t create spool directory "%s".' % self.__directory) from ex
+
+    @property
+    def fetch_items(self) -> list[str]:
+        """
+        Items to fetch along with the envelope, in order to know the size of the configured sections.
+        """
+
+        if any(section[:1].isdigit() for section in self.__sections):
+            return ['RFC822.SIZE', 'BODYSTRUCTURE']
+        return ['RFC822.SIZE']
+
+    def spool(
+            self,
+            client: IMAPClient,
+            uid: int,
+            logger: logging.Logger = root_logger,
+            message_result: dict | None = None,
+    ) -> dict[str, str]:
+        """
+        Write the configured body sections of a message into files.
+        Sections, that are larger than the maximal size, are skipped.
+
+        :param client: IMAP client with the folder of the message selected
+        :param uid: UID of the message
+        :param logger: logger of the mailbox
+        :param message_result: fetched data of the message including fetch_items, in order to skip large sections
+        without transferring them
+        :return: paths of the spooled files by environment variable
+        """
+
+        files: dict[str, str] = {}
+        use_uid = client.use_uid
+        client.use_uid = True
+        try:
+            for section in self.__sections:
+                size = self.__get_section_size(message_result, section)
+                if size is not None and size > self.__max_size:
+                    logger.warning(
+                        'Body section "%s" of message UID %s has %s bytes and exceeds %s bytes, it is not spooled.',
+                        section or '(whole message)', uid, size, self.__max_size
+                    )
+                    continue
+
+                path = self.__spool_section(client, uid, section, logger)
+                if path:
+                    files[get_file_variable(section)] = path
+        except Exception:
+            remove_files(files)
+            raise
+        finally:
+            client.use_uid = use_uid
+        return files
+
+    @staticmethod
+    def __get_section_size(message_result: dict | None, section: str) -> int | None:
+        """
+        Get the size of a body section from the fetched size and body structure of the message.
+        The size of HEADER, TEXT and MIME sections is not provided by the server.
+
+        :param message_result: fetched data of the message
+        :param section: body section or an empty string for the whole message
+        :return: number of bytes or None, if the size is unknown
+        """
+
+        if not message_result:
+            return None
+        if not section:
+            return message_result.get(b'RFC822.SIZE')
+
+        # only numbered parts provide a size, e.g. "1.2" but not "1.2.TEXT"
+        if not re.fullmatch(r'[0-9]+(\.[0-9]+)*', section):
+            return None
+
+        part = message_result.get(b'BODYSTRUCTURE')
+        for number in (int(n) for n in section.split('.')):
+            if not part:
+                return None
+
+            # the body of a message/rfc822 part is structured like a message
+            if len(part) > 8 and part[0] == b'MESSAGE' and part[1] == b'RFC822' and isinstance(part[8], tuple):
+                part = part[8]
+
+            # the parts of a multipart body lead its fields, nested body structures are parsed as plain tuples
+            if isinstance(part[0], (list, tuple)):
+                parts = part[0] if isinstance(part[0], list) else list(takewhile(lambda p: isinstance(p, tuple), part))
+                part = parts[number - 1] if 0 < number <= len(parts) else None
+            elif number != 1:
+                # a single part body only has part number 1
+                return None
+
+        if not part or isinstance(part[0], (list, tuple)) or len(part) < 7:
+            return None
+        return part[6] if isinstance(part[6], int) else None
+
+    def __spool_section(self, client: IMAPClient, uid: int, section: str, logger: logging.Logger) -> str | None:
+        """
+        Fetch a body section in chunks and write it into a file.
+
+        :param client: IMAP client in UID mode
+        :param uid: UID of the message
+        :param section: body section or an empty string for the whole message
+        :param logger: logger of the mailbox
+        :return: path of the written file or None, if the section is too large
+        """
+
+        fd, path = tempfile.mkstemp(
+            dir=self.__directory,
+            prefix='message-%s-%s' % (uid, '%s-' % section if section else ''),
+            suffix='.eml' if not section else '.part',
+        )
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                offset = 0
+                while True:
+                    item = 'BODY.PEEK[%s]<%d.%d>' % (section, offset, self.__chunk_size)
+                    result = client.fetch([uid], [item])
+                    data = result.get(uid, {})
+                    chunk = data.get(b'BODY[%s]<%d>' % (section.encode('ascii'), offset))
+                    if chunk is None:
+                        # the server might omit the origin octet in its response
+                        chunk = data.get(b'BODY[%s]' % section.encode('ascii'))
+                    if chunk is None and offset > 0:
+                        # servers might return NIL, if the previous chunk ended exactly at the end of the section
+                        break
+                    if chunk is None:
+                        raise Exception('No data for body section "%s" of message UID %s.' % (section, uid))
+
+                    offset += len(chunk)
+                    if offset > self.__max_size:
+                        logger.warning(
+                            'Body section "%s" of message UID %s exceeds %s bytes, it is not spooled.',
+                            section or '(whole message)', uid, self.__max_size
+                        )
+                        remove_files({'': path})
+                        return None
+
+                    f.write(chunk)
+                    if len(chunk) < self.__chunk_size:
+                        break
+        except Exception:
+            remove_files({'': path})
+            raise
+
+        return path
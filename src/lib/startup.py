@@ -0,0 +1,236 @@
+#
+# Copyright 2023 OpenIndex.de.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+from collections import deque
+from threading import Condition, Event
+from time import monotonic
+from typing import Callable, Iterable, TypeVar
+
+from . import root_logger
+
+T = TypeVar('T')
+
+
+def order_by_host(items: Iterable[T], get_host: Callable[[T], str]) -> list[T]:
+    """
+    Order items round-robin by their host, so that the first started handlers cover all hosts
+    and a single large host doesn't delay all others.
+
+    :param items: items to order
+    :param get_host: function, that returns the host of an item
+    :return: ordered items
+    """
+
+    queues: dict[str, deque] = {}
+    for item in items:
+        queues.setdefault(get_host(item).lower(), deque()).append(item)
+
+    result: list[T] = []
+    while queues:
+        for host in list(queues.keys()):
+            queue = queues[host]
+            result.append(queue.popleft())
+            if not queue:
+                del queues[host]
+
+    return result
+
+
+class StartupTicket:
+    """
+    Permission to open an IDLE connection to a certain host.
+    """
+
+    __slots__ = ('name', 'host', 'released')
+
+    def __init__(self, name: str, host: str):
+        self.name = name
+        self.host = host
+        self.released = False
+
+
+class StartupHostState:
+    """
+    Connection attempts of a single host.
+    """
+
+    def __init__(self):
+        self.active = 0
+        self.waiting: deque[StartupTicket] = deque()
+        self.next_connect_at = 0.0
+
+
+class StartupScheduler:
+    """
+    Limits concurrent and per second IDLE connection attempts for each host.
+
+    A connection attempt holds a ticket from login until IDLE mode is entered (or the attempt failed).
+    Waiting handlers are served in order of their requests. Additionally, the time until all expected
+    handlers reached IDLE mode is measured.
+    """
+
+    def __init__(
+            self,
+            max_concurrent_per_host: int = 10,
+            connections_per_second_per_host: float = 5.0,
+    ):
+        self.__max_concurrent = max_concurrent_per_host
+        self.__interval = 1.0 / connections_per_second_per_host if connections_per_second_per_host > 0 else 0.0
+        self.__hosts: dict[str, StartupHostState] = {}
+        self.__condition = Condition()
+        self.__ramp_started_at: float | None = None
+        self.__ramp_pending: set[str] = set()
+        self.__ramp_total = 0
+        self.__ramp_duration: float | None = None
+
+    def expect(self, names: Iterable[str]):
+        """
+        Start measuring the time until all provided handlers reached IDLE mode.
+
+        :param names: names of the started handlers
+        """
+
+        with self.__condition:
+            names = set(names)
+            if not names:
+                return
+            if self.__ramp_started_at is None:
+                self.__ramp_started_at = monotonic()
+                self.__ramp_total = 0
+            self.__ramp_pending.update(names)
+            self.__ramp_total += len(names)
+
+    def forget(self, name: str):
+        """
+        Stop waiting for a handler to reach IDLE mode (e.g. because it was stopped).
+
+        :param name: handler name
+        """
+
+        with self.__condition:
+            if name in self.__ramp_pending:
+                self.__ramp_pending.discard(name)
+                self.__ramp_total -= 1
+                self.__check_ramp_finished()
+
+    def acquire(
+            self,
+            name: str,
+            host: str,
+            timeout: float | None = None,
+            cancel: Event | None = None,
+    ) -> StartupTicket | None:
+        """
+        Wait for permission to open a connection to a host.
+
+        :param name: handler name
+        :param host: target host
+        :param timeout: maximal number of seconds to wait or None to wait infinitely
+        :param cancel: stop waiting, if this event is set
+        :return: ticket or None, if the timeout was reached or waiting was cancelled
+        """
+
+        ticket = StartupTicket(name=name, host=host.lower())
+        deadline = monotonic() + timeout if timeout is not None else None
+
+        with self.__condition:
+            state = self.__hosts.setdefault(ticket.host, StartupHostState())
+            state.waiting.append(ticket)
+
+            while True:
+                now = monotonic()
+                if state.waiting[0] is ticket \
+                        and (self.__max_concurrent <= 0 or state.active < self.__max_concurrent) \
+                        and now >= state.next_connect_at:
+                    state.waiting.popleft()
+                    state.active += 1
+                    state.next_connect_at = max(now, state.next_connect_at) + self.__interval
+                    self.__condition.notify_all()
+                    return ticket
+
+                if (cancel is not None and cancel.is_set()) or (deadline is not None and now >= deadline):
+                    state.waiting.remove(ticket)
+                    self.__condition.notify_all()
+                    return None
+
+                wait = state.next_connect_at - now if state.next_connect_at > now else None
+                if deadline is not None:
+                    wait = min(wait, deadline - now) if wait is not None else deadline - now
+                if cancel is not None:
+                    wait = min(wait, 1.0) if wait is not None else 1.0
+
+                self.__condition.wait(timeout=wait)
+
+    def release(self, ticket: StartupTicket | None, idle: bool = False):
+        """
+        Give back a ticket after IDLE mode was entered or the connection attempt failed.
+
+        :param ticket: ticket returned by acquire()
+        :param idle: True, if IDLE mode was entered successfully
+        """
+
+        if ticket is None:
+            return
+
+        with self.__condition:
+            if not ticket.released:
+                ticket.released = True
+                self.__hosts[ticket.host].active -= 1
+                self.__condition.notify_all()
+
+            if idle and ticket.name in self.__ramp_pending:
+                self.__ramp_pending.discard(ticket.name)
+                self.__check_ramp_finished()
+
+    def get_time_to_all_idle(self) -> float | None:
+        """
+        Get the number of seconds it took for the last batch of started handlers to reach IDLE mode.
+
+        :return: number of seconds or None, if not all handlers reached IDLE mode yet
+        """
+
+        with self.__condition:
+            return self.__ramp_duration
+
+    def get_usage(self) -> dict[str, dict[str, int]]:
+        """
+        Get the number of active and waiting connection attempts for each host.
+
+        :return: usage per host
+        """
+
+        with self.__condition:
+            return {
+                host: {'active': state.active, 'waiting': len(state.waiting)}
+                for host, state in self.__hosts.items()
+            }
+
+    def __check_ramp_finished(self):
+        """
+        Log the time to all IDLE, if all expected handlers reached IDLE mode.
+        Must be called while holding the lock.
+        """
+
+        if self.__ramp_started_at is None or self.__ramp_pending:
+            return
+
+        self.__ramp_duration = monotonic() - self.__ramp_started_at
+        self.__ramp_started_at = None
+        if self.__ramp_total > 0:
+            root_logger.info(
+                'All %s started mailboxes reached IDLE mode after %.1f seconds.',
+                self.__ramp_total, self.__ramp_duration
+            )
@@ -0,0 +1,113 @@
+#
+# Copyright 2023 OpenIndex.de.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+from array import array
+from typing import Iterable
+
+
+class UidMap:
+    """
+    Maps message sequence numbers of a selected folder to UIDs.
+
+    UIDs are stored in a compact array of unsigned 32-bit integers (4 bytes per message), the index of a UID is its
+    sequence number minus one. The map is loaded once after the folder was selected and is updated incrementally from
+    EXISTS and EXPUNGE responses. UIDs of new messages are not known until they are fetched, these are stored as 0.
+    """
+
+    __slots__ = ('__uids',)
+
+    UNKNOWN: int = 0
+    """
+    Placeholder for messages with an unknown UID (valid UIDs are greater than 0).
+    """
+
+    def __init__(self, uids: Iterable[int] = ()):
+        self.__uids = array('I', uids)
+
+    def __len__(self) -> int:
+        return len(self.__uids)
+
+    def load(self, uids: Iterable[int]):
+        """
+        Replace all UIDs of the map.
+
+        :param uids: UIDs ordered by sequence number
+        """
+
+        self.__uids = array('I', sorted(uids))
+
+    def get(self, sequence_number: int) -> int | None:
+        """
+        Get the UID of a message.
+
+        :param sequence_number: message sequence number
+        :return: UID or None, if the UID is not known
+        """
+
+        if sequence_number < 1 or sequence_number > len(self.__uids):
+            return None
+        uid = self.__uids[sequence_number - 1]
+        return uid if uid != self.UNKNOWN else None
+
+    def get_first_unknown(self) -> int | None:
+        """
+        Get the first message with an unknown UID.
+
+        :return: sequence number or None, if all UIDs are known
+        """
+
+        try:
+            return self.__uids.index(self.UNKNOWN) + 1
+        except ValueError:
+            return None
+
+    def set(self, sequence_number: int, uid: int):
+        """
+        Store the UID of a message, that was fetched after an EXISTS response.
+
+        :param sequence_number: message sequence number
+        :param uid: UID
+        """
+
+        if 1 <= sequence_number <= len(self.__uids):
+            self.__uids[sequence_number - 1] = uid
+
+    def exists(self, count: int):
+        """
+        Apply an EXISTS response. Placeholders are appended for new messages.
+
+        :param count: number of messages in the folder
+        """
+
+        missing = count - len(self.__uids)
+        if missing > 0:
+            self.__uids.extend(self.UNKNOWN for _ in range(missing))
+        elif missing < 0:
+            # should not happen without EXPUNGE responses, keep the map consistent anyway
+            del self.__uids[count:]
+
+    def expunge(self, sequence_number: int) -> int | None:
+        """
+        Apply an EXPUNGE response. Sequence numbers of all following messages are decremented.
+
+        :param sequence_number: sequence number of the removed message
+        :return: UID of the removed message or None, if the UID is not known
+        """
+
+        uid = self.get(sequence_number)
+        if 1 <= sequence_number <= len(self.__uids):
+            del self.__uids[sequence_number - 1]
+        return uid
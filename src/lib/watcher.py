@@ -0,0 +1,250 @@
+#
+# Copyright 2023 OpenIndex.de.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+from configparser import ConfigParser
+from threading import Lock
+
+from . import root_logger
+from .actions import MailboxActionExecutor
+from .backfill import BackfillProgress
+from .budget import ConnectionBudget
+from .callback import CallbackHandler
+from .config import GLOBAL_SECTION, \
+    get_section_fingerprint, \
+    create_account_config, \
+    create_inventory, \
+    create_imap_connector, \
+    create_imap_idle_handler, \
+    create_callback_handler
+from .connector import ImapConnector
+from .dedup import MessageDeduplicator
+from .fetcher import MessageFetcher
+from .idle import ImapIdleHandler
+from .inventory import Inventory
+from .journal import EventJournal
+from .priority import CallbackDispatcher
+from .publisher import EventPublisher
+from .reconnect import ReconnectIntervals
+from .startup import StartupScheduler, order_by_host
+
+
+class ImapWatcher:
+    """
+    Manages the IDLE handlers of all configured mailboxes.
+
+    On configuration changes only the handlers of added, removed or modified accounts are started, stopped or
+    rebuilt. Handlers of untouched accounts keep their IMAP connections. Accounts are taken from the mailbox
+    sections of the configuration or from an inventory.
+    """
+
+    SECONDS_TO_WAIT_FOR_STOP: int = 30
+    """
+    Number of seconds to wait for a handler thread to stop, before its replacement is started anyway.
+    """
+
+    def __init__(
+            self,
+            deduplicator: MessageDeduplicator | None = None,
+            startup_scheduler: StartupScheduler | None = None,
+            budget: ConnectionBudget | None = None,
+            dispatcher: CallbackDispatcher | None = None,
+            fetcher: MessageFetcher | None = None,
+            executor: MailboxActionExecutor | None = None,
+            reconnect_intervals: ReconnectIntervals | None = None,
+            backfill_progress: BackfillProgress | None = None,
+            publisher: EventPublisher | None = None,
+            journal: EventJournal | None = None,
+    ):
+        self.__deduplicator = deduplicator
+        self.__startup_scheduler = startup_scheduler
+        self.__budget = budget
+        self.__dispatcher = dispatcher
+        self.__fetcher = fetcher
+        self.__executor = executor
+        self.__reconnect_intervals = reconnect_intervals
+        self.__backfill_progress = backfill_progress
+        self.__publisher = publisher
+        self.__journal = journal
+        self.__config: ConfigParser | None = None
+        self.__handlers: dict[str, ImapIdleHandler] = {}
+        self.__stopping: list[ImapIdleHandler] = []
+        self.__fingerprints: dict[str, tuple] = {}
+        self.__lock = Lock()
+
+    def start(self, config: ConfigParser, inventory: Inventory | None = None):
+        """
+        Start handlers for all mailboxes in the configuration.
+
+        :param config: configuration
+        :param inventory: source of accounts or None, to use the mailbox sections of the configuration
+        """
+
+        self.reload(config, inventory)
+
+    def reload(self, config: ConfigParser, inventory: Inventory | None = None):
+        """
+        Apply a new configuration by starting, stopping or rebuilding the handlers of changed accounts.
+
+        :param config: new configuration
+        :param inventory: source of accounts or None, to use the mailbox sections of the configuration
+        """
+
+        if inventory is None:
+            inventory = create_inventory(config)
+
+        with self.__lock:
+            old_config = self.__config
+            if old_config is not None and \
+                    get_section_fingerprint(old_config, GLOBAL_SECTION) != \
+                    get_section_fingerprint(config, GLOBAL_SECTION):
+                root_logger.warning('Changes in the "%s" section require a restart.', GLOBAL_SECTION)
+
+            fingerprints = inventory.get_fingerprints()
+            removed = [name for name in self.__handlers if name not in fingerprints]
+            changed = [name for name, fingerprint in fingerprints.items()
+                       if name in self.__handlers and self.__fingerprints.get(name) != fingerprint]
+            added = [name for name in fingerprints if name not in self.__handlers]
+
+            if old_config is not None:
+                root_logger.info(
+                    'Reloading configuration (%s added, %s changed, %s removed, %s untouched).',
+                    len(added), len(changed), len(removed),
+                    len(fingerprints) - len(added) - len(changed)
+                )
+
+            self.__stop_sections(removed + changed)
+
+            # only added or changed accounts are loaded
+            handlers: list[ImapIdleHandler] = []
+            for name in changed + added:
+                try:
+                    options = inventory.load(name)
+                    if options is None:
+                        continue
+                    handlers.append(self.__create_handler(create_account_config(config, name, options), name))
+                except Exception as ex:
+                    root_logger.exception('Can\'t create handler for "%s". %s', name, str(ex))
+
+            # start handlers round-robin by host, the scheduler limits connection attempts per host
+            handlers = order_by_host(handlers, lambda h: h.host)
+            if self.__startup_scheduler:
+                self.__startup_scheduler.expect([handler.name for handler in handlers])
+
+            for handler in handlers:
+                self.__handlers[handler.name] = handler
+                self.__fingerprints[handler.name] = fingerprints[handler.name]
+                handler.start()
+
+            self.__config = config
+
+    def stop(self):
+        """
+        Stop all handlers.
+        """
+
+        with self.__lock:
+            self.__stop_sections(list(self.__handlers.keys()))
+
+    def join(self):
+        """
+        Wait until all handler threads are finished.
+        """
+
+        for handler in list(self.__handlers.values()):
+            handler.join()
+
+    def get_sections(self) -> list[str]:
+        """
+        Get names of all currently watched sections.
+
+        :return: section names
+        """
+
+        return list(self.__handlers.keys())
+
+    def get_running_sections(self) -> set[str]:
+        """
+        Get names of all sections, whose handler threads are running, including handlers that are still stopping.
+        This does not wait for the lock, as it is called while handlers are stopped.
+
+        :return: section names
+        """
+
+        handlers = list(self.__handlers.values()) + list(self.__stopping)
+        return {handler.name for handler in handlers if handler.is_alive()}
+
+    def __create_handler(self, config: ConfigParser, section: str) -> ImapIdleHandler:
+        """
+        Create callback handler, connector and IDLE handler for a section.
+
+        :param config: configuration
+        :param section: section name
+        :return: created IDLE handler
+        """
+
+        connector: ImapConnector = create_imap_connector(
+            config=config,
+            section=section,
+            budget=self.__budget,
+        )
+
+        callback: CallbackHandler = create_callback_handler(
+            config=config,
+            section=section,
+            deduplicator=self.__deduplicator,
+            dispatcher=self.__dispatcher,
+            connector=connector,
+            executor=self.__executor,
+            publisher=self.__publisher,
+            journal=self.__journal,
+        )
+
+        return create_imap_idle_handler(
+            config=config,
+            section=section,
+            connector=connector,
+            callback=callback,
+            startup_scheduler=self.__startup_scheduler,
+            fetcher=self.__fetcher,
+            reconnect_intervals=self.__reconnect_intervals,
+            backfill_progress=self.__backfill_progress,
+        )
+
+    def __stop_sections(self, sections: list[str]):
+        """
+        Stop handlers of some sections and wait for them to finish.
+        Must be called while holding the lock.
+
+        :param sections: section names
+        """
+
+        handlers: list[ImapIdleHandler] = []
+        for section in sections:
+            handler = self.__handlers.get(section)
+            if handler:
+                # stopping handlers are still reported as running
+                self.__stopping.append(handler)
+                handler.stop()
+                handlers.append(handler)
+            self.__handlers.pop(section, None)
+            self.__fingerprints.pop(section, None)
+
+        for handler in handlers:
+            handler.join(timeout=self.SECONDS_TO_WAIT_FOR_STOP)
+            if handler.is_alive():
+                root_logger.warning('Handler for "%s" did not stop in time.', handler.name)
+
+        self.__stopping = [handler for handler in self.__stopping if handler.is_alive()]
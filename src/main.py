@@ -14,42 +14,213 @@
 # limitations under the License.
 #
 
+import atexit
+import os
+import signal
+from threading import Event
+from time import time
+
 from lib import root_logger
-from lib.callback import CallbackHandler
-from lib.config import get_config, \
-    create_imap_connector, \
-    create_imap_idle_handler, \
-    create_callback_handler
-from lib.connector import ImapConnector
+from lib.config import get_config_path, \
+    read_config, \
+    setup_logging, \
+    setup_threads, \
+    get_config_watch_interval, \
+    create_message_deduplicator, \
+    create_startup_scheduler, \
+    create_reconnect_intervals, \
+    create_backfill_progress, \
+    create_connection_budget, \
+    create_external_inventory, \
+    create_inventory, \
+    create_callback_dispatcher, \
+    create_message_fetcher, \
+    create_action_executor, \
+    create_event_publisher, \
+    create_event_journal, \
+    create_section_leases, \
+    get_callback_stats_interval
+from lib.actions import MailboxActionExecutor
+from lib.backfill import BackfillProgress
+from lib.budget import ConnectionBudget
+from lib.dedup import MessageDeduplicator
+from lib.fetcher import MessageFetcher
 from lib.idle import ImapIdleHandler
+from lib.inventory import Inventory
+from lib.journal import EventJournal
+from lib.lease import SectionLeases, LeasedInventory
+from lib.priority import CallbackDispatcher
+from lib.publisher import EventPublisher
+from lib.reconnect import ReconnectIntervals
+from lib.startup import StartupScheduler
+from lib.watcher import ImapWatcher
 
 if __name__ == '__main__':
-    config = get_config(logger=root_logger)
+    config_path = get_config_path(logger=root_logger)
+    if not config_path:
+        exit(1)
+
+    config = read_config(config_path=config_path, logger=root_logger)
     if not config:
         exit(1)
 
-    sections = config.sections()
-    if not sections:
+    try:
+        setup_logging(config=config)
+    except Exception as ex:
+        root_logger.error('Invalid logging configuration. %s', str(ex))
+        exit(1)
+
+    try:
+        setup_threads(config=config)
+    except Exception as ex:
+        root_logger.error('Invalid thread configuration. %s', str(ex))
+        exit(1)
+
+    try:
+        external_inventory: Inventory | None = create_external_inventory(config=config)
+    except Exception as ex:
+        root_logger.error('Invalid account inventory configuration. %s', str(ex))
+        exit(1)
+
+    inventory: Inventory = create_inventory(config=config, external=external_inventory)
+    if not inventory.get_fingerprints() and not external_inventory:
         root_logger.warning('No IMAP servers configured. Nothing to do.')
         exit(0)
 
-    for section in sections:
-        callback: CallbackHandler = create_callback_handler(
+    # accounts are shared with other instances, if a coordination file is configured
+    try:
+        leases: SectionLeases | None = create_section_leases(
             config=config,
-            section=section,
+            stop_timeout=ImapIdleHandler.SECONDS_TO_WAIT_FOR_STOP,
         )
+    except Exception as ex:
+        root_logger.error('Invalid coordination configuration. %s', str(ex))
+        exit(1)
+    if leases:
+        root_logger.info('Sharing accounts with other instances as "%s".', leases.owner)
+        inventory = LeasedInventory(inventory, leases)
 
-        connector: ImapConnector = create_imap_connector(
-            config=config,
-            section=section,
-        )
+    deduplicator: MessageDeduplicator | None = create_message_deduplicator(config=config)
+    if deduplicator:
+        atexit.register(deduplicator.save)
 
-        handler: ImapIdleHandler = create_imap_idle_handler(
-            config=config,
-            section=section,
-            connector=connector,
-            callback=callback,
-        )
+    startup_scheduler: StartupScheduler = create_startup_scheduler(config=config)
+
+    try:
+        budget: ConnectionBudget | None = create_connection_budget(config=config)
+    except Exception as ex:
+        root_logger.error('Invalid connection limits. %s', str(ex))
+        exit(1)
+
+    reconnect_intervals: ReconnectIntervals = create_reconnect_intervals(config=config)
+    backfill_progress: BackfillProgress = create_backfill_progress(config=config)
+
+    try:
+        dispatcher: CallbackDispatcher | None = create_callback_dispatcher(config=config)
+    except Exception as ex:
+        root_logger.error('Invalid callback configuration. %s', str(ex))
+        exit(1)
+
+    try:
+        fetcher: MessageFetcher | None = create_message_fetcher(config=config)
+    except Exception as ex:
+        root_logger.error('Invalid fetch configuration. %s', str(ex))
+        exit(1)
+
+    executor: MailboxActionExecutor = create_action_executor(config=config)
+
+    try:
+        publisher: EventPublisher | None = create_event_publisher(config=config)
+        if publisher:
+            publisher.start()
+    except Exception as ex:
+        root_logger.error('Invalid publisher configuration. %s', str(ex))
+        exit(1)
+
+    try:
+        journal: EventJournal | None = create_event_journal(config=config)
+    except Exception as ex:
+        root_logger.error('Invalid journal configuration. %s', str(ex))
+        exit(1)
+
+    watcher = ImapWatcher(
+        deduplicator=deduplicator,
+        startup_scheduler=startup_scheduler,
+        budget=budget,
+        dispatcher=dispatcher,
+        fetcher=fetcher,
+        executor=executor,
+        reconnect_intervals=reconnect_intervals,
+        backfill_progress=backfill_progress,
+        publisher=publisher,
+        journal=journal,
+    )
+    watcher.start(config, inventory)
+    if leases:
+        leases.has_changed()
+        leases.start(get_running=watcher.get_running_sections)
+
+    # reload configuration on SIGHUP or optionally on modification of the config file or the account inventory
+    reload_requested = Event()
+    stop_requested = Event()
+    signal.signal(signal.SIGHUP, lambda signum, frame: reload_requested.set())
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_requested.set())
+
+    watch_interval: int = get_config_watch_interval(config)
+    config_modified_at = os.path.getmtime(config_path)
+    config_checked_at = time()
+
+    stats_interval: int = get_callback_stats_interval(config)
+    stats_logged_at = time()
+
+    try:
+        while not stop_requested.wait(timeout=1):
+            if leases and leases.has_changed():
+                root_logger.info('Owned accounts have changed.')
+                watcher.reload(config, inventory)
+
+            if dispatcher and stats_interval > 0 and time() - stats_logged_at >= stats_interval:
+                stats_logged_at = time()
+                dispatcher.log_usage()
+
+            if watch_interval > 0 and time() - config_checked_at >= watch_interval:
+                config_checked_at = time()
+                try:
+                    modified_at = os.path.getmtime(config_path)
+                except OSError:
+                    modified_at = config_modified_at
+                if modified_at != config_modified_at:
+                    config_modified_at = modified_at
+                    reload_requested.set()
+                elif external_inventory and external_inventory.has_changed():
+                    reload_requested.set()
+
+            if not reload_requested.is_set():
+                continue
+
+            reload_requested.clear()
+            root_logger.info('Reloading configuration from "%s".', config_path)
+            new_config = read_config(config_path=config_path, logger=root_logger)
+            if new_config:
+                config = new_config
+            inventory = create_inventory(config=config, external=external_inventory)
+            if leases:
+                inventory = LeasedInventory(inventory, leases)
+            watcher.reload(config, inventory)
+
+    except KeyboardInterrupt:
+        root_logger.info('Stopped by keyboard interruption.')
 
-        handler.start()
-        # handler.join()
+    root_logger.info('Stopping all handlers.')
+    watcher.stop()
+    if leases:
+        leases.release()
+    if fetcher:
+        fetcher.stop()
+    if dispatcher:
+        dispatcher.stop()
+    executor.stop()
+    if publisher:
+        publisher.stop()
+    if journal:
+        journal.close()
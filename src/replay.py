@@ -0,0 +1,176 @@
+#
+# Copyright 2023 OpenIndex.de.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import argparse
+import sys
+from configparser import ConfigParser
+from datetime import datetime
+from time import perf_counter, sleep
+
+from lib import create_logger
+from lib.callback import CallbackHandler
+from lib.config import GLOBAL_SECTION, \
+    read_config, \
+    setup_logging, \
+    create_account_config, \
+    create_callback_dispatcher, \
+    create_callback_handler, \
+    create_external_inventory, \
+    create_inventory
+from lib.event import MessageEvent
+from lib.inventory import Inventory
+from lib.journal import read_journal
+from lib.priority import CallbackDispatcher
+from lib.spawner import get_process_reaper
+
+
+def parse_time(value: str | None) -> float | None:
+    """
+    Parse a point in time given on the command line.
+
+    :param value: date and time in ISO format (e.g. "2024-01-31 12:00"), local time is used without a time zone
+    :return: timestamp or None, if no value was given
+    """
+
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        raise argparse.ArgumentTypeError('Invalid date "%s".' % value)
+
+
+def wait_for_callbacks(dispatcher: CallbackDispatcher | None):
+    """
+    Wait until queued and launched callback commands finished.
+    Callbacks running in their own (non-daemon) threads are awaited on exit.
+
+    :param dispatcher: callback dispatcher, if callbacks are queued
+    """
+
+    if dispatcher:
+        dispatcher.join()
+    while get_process_reaper().get_running_count() > 0:
+        sleep(0.1)
+
+
+if __name__ == '__main__':
+    root_logger = create_logger()
+
+    parser = argparse.ArgumentParser(description='Replay recorded message events through configured callbacks.')
+    parser.add_argument('config', help='path to the configuration file')
+    parser.add_argument('--journal', metavar='DIR', default=None,
+                        help='journal directory (default: "journal_directory" of the configuration)')
+    parser.add_argument('--from', dest='start', metavar='TIME', type=parse_time, default=None,
+                        help='replay events recorded at or after this time (e.g. "2024-01-31 12:00")')
+    parser.add_argument('--to', dest='end', metavar='TIME', type=parse_time, default=None,
+                        help='replay events recorded before this time')
+    parser.add_argument('--section', action='append', default=[],
+                        help='replay only events of this section (might be used multiple times)')
+    parser.add_argument('--callback', metavar='SECTION', default=None,
+                        help='replay all events through the callback of this section '
+                             '(default: the section of each event)')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='factor of the original timing, e.g. 2 replays twice as fast, '
+                             '0 replays as fast as possible (default: 1)')
+    args = parser.parse_args()
+
+    config = read_config(config_path=args.config, logger=root_logger)
+    if not config:
+        sys.exit(1)
+
+    try:
+        setup_logging(config=config)
+    except Exception as ex:
+        root_logger.error('Invalid logging configuration. %s', str(ex))
+        sys.exit(1)
+
+    journal_directory: str = args.journal or config.get(GLOBAL_SECTION, 'journal_directory', fallback='').strip()
+    if not journal_directory:
+        root_logger.error('No journal directory configured.')
+        sys.exit(1)
+
+    try:
+        inventory: Inventory = create_inventory(config=config, external=create_external_inventory(config=config))
+        dispatcher: CallbackDispatcher | None = create_callback_dispatcher(config=config)
+    except Exception as ex:
+        root_logger.error('Invalid configuration. %s', str(ex))
+        sys.exit(1)
+
+    # callback handlers are created on first use, events are not deduplicated, published or recorded again
+    handlers: dict[str, CallbackHandler | None] = {}
+
+    def get_handler(name: str) -> CallbackHandler | None:
+        if name not in handlers:
+            handler: CallbackHandler | None = None
+            try:
+                options = inventory.load(name)
+                if options is None:
+                    root_logger.warning('Section "%s" is not configured, its events are skipped.', name)
+                else:
+                    account_config: ConfigParser = create_account_config(config, name, options)
+                    handler = create_callback_handler(config=account_config, section=name, dispatcher=dispatcher)
+                    if not handler.has_new_message_command:
+                        root_logger.warning('Section "%s" has no "on_new_message" command, its events are skipped.',
+                                            name)
+                        handler = None
+            except Exception as ex:
+                root_logger.error('Invalid configuration of section "%s". %s', name, str(ex))
+            handlers[name] = handler
+        return handlers[name]
+
+    replayed = 0
+    skipped = 0
+    first_recorded_at: float | None = None
+    started = perf_counter()
+    try:
+        for recorded_at, data in read_journal(journal_directory, start=args.start, end=args.end):
+            if args.section and data.get('section') not in args.section:
+                continue
+
+            # keep the original distance between events
+            if first_recorded_at is None:
+                first_recorded_at = recorded_at
+            if args.speed > 0:
+                delay = (recorded_at - first_recorded_at) / args.speed - (perf_counter() - started)
+                if delay > 0:
+                    sleep(delay)
+
+            handler = get_handler(args.callback or data.get('section') or '')
+            if not handler:
+                skipped += 1
+                continue
+
+            try:
+                handler.trigger_new_message_command(event=MessageEvent.from_dict(data))
+                replayed += 1
+            except Exception as ex:
+                root_logger.exception('Replay failed. %s', str(ex))
+                skipped += 1
+
+    except KeyboardInterrupt:
+        root_logger.info('Stopped by keyboard interruption.')
+
+    duration = perf_counter() - started
+    root_logger.info(
+        'Replayed %s events in %.1f seconds (%.1f events per second), %s skipped.',
+        replayed, duration, replayed / duration if duration > 0 else 0.0, skipped
+    )
+
+    wait_for_callbacks(dispatcher)
+    root_logger.info('All callbacks finished after %.1f seconds.', perf_counter() - started)
+    if dispatcher:
+        dispatcher.stop()